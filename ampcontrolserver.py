@@ -6,14 +6,47 @@ response or error message.
 """
 
 import commands
+import json
 
+from statuspublisher import split_update
+from twisted.internet.defer import maybeDeferred
 from twisted.internet.protocol import Factory
-from twisted.protocols.amp import AMP
+from twisted.protocols.amp import AMP, MAX_VALUE_LENGTH
 
 
 class AMPControlServer(AMP):
     def __init__(self, client):
+        AMP.__init__(self)
         self._client = client
+        self._subscription = None
+
+    def connectionLost(self, reason):
+        self.unsubscribe()
+        AMP.connectionLost(self, reason)
+
+    def _send_update(self, deltas):
+        # Split the update among as many messages as needed to keep each
+        # within the AMP value size limit
+        for chunk in split_update(deltas, MAX_VALUE_LENGTH):
+            self.callRemote(commands.MsgStatusUpdate, deltas=chunk)
+
+    @commands.MsgSubscribe.responder
+    def subscribe(self, interval):
+        self.unsubscribe()
+        try:
+            self._subscription = self._client.subscribe(self._send_update,
+                                                        interval)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return dict()
+
+    @commands.MsgUnsubscribe.responder
+    def unsubscribe(self):
+        if self._subscription is not None:
+            self._subscription.cancel()
+            self._subscription = None
+        return dict()
 
     @commands.MsgAdd.responder
     def add(self, filename):
@@ -26,6 +59,28 @@ class AMPControlServer(AMP):
         return (self._client.add_torrent(filename)
                 .addCallbacks(success, failure))
 
+    @commands.MsgAddMany.responder
+    def add_many(self, filenames=None, directory=None, concurrency=None,
+                 stream=False):
+        def result(outcome):
+            if stream:
+                self.callRemote(commands.MsgAddResult, **outcome)
+
+        def success((added, failed)):
+            return dict(added=added, failed=failed)
+
+        kwargs = {}
+        if concurrency is not None:
+            kwargs['concurrency'] = concurrency
+
+        try:
+            d = self._client.add_torrents(filenames or (), directory,
+                                          result=result, **kwargs)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return d.addCallback(success)
+
     @commands.MsgStatus.responder
     def get_status(self, key):
         try:
@@ -35,6 +90,101 @@ class AMPControlServer(AMP):
 
         return status
 
+    @commands.MsgPriority.responder
+    def priority(self, key, priority, file=None):
+        def failure(err):
+            raise commands.MsgError(err.getErrorMessage())
+
+        file_indices = [file] if file is not None else None
+        return (maybeDeferred(self._client.set_priority, key, priority,
+                              file_indices)
+                .addCallbacks(lambda _: dict(), failure))
+
+    @commands.MsgStream.responder
+    def stream(self, key, enable, file=None):
+        def failure(err):
+            raise commands.MsgError(err.getErrorMessage())
+
+        return (maybeDeferred(self._client.set_streaming, key, enable, file)
+                .addCallbacks(lambda _: dict(), failure))
+
+    @commands.MsgQueue.responder
+    def queue(self, start=0, count=None):
+        queue = self._client.get_queue()
+        limits = queue['limits']
+        torrents = queue['torrents'][start:]
+        if count is not None:
+            torrents = torrents[:count]
+        return dict(torrents=json.dumps(torrents),
+                    total=len(queue['torrents']),
+                    downloads=limits['downloads'], seeds=limits['seeds'],
+                    connections=limits['connections'])
+
+    @commands.MsgQueueMove.responder
+    def queue_move(self, key, position):
+        try:
+            self._client.move_torrent(key, position)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return dict()
+
+    @commands.MsgQueueLimits.responder
+    def queue_limits(self, downloads=None, seeds=None, connections=None):
+        try:
+            return self._client.set_queue_limits(downloads, seeds,
+                                                 connections)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+    @commands.MsgTrace.responder
+    def trace(self, enable, sample=None):
+        def success(status):
+            return dict(enabled=status['enabled'], sample=status['sample'],
+                        records=status['records'])
+
+        try:
+            d = self._client.set_tracing(enable, sample)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return d.addCallback(success)
+
+    @commands.MsgTraceDump.responder
+    def trace_dump(self, filename):
+        def failure(err):
+            raise commands.MsgError(str(err.value))
+
+        return (self._client.dump_trace(filename)
+                .addCallbacks(lambda records: dict(records=records), failure))
+
+    @commands.MsgLag.responder
+    def get_lag(self):
+        def success(status):
+            turns = status['recent_slow_turns']
+            return dict(turns=status['turns'], p50=status['p50'],
+                        p99=status['p99'], max=status['max'],
+                        slow_turns=status['slow_turns'],
+                        last_slow_callback=str(turns[-1]['callback'] or ''
+                                               if turns else ''))
+
+        return self._client.get_lag().addCallback(success)
+
+    @commands.MsgProfile.responder
+    def profile(self, duration, mode, filename, format=None):
+        def success(size):
+            return dict(size=size)
+
+        def failure(err):
+            raise commands.MsgError(str(err.value))
+
+        try:
+            d = self._client.dump_profile(duration, mode, format, filename)
+        except Exception as err:
+            raise commands.MsgError(err.message)
+
+        return d.addCallbacks(success, failure)
+
     @commands.MsgQuit.responder
     def quit(self):
         self._client.quit()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+The bitfields benchmark measures the bitfield operations which the TorrentMgr
+performs on every bitfield message, have message and completed piece, for a
+torrent with a large number of pieces.  It compares the Bitfield class with
+bitstring's BitArray, which the TorrentMgr used before, when bitstring is
+installed.
+
+The operations are:
+
+    receive    make a bitfield from the bytes of a bitfield message and trim
+               it to the number of pieces, as in peer_bitfield()
+    send       convert a bitfield to the bytes of a bitfield message
+    ones       list the pieces a peer has
+    zeros      list the pieces which are not yet had
+    interest   list the wanted pieces a peer has, as in _check_interest()
+    count      count the pieces which are had
+    set        set the bit of every piece one at a time, as have messages do
+    range      check whether a file's range of pieces is had, as in
+               _available()
+
+Each bitfield has the given fraction of its bits set at random.  For each
+implementation and operation, the benchmark reports the best time for one
+operation over a number of repetitions as a json object on stdout, one per
+line.
+
+Usage:
+
+    python benchmarks/bitfields.py [--pieces N] [--density fraction]
+                                   [--repeat N] [--implementation name ...]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import json
+import random
+import time
+
+from bitfield import Bitfield
+from loopback import git_commit
+
+try:
+    from bitstring import BitArray
+except ImportError:
+    BitArray = None
+
+_OPERATIONS = ('receive', 'send', 'ones', 'zeros', 'interest', 'count', 'set',
+               'range')
+
+# The number of pieces in the range checked by the range operation, a file of
+# a few hundred megabytes in a torrent with 256 KB pieces
+_RANGE = 1000
+
+
+def _bitstring_operations(num_pieces):
+    # The operations as the TorrentMgr performed them with a BitArray
+    def receive(data):
+        bitfield = BitArray(bytes=data)
+        if bitfield[num_pieces:].any(1):
+            raise ValueError("Bits set beyond the last piece")
+        return bitfield[0:num_pieces]
+
+    def make(data):
+        return BitArray(bytes=data, length=num_pieces)
+
+    def set_all(bitfield):
+        for index in xrange(num_pieces):
+            bitfield[index] = 1
+
+    def range_all(bitfield, first, last):
+        return bitfield[first:last+1].all(1)
+
+    return {'make': make,
+            'receive': receive,
+            'send': lambda bitfield: bitfield.tobytes(),
+            'ones': lambda bitfield: list(bitfield.findall('0b1')),
+            'zeros': lambda bitfield: list(bitfield.findall('0b0')),
+            'interest': lambda a, b: list((a & b).findall('0b1')),
+            'count': lambda bitfield: bitfield.count(1),
+            'set': set_all,
+            'range': range_all}
+
+
+def _bitfield_operations(num_pieces):
+    def receive(data):
+        return Bitfield.from_bytes(bytearray(data)).trim(num_pieces)
+
+    def make(data):
+        return Bitfield.from_bytes(data, num_pieces)
+
+    def set_all(bitfield):
+        for index in xrange(num_pieces):
+            bitfield[index] = 1
+
+    def range_all(bitfield, first, last):
+        return bitfield.all(first, last+1)
+
+    return {'make': make,
+            'receive': receive,
+            'send': lambda bitfield: bitfield.tobytes(),
+            'ones': lambda bitfield: bitfield.ones(),
+            'zeros': lambda bitfield: bitfield.zeros(),
+            'interest': lambda a, b: (a & b).ones(),
+            'count': lambda bitfield: bitfield.count(),
+            'set': set_all,
+            'range': range_all}
+
+
+_IMPLEMENTATIONS = {'bitfield': _bitfield_operations,
+                    'bitstring': _bitstring_operations}
+
+
+def random_bytes(num_pieces, density):
+    """
+    random_bytes() returns the bytes of a bitfield message for num_pieces
+    pieces with about the given fraction of them set.
+    """
+    bits = [random.random() < density for _ in xrange(num_pieces)]
+    bits.extend([False] * (-num_pieces % 8))
+    return ''.join(chr(sum(bit << (7 - i)
+                           for i, bit in enumerate(bits[j:j+8])))
+                   for j in xrange(0, len(bits), 8))
+
+
+def bench(implementation, operation, num_pieces, density, repeat):
+    operations = _IMPLEMENTATIONS[implementation](num_pieces)
+    data = random_bytes(num_pieces, density)
+    other = random_bytes(num_pieces, density)
+    first = (num_pieces - _RANGE) // 2
+    last = first + _RANGE - 1
+
+    function = operations[operation]
+    if operation == 'receive':
+        call = lambda: function(data)
+    elif operation == 'interest':
+        call = lambda a=operations['make'](data), \
+            b=operations['make'](other): function(a, b)
+    elif operation == 'set':
+        call = lambda: function(operations['make'](data))
+    elif operation == 'range':
+        call = lambda a=operations['make']('\xff' * len(data)): \
+            function(a, first, last)
+    else:
+        call = lambda a=operations['make'](data): function(a)
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        call()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return {'benchmark': 'bitfields',
+            'commit': git_commit(),
+            'implementation': implementation,
+            'operation': operation,
+            'pieces': num_pieces,
+            'density': density,
+            'seconds': best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bitfield operations "
+                                                 "benchmark")
+    parser.add_argument('--pieces', type=int, default=100000,
+                        help="number of pieces in the torrent")
+    parser.add_argument('--density', type=float, default=0.5,
+                        help="fraction of the bits which are set")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="number of timed repetitions, the best of which "
+                             "is reported")
+    parser.add_argument('--implementation', nargs='+',
+                        choices=sorted(_IMPLEMENTATIONS),
+                        help="implementations to compare, by default those "
+                             "which can be imported")
+    args = parser.parse_args()
+
+    implementations = args.implementation
+    if implementations is None:
+        implementations = ['bitfield']
+        if BitArray is not None:
+            implementations.append('bitstring')
+    elif 'bitstring' in implementations and BitArray is None:
+        parser.error("bitstring is not installed")
+
+    random.seed(0)
+    for operation in _OPERATIONS:
+        for implementation in implementations:
+            print json.dumps(bench(implementation, operation, args.pieces,
+                                   args.density, args.repeat))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+The codec benchmark measures the incremental parsers and message encoders of
+the PeerWireTranslator and the HandshakeTranslator.  It gives a baseline for
+work on the parsers and their buffers.
+
+For decoding, a synthetic byte stream containing a mix of messages is fed
+through ProtocolAdapter.dataReceived() in chunks of a fixed size, which drives
+the translator exactly as the reactor does.  The chunk sizes model a slow
+trickle of single bytes, one TCP segment (1460 bytes) and a large socket read
+(64 KB).  For encoding, the same mix of messages is generated by calling the
+translator's tx methods with a readerwriter which discards the bytes.
+
+The message mixes are:
+
+    download   mostly 16 KB piece messages with the occasional have, as seen
+               by a downloading peer
+    control    short messages such as haves, requests, chokes and interest
+               changes, as seen by a seeding peer
+    handshake  back to back handshakes
+
+For each combination, the benchmark reports messages per second and the number
+of objects allocated per message.  Allocations are counted with sys.getcounts()
+on interpreters built with COUNT_ALLOCS.  Otherwise, when tracemalloc is
+available, the number of memory blocks still allocated afterwards and the peak
+memory traced are reported instead, and when neither is available, allocation
+figures are null.  The results are printed as json objects, one per line.
+
+Usage:
+
+    python benchmarks/codec.py [--messages N] [--repeat N] [--mix mix ...]
+                               [--chunk bytes ...]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import json
+import time
+
+from handshaketranslator import FAST_EXTENSION, HandshakeTranslator
+from handshaketranslator import make_reserved
+from peerwiretranslator import PeerWireTranslator
+from protocoladapter import ProtocolAdapter
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_BLOCK = 'B' * 2**14
+_INFO_HASH = 'I' * 20
+_PEER_ID = '-HS0001-' + 'P' * 12
+_RESERVED = make_reserved(FAST_EXTENSION)
+_CHUNK_SIZES = (1, 1460, 65536)
+_MIXES = ('download', 'control', 'handshake')
+
+
+class _Sink(object):
+    # A receiver which counts every message it is given
+    def __init__(self):
+        self.count = 0
+
+    def _received(self, *args):
+        self.count += 1
+
+    rx_keep_alive = rx_choke = rx_unchoke = rx_interested = \
+        rx_not_interested = rx_have = rx_bitfield = rx_request = rx_piece = \
+        rx_cancel = rx_handshake = rx_non_handshake = _received
+
+    def connection_lost(self):
+        pass
+
+
+class _NullWriter(object):
+    # A readerwriter which discards the bytes it is given
+    def set_receiver(self, receiver):
+        pass
+
+    def unset_receiver(self):
+        pass
+
+    def tx_bytes(self, data):
+        pass
+
+
+def _download_mix(translator, n):
+    for i in xrange(n):
+        if i % 16 == 15:
+            translator.tx_have(i // 16)
+        else:
+            translator.tx_piece(i // 16, (i % 16) * len(_BLOCK), _BLOCK)
+
+
+def _control_mix(translator, n):
+    for i in xrange(n):
+        kind = i % 8
+        if kind < 4:
+            translator.tx_have(i)
+        elif kind < 6:
+            translator.tx_request(i, 0, 2**14)
+        elif kind == 6:
+            translator.tx_interested()
+        else:
+            translator.tx_unchoke()
+
+
+def _handshake_mix(translator, n):
+    for _ in xrange(n):
+        translator.tx_handshake(_RESERVED, _INFO_HASH, _PEER_ID)
+
+
+_GENERATORS = {'download': (PeerWireTranslator, _download_mix),
+               'control': (PeerWireTranslator, _control_mix),
+               'handshake': (HandshakeTranslator, _handshake_mix)}
+
+
+class _Collector(_NullWriter):
+    # A readerwriter which keeps the bytes it is given
+    def __init__(self):
+        self.chunks = []
+
+    def tx_bytes(self, data):
+        self.chunks.append(data)
+
+
+def make_stream(mix, n):
+    """
+    make_stream() returns a string containing n messages of the specified
+    mix, encoded by the translators themselves.
+    """
+    translator_class, generate = _GENERATORS[mix]
+    collector = _Collector()
+    generate(translator_class(None, collector), n)
+    return ''.join(collector.chunks)
+
+
+def _allocations(function, n):
+    # Runs function, which handles n messages, and returns a dictionary
+    # describing the memory it allocates per message
+    if hasattr(sys, 'getcounts'):
+        def total():
+            return sum(allocs for _, allocs, _, _ in sys.getcounts())
+        before = total()
+        function()
+        return {'allocation_method': 'getcounts',
+                'allocations_per_message': float(total() - before) / n}
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        function()
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained = sum(stat.count_diff
+                       for stat in after.compare_to(before, 'lineno'))
+        return {'allocation_method': 'tracemalloc',
+                'retained_blocks_per_message': float(retained) / n,
+                'peak_bytes_per_message': float(peak) / n}
+
+    function()
+    return {'allocation_method': None,
+            'allocations_per_message': None}
+
+
+def bench_decode(mix, n, chunk_size, repeat):
+    translator_class, _ = _GENERATORS[mix]
+    stream = make_stream(mix, n)
+    chunks = [stream[i:i+chunk_size]
+              for i in xrange(0, len(stream), chunk_size)]
+
+    def decode():
+        sink = _Sink()
+        adapter = ProtocolAdapter(None)
+        translator_class(sink, adapter)
+        for chunk in chunks:
+            adapter.dataReceived(chunk)
+        return sink.count
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        count = decode()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    if count != n:
+        raise RuntimeError("Decoded {} of {} {} messages"
+                           .format(count, n, mix))
+
+    result = {'benchmark': 'codec',
+              'operation': 'decode',
+              'mix': mix,
+              'chunk_size': chunk_size,
+              'messages': n,
+              'bytes': len(stream),
+              'messages_per_second': n / best,
+              'mb_per_second': len(stream) / best / 2**20}
+    result.update(_allocations(decode, n))
+    return result
+
+
+def bench_encode(mix, n, repeat):
+    translator_class, generate = _GENERATORS[mix]
+
+    def encode():
+        generate(translator_class(None, _NullWriter()), n)
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        encode()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {'benchmark': 'codec',
+              'operation': 'encode',
+              'mix': mix,
+              'messages': n,
+              'messages_per_second': n / best}
+    result.update(_allocations(encode, n))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Translator codec "
+                                                 "benchmark")
+    parser.add_argument('--messages', type=int, default=20000,
+                        help="number of messages in each stream")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of timed repetitions, the best of which "
+                             "is reported")
+    parser.add_argument('--mix', nargs='+', choices=_MIXES,
+                        default=list(_MIXES), help="message mixes")
+    parser.add_argument('--chunk', nargs='+', type=int,
+                        default=list(_CHUNK_SIZES),
+                        help="sizes of the chunks passed to dataReceived")
+    args = parser.parse_args()
+
+    for mix in args.mix:
+        # A stream of full size pieces fed one byte at a time takes a long
+        # time, so fewer messages are used for the smallest chunks
+        for chunk_size in args.chunk:
+            n = args.messages
+            if mix == 'download' and chunk_size < 64:
+                n = max(16, n // 256)
+            print json.dumps(bench_decode(mix, n, chunk_size, args.repeat))
+            sys.stdout.flush()
+        print json.dumps(bench_encode(mix, args.messages, args.repeat))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+
+"""
+The loopback benchmark measures how quickly a TorrentMgr downloads a torrent
+without relying on the public internet.  It generates a synthetic torrent,
+starts a stand-in HTTP tracker and a number of seeders speaking the peer wire
+protocol on localhost and runs a headless TorrentMgr until it has downloaded
+the entire torrent.
+
+The tracker and seeders run in a separate process so that the CPU time and
+memory which are reported belong to the downloading client alone.  The
+benchmark reports the throughput in MB/s, the CPU time per MB, the peak
+resident set size and the times to the first and last piece as a json object
+on stdout.  With --output, the result is also appended as a line to the
+specified file along with the current git commit so that regressions in the
+TorrentMgr, FileMgr and translators can be tracked across commits.
+
+Usage:
+
+    python benchmarks/loopback.py [--size MB] [--piece-length KB]
+                                  [--seeders N] [--runs N] [--output file]
+
+The tracker, seeders and synthetic torrent are also used by the other
+benchmarks, some of which add seeders that spoil the pieces they serve or an
+HTTP server publishing the torrent's data as a web seed.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import bencode
+import hashlib
+import json
+import logging
+import resource
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+from bitfield import Bitfield
+from handshaketranslator import FAST_EXTENSION, HandshakeTranslator
+from handshaketranslator import make_reserved, supports
+from peerwiretranslator import PeerWireTranslator
+from protocoladapter import ProtocolAdapter
+from torrentmgr import TorrentMgr
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import Factory
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+from twisted.web.static import File
+
+_PEER_ID = "-HS0001-" + "B" * 12
+_SEEDER_ID = "-HS0001-" + "S" * 12
+_MB = 2**20
+
+
+def make_torrent(directory, size, piece_length, name='payload.bin',
+                 announce='http://127.0.0.1:0/announce'):
+    """
+    make_torrent() writes a file of size pseudo-random bytes named name in
+    directory and returns the metainfo dictionary for a single file torrent
+    containing it.  The contents are deterministic so that repeated runs
+    transfer the same data.
+    """
+    path = os.path.join(directory, name)
+
+    # Generate the contents 64 KB at a time by hashing a counter
+    with open(path, 'wb') as f:
+        counter = 0
+        remaining = size
+        while remaining > 0:
+            chunk = ''.join(hashlib.sha512(str(counter + i)).digest()
+                            for i in range(1024))[:remaining]
+            f.write(chunk)
+            remaining -= len(chunk)
+            counter += 1024
+
+    hashes = []
+    with open(path, 'rb') as f:
+        piece = f.read(piece_length)
+        while piece != '':
+            hashes.append(hashlib.sha1(piece).digest())
+            piece = f.read(piece_length)
+
+    return {'announce': announce,
+            'info': {'name': name,
+                     'length': size,
+                     'piece length': piece_length,
+                     'pieces': ''.join(hashes)}}
+
+
+def write_torrent(metainfo, filename):
+    with open(filename, 'wb') as f:
+        f.write(bencode.bencode(metainfo))
+
+
+def info_hash(metainfo):
+    return hashlib.sha1(bencode.bencode(metainfo['info'])).digest()
+
+
+class Tracker(Resource):
+    """
+    A stand-in HTTP tracker which responds to every announce with the same
+    compact list of peers.
+    """
+    isLeaf = True
+
+    def __init__(self, addrs):
+        Resource.__init__(self)
+        self._addrs = addrs
+        self.announces = 0
+
+    def render_GET(self, request):
+        self.announces += 1
+        peers = ''.join(struct.pack('>4BH', *(map(int, ip.split('.')) +
+                                              [port]))
+                        for ip, port in self._addrs)
+        return bencode.bencode({'interval': 1800,
+                                'complete': len(self._addrs),
+                                'incomplete': 0,
+                                'peers': peers})
+
+
+class SeederSession(object):
+    """
+    A SeederSession serves one connection from a downloading peer.  It answers
+    the handshake, sends a full bitfield (or a have all message when the peer
+    supports the Fast Extension), unchokes the peer as soon as it is
+    interested and serves every block which is requested.
+    """
+
+    def __init__(self, seeder):
+        self._seeder = seeder
+        self._translator = None
+
+    def connection_complete(self, protocol):
+        self._protocol = protocol
+        self._translator = HandshakeTranslator(self, protocol)
+
+    def connection_lost(self):
+        self._translator = None
+
+    def rx_handshake(self, reserved, info_hash, peer_id):
+        if info_hash != self._seeder.info_hash:
+            self._protocol.stop()
+            return
+
+        fast = supports(reserved, FAST_EXTENSION)
+        self._translator.tx_handshake(make_reserved(FAST_EXTENSION),
+                                      self._seeder.info_hash, _SEEDER_ID)
+        self._translator.unset_receiver()
+        self._translator.unset_readerwriter()
+        self._translator = PeerWireTranslator(self, self._protocol)
+        if fast:
+            self._translator.tx_have_all()
+        else:
+            self._translator.tx_bitfield(self._seeder.bitfield)
+
+    def rx_non_handshake(self):
+        self._protocol.stop()
+
+    def rx_interested(self):
+        self._translator.tx_unchoke()
+
+    def rx_request(self, index, begin, length):
+        self._translator.tx_piece(index, begin,
+                                  self._seeder.read(index, begin, length))
+
+    def __getattr__(self, name):
+        # Ignore every other peer wire message
+        if name.startswith('rx_'):
+            return lambda *args: None
+        raise AttributeError(name)
+
+
+class Seeder(Factory):
+    """
+    A Seeder serves the torrent's data to each peer which connects.  A
+    corrupt Seeder spoils every block of the pieces with even indices by
+    inverting its first byte.
+    """
+
+    def __init__(self, metainfo, path, corrupt=False):
+        self.info_hash = info_hash(metainfo)
+        self._piece_length = metainfo['info']['piece length']
+        self._file = open(path, 'rb')
+        self._corrupt = corrupt
+
+        num_pieces = len(metainfo['info']['pieces']) // 20
+        self.bitfield = Bitfield(num_pieces, fill=True)
+
+    def read(self, index, begin, length):
+        self._file.seek(index * self._piece_length + begin)
+        data = self._file.read(length)
+        if self._corrupt and index % 2 == 0:
+            data = chr(ord(data[0]) ^ 0xff) + data[1:]
+        return data
+
+    def buildProtocol(self, addr):
+        return ProtocolAdapter(SeederSession(self))
+
+
+def serve(directory, size, piece_length, seeders, name='payload.bin',
+          corrupt=0, web_seed=False):
+    """
+    serve() creates the synthetic torrent named name in directory, starts a
+    tracker, the specified number of seeders and the specified number of
+    corrupt seeders on localhost and runs the reactor.  With web_seed, it
+    also serves directory over HTTP and lists it in the torrent's url-list.
+    It writes a json object containing the name of the torrent file to stdout
+    once everything is listening and stops when its parent process exits.
+    """
+    metainfo = make_torrent(directory, size, piece_length, name)
+    path = os.path.join(directory, metainfo['info']['name'])
+
+    addrs = []
+    for n in range(seeders + corrupt):
+        seeder = Seeder(metainfo, path, corrupt=n >= seeders)
+        port = reactor.listenTCP(0, seeder,
+                                 interface='127.0.0.1').getHost().port
+        addrs.append(('127.0.0.1', port))
+    tracker_port = reactor.listenTCP(0, Site(Tracker(addrs)),
+                                     interface='127.0.0.1').getHost().port
+
+    metainfo['announce'] = "http://127.0.0.1:{}/announce".format(tracker_port)
+    if web_seed:
+        web_port = reactor.listenTCP(0, Site(File(directory)),
+                                     interface='127.0.0.1').getHost().port
+        metainfo['url-list'] = ["http://127.0.0.1:{}/".format(web_port)]
+    torrent = os.path.join(directory, 'payload.torrent')
+    write_torrent(metainfo, torrent)
+
+    parent = os.getppid()
+
+    def check_parent():
+        if os.getppid() != parent:
+            reactor.stop()
+    task.LoopingCall(check_parent).start(1)
+
+    sys.stdout.write(json.dumps({'torrent': torrent}) + "\n")
+    sys.stdout.flush()
+    reactor.run()
+
+
+def start_swarm(size, piece_length, seeders, name='payload.bin',
+                corrupt=0, web_seed=False):
+    """
+    start_swarm() starts the tracker, seeders and corrupt seeders, along with
+    a web seed if web_seed is true, in a child process serving a synthetic
+    torrent named name of size MB with pieces of piece_length KB.  It returns
+    the child process, the directory holding the seeded data and the name of
+    the torrent file.
+    """
+    directory = tempfile.mkdtemp(prefix='bt-seed-')
+    command = [sys.executable, os.path.abspath(__file__),
+               '--serve', directory,
+               '--size', str(size),
+               '--piece-length', str(piece_length),
+               '--seeders', str(seeders),
+               '--corrupt', str(corrupt),
+               '--name', name]
+    if web_seed:
+        command.append('--web-seed')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    line = process.stdout.readline()
+    if line == '':
+        raise RuntimeError("Seeders failed to start")
+    return process, directory, str(json.loads(line)['torrent'])
+
+
+class _Quiet(object):
+    # Discards the progress which TorrentMgr prints so that it doesn't mix
+    # with the results
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def download(torrent, size, timeout, torrent_class=TorrentMgr):
+    """
+    download() runs a TorrentMgr for the specified torrent file, whose
+    contents are size bytes long, in the current directory until it completes
+    or the timeout expires and returns a dictionary of measurements.  The
+    reactor is run and stopped, so download() can be called only once per
+    process.
+    """
+    result = {'completed': False}
+    times = {}
+
+    torrent_mgr = torrent_class(torrent, 6881, _PEER_ID, reactor)
+
+    start_wall = time.time()
+    start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+
+    def check_progress():
+        percent = torrent_mgr.percent()
+        if percent > 0 and 'first' not in times:
+            times['first'] = time.time()
+        if percent >= 100:
+            times['last'] = time.time()
+            result['completed'] = True
+            reactor.stop()
+
+    def started(_):
+        torrent_mgr.start()
+        task.LoopingCall(check_progress).start(0.001)
+
+    def failed(failure):
+        result['error'] = failure.getErrorMessage()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: torrent_mgr.initialize().addCallbacks(started, failed))
+    reactor.callLater(timeout, reactor.stop)
+
+    stdout, sys.stdout = sys.stdout, _Quiet()
+    try:
+        reactor.run()
+    finally:
+        sys.stdout = stdout
+
+    end_wall = time.time()
+    end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+
+    elapsed = end_wall - start_wall
+    cpu = ((end_cpu.ru_utime - start_cpu.ru_utime) +
+           (end_cpu.ru_stime - start_cpu.ru_stime))
+    if not result['completed']:
+        size = 0
+
+    result.update({'seconds': elapsed,
+                   'mb_per_second': size / float(_MB) / elapsed,
+                   'cpu_seconds': cpu,
+                   'cpu_seconds_per_mb': (cpu / (size / float(_MB))
+                                          if size else None),
+                   'peak_rss_kb': end_cpu.ru_maxrss,
+                   'first_piece_seconds': (times['first'] - start_wall
+                                           if 'first' in times else None),
+                   'last_piece_seconds': (times['last'] - start_wall
+                                          if 'last' in times else None)})
+    return result
+
+
+def git_commit():
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=directory,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    process, seed_directory, torrent = start_swarm(args.size,
+                                                   args.piece_length,
+                                                   args.seeders)
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        result = download(torrent, args.size * _MB, args.timeout)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(seed_directory, ignore_errors=True)
+
+    result.update({'benchmark': 'loopback',
+                   'commit': git_commit(),
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'seeders': args.seeders})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback download "
+                                                 "benchmark")
+    parser.add_argument('--size', type=int, default=64,
+                        help="size of the torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help="piece length in KB")
+    parser.add_argument('--seeders', type=int, default=4,
+                        help="number of seeders")
+    parser.add_argument('--runs', type=int, default=1,
+                        help="number of times to run the benchmark")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the download to complete")
+    parser.add_argument('--output', help="file to append results to")
+    parser.add_argument('--serve', metavar='directory', help=argparse.SUPPRESS)
+    parser.add_argument('--name', default='payload.bin',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--corrupt', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--web-seed', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--run-once', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.serve is not None:
+        serve(args.serve, args.size * _MB, args.piece_length * 1024,
+              args.seeders, args.name, args.corrupt, args.web_seed)
+        return
+
+    if args.run_once:
+        print json.dumps(run(args))
+        return
+
+    # The reactor can't be restarted, so each run is made in a new process
+    for _ in range(args.runs):
+        command = [sys.executable, os.path.abspath(__file__), '--run-once',
+                   '--size', str(args.size),
+                   '--piece-length', str(args.piece_length),
+                   '--seeders', str(args.seeders),
+                   '--timeout', str(args.timeout)]
+        line = subprocess.check_output(command).strip().splitlines()[-1]
+        print line
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
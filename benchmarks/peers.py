@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+The peers benchmark measures the memory which a TorrentMgr holds for each of
+a large number of peers and how long it takes to add and remove them.  It
+starts a local tracker from the loopback benchmark, initializes a TorrentMgr
+for a synthetic torrent and hands it stand-ins for connected peers, each of
+which announces a bitfield with the given fraction of the pieces and keeps
+the TorrentMgr choked so that no data is transferred.  Once every peer has
+been added, they are all disconnected.
+
+The stand-ins are created before the resident set size is first sampled, so
+the memory reported per peer is what the TorrentMgr keeps for a peer, its
+record, bitfield and reserved piece, rather than the cost of the connection.
+The results are printed as a json object on stdout.
+
+Usage:
+
+    python benchmarks/peers.py [--peers N] [--size MB] [--piece-length KB]
+                               [--density fraction] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import gc
+import json
+import logging
+import resource
+import shutil
+import tempfile
+import time
+
+from bitfield import Bitfield
+from bitfields import random_bytes
+from loopback import start_swarm, git_commit
+from torrentmgr import TorrentMgr
+
+from twisted.internet import reactor
+
+_PEER_ID = "-HS0001-" + "P" * 12
+
+# The number of distinct bitfields handed out to the stand-ins
+_BITFIELDS = 16
+
+
+class _StandIn(object):
+    # Stands in for a PeerProxy whose peer has connected and is choking the
+    # TorrentMgr
+    def __init__(self, n):
+        self._addr = ('127.0.0.{}'.format(n // 65536 % 256 + 1),
+                      n % 65536)
+        self._interested = False
+
+    def addr(self):
+        return self._addr
+
+    def is_snubbed(self):
+        return False
+
+    def is_peer_choked(self):
+        return True
+
+    def is_allowed_fast(self, index):
+        return False
+
+    def supports_fast(self):
+        return False
+
+    def is_interested(self):
+        return self._interested
+
+    def interested(self):
+        self._interested = True
+
+    def not_interested(self):
+        self._interested = False
+
+    def download_rate(self):
+        return 0.0
+
+    def upload_rate(self):
+        return 0.0
+
+
+def rss_kb():
+    """
+    rss_kb() returns the current resident set size in KB, or the peak on
+    platforms without /proc.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(torrent, num_peers, density, timeout):
+    """
+    measure() adds num_peers stand-in peers to a TorrentMgr for the
+    specified torrent in the current directory and removes them again.  It
+    returns a dictionary of measurements.  The reactor is run and stopped,
+    so measure() can be called only once per process.
+    """
+    result = {}
+    torrent_mgr = TorrentMgr(torrent, 6881, _PEER_ID, reactor)
+
+    def run(_):
+        num_pieces = len(torrent_mgr.get_bitfield())
+        datas = [random_bytes(num_pieces, density) for _ in range(_BITFIELDS)]
+        peers = [_StandIn(n) for n in range(num_peers)]
+
+        gc.collect()
+        before = rss_kb()
+        start = time.time()
+        for n, peer in enumerate(peers):
+            torrent_mgr._add_peer(peer)
+            data = bytearray(datas[n % _BITFIELDS])
+            torrent_mgr.peer_bitfield(peer, Bitfield.from_bytes(data))
+        added = time.time()
+        gc.collect()
+        after = rss_kb()
+
+        for peer in peers:
+            torrent_mgr.peer_unconnected(peer)
+        removed = time.time()
+
+        result.update({'pieces': num_pieces,
+                       'add_seconds': added - start,
+                       'remove_seconds': removed - added,
+                       'rss_kb': after,
+                       'bytes_per_peer': (after - before) * 1024 / num_peers})
+        reactor.stop()
+
+    def failed(failure):
+        result['error'] = failure.getErrorMessage()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: torrent_mgr.initialize().addCallbacks(run, failed))
+    reactor.callLater(timeout, reactor.stop)
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        reactor.run()
+    finally:
+        sys.stdout = stdout
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per peer memory "
+                                                 "benchmark")
+    parser.add_argument('--peers', type=int, default=5000,
+                        help="number of peers")
+    parser.add_argument('--size', type=int, default=64,
+                        help="size of the torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=16,
+                        help="piece length in KB")
+    parser.add_argument('--density', type=float, default=0.5,
+                        help="fraction of the pieces each peer has")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the measurement")
+    parser.add_argument('--output', help="file to append results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    process, seed_directory, torrent = start_swarm(args.size,
+                                                   args.piece_length, 0)
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        result = measure(torrent, args.peers, args.density, args.timeout)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(seed_directory, ignore_errors=True)
+
+    result.update({'benchmark': 'peers',
+                   'commit': git_commit(),
+                   'peers': args.peers,
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'density': args.density})
+    line = json.dumps(result)
+    print line
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
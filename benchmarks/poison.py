@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""
+The poison benchmark measures what a peer which sends bad data costs a
+download.  It starts a local swarm from the loopback benchmark in which some
+of the seeders spoil half of the pieces they serve and downloads the torrent
+with a TorrentMgr until every piece has been written to disk.
+
+It reports the throughput, the numbers of pieces which failed the hash check,
+the bytes which had to be downloaded again and the number of peers banned for
+sending bad data, and checks that the downloaded file matches the seeded one.
+The results are printed as a json object on stdout.
+
+Usage:
+
+    python benchmarks/poison.py [--size MB] [--piece-length KB]
+                                [--seeders N] [--corrupt N] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import filecmp
+import json
+import logging
+import metrics
+import shutil
+import tempfile
+import time
+
+from loopback import git_commit, start_swarm
+from torrentmgr import TorrentMgr
+
+from twisted.internet import reactor, task
+
+_PEER_ID = "-HS0001-" + "X" * 12
+_MB = 2**20
+
+_COUNTERS = {'pieces_failed': 'bt_pieces_failed_total',
+             'bytes_refetched': 'bt_bytes_refetched_total',
+             'peers_banned': 'bt_peers_banned_total'}
+
+
+def download(torrent, size, timeout):
+    """
+    download() runs a TorrentMgr for the specified torrent file, whose
+    contents are size bytes long, in the current directory until every piece
+    has been written or the timeout expires and returns a dictionary of
+    measurements.  The reactor is run and stopped, so download() can be
+    called only once per process.
+    """
+    result = {'completed': False}
+    torrent_mgr = TorrentMgr(torrent, 6881, _PEER_ID, reactor)
+    start = time.time()
+
+    def check_progress():
+        have = torrent_mgr.get_bitfield()
+        if have.count() == len(have):
+            result['completed'] = True
+            reactor.stop()
+
+    def started(_):
+        torrent_mgr.start()
+        task.LoopingCall(check_progress).start(0.01)
+
+    def failed(failure):
+        result['error'] = failure.getErrorMessage()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: torrent_mgr.initialize().addCallbacks(started, failed))
+    reactor.callLater(timeout, reactor.stop)
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        reactor.run()
+    finally:
+        sys.stdout = stdout
+
+    elapsed = time.time() - start
+    result.update({'seconds': elapsed,
+                   'mb_per_second': (size / float(_MB) / elapsed
+                                     if result['completed'] else 0)})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bad data benchmark")
+    parser.add_argument('--size', type=int, default=32,
+                        help="size of the torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=64,
+                        help="piece length in KB")
+    parser.add_argument('--seeders', type=int, default=3,
+                        help="number of seeders which send good data")
+    parser.add_argument('--corrupt', type=int, default=1,
+                        help="number of seeders which send bad data")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the download to complete")
+    parser.add_argument('--output', help="file to append results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    process, seed_directory, torrent = start_swarm(args.size,
+                                                   args.piece_length,
+                                                   args.seeders,
+                                                   corrupt=args.corrupt)
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        result = download(torrent, args.size * _MB, args.timeout)
+        result['intact'] = filecmp.cmp(
+            os.path.join(directory, 'payload.bin'),
+            os.path.join(seed_directory, 'payload.bin'), shallow=False)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(seed_directory, ignore_errors=True)
+
+    for key, name in _COUNTERS.iteritems():
+        result[key] = metrics.registry.get(name).value
+    result.update({'benchmark': 'poison',
+                   'commit': git_commit(),
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'seeders': args.seeders,
+                   'corrupt': args.corrupt})
+    line = json.dumps(result)
+    print line
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
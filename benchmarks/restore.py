@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""
+The restore benchmark measures how long the client takes to get its torrents
+back after a restart.  It writes a number of synthetic torrent files and a
+session store (see session.py) which holds each of them along with resume
+data in which about half of the pieces are on disk, and times:
+
+    parse      parsing every torrent file with Metainfo, the least the client
+               would have to do for each torrent without a session store
+               before contacting its tracker
+    restore    opening the session store, reading its rows and adding a
+               StoredTorrent for each to a TorrentQueue, as the client does
+               on startup
+    save       saving the resume data of every torrent and the order of the
+               queue in one transaction, the most a periodic save of the
+               session writes
+
+The StoredTorrents which the queue starts are never loaded, so the restore
+time doesn't include contacting trackers.  The results are printed as json
+objects on stdout, one per line.
+
+Usage:
+
+    python benchmarks/restore.py [--torrents N] [--size MB]
+                                 [--piece-length KB] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+import time
+
+from bitfields import random_bytes
+from loopback import git_commit, info_hash, write_torrent
+from metainfo import Metainfo
+from session import SessionStore, StoredTorrent
+from torrentqueue import TorrentQueue
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+# The number of peer addresses in each torrent's resume data
+_PEERS = 50
+
+
+def make_session(directory, num_torrents, size, piece_length):
+    """
+    make_session() writes num_torrents torrent files of size bytes each to
+    directory along with a session store holding them and returns the list
+    of the filenames and the path of the store.
+    """
+    num_pieces = -(-size // piece_length)
+    filenames = []
+    resumes = {}
+    path = os.path.join(directory, 'session.db')
+    store = SessionStore(path)
+    for n in range(num_torrents):
+        name = 'payload{}.bin'.format(n)
+        pieces = ''.join(hashlib.sha1('{}/{}'.format(n, i)).digest()
+                         for i in range(num_pieces))
+        metainfo = {'announce': 'http://127.0.0.1:0/announce',
+                    'info': {'name': name,
+                             'length': size,
+                             'piece length': piece_length,
+                             'pieces': pieces}}
+        filename = os.path.join(directory, name + '.torrent')
+        write_torrent(metainfo, filename)
+        filenames.append(filename)
+
+        key = info_hash(metainfo).encode('hex')
+        store.add(key, filename, name, directory)
+        store.save_files(key, [[[name], size]])
+        resumes[key] = {'have': random_bytes(num_pieces, 0.5),
+                        'priorities': '2',
+                        'peers': [['127.0.0.1', 6881 + i]
+                                  for i in range(_PEERS)],
+                        'wanted': num_pieces,
+                        'needed': num_pieces // 2}
+
+    start = time.time()
+    store.save(resumes, list(resumes))
+    save_seconds = time.time() - start
+    store.close()
+    return filenames, path, save_seconds
+
+
+def parse(filenames):
+    start = time.time()
+    for filename in filenames:
+        Metainfo(filename)
+    return time.time() - start
+
+
+def restore(path):
+    start = time.time()
+    store = SessionStore(path)
+    queue = TorrentQueue(reactor)
+    queue.extend([(entry['key'], StoredTorrent(store, entry, Deferred))
+                  for entry in store.torrents()])
+    seconds = time.time() - start
+    store.close()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Session restore "
+                                                 "benchmark")
+    parser.add_argument('--torrents', type=int, default=2000,
+                        help="number of torrents")
+    parser.add_argument('--size', type=int, default=256,
+                        help="size of each torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help="piece length in KB")
+    parser.add_argument('--output', help="file to append results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    try:
+        filenames, path, save_seconds = make_session(
+            directory, args.torrents, args.size * 2**20,
+            args.piece_length * 1024)
+        seconds = {'parse': parse(filenames),
+                   'restore': restore(path),
+                   'save': save_seconds}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    commit = git_commit()
+    for operation in ('parse', 'restore', 'save'):
+        line = json.dumps({'benchmark': 'restore',
+                           'commit': commit,
+                           'operation': operation,
+                           'torrents': args.torrents,
+                           'size_mb': args.size,
+                           'piece_length_kb': args.piece_length,
+                           'seconds': seconds[operation],
+                           'torrents_per_second': (args.torrents /
+                                                   seconds[operation])})
+        print line
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
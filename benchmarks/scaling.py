@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+The scaling benchmark measures the aggregate download throughput of a number
+of torrents spread across worker processes (see workerpool.py) as the number
+of workers grows.  Each torrent has its own local swarm of seeders and tracker
+from the loopback benchmark, running in a separate process, and all the
+torrents are downloaded at the same time.
+
+For each number of workers, the benchmark starts a WorkerPool in a new
+process, adds every torrent to it and waits until every torrent has been
+downloaded.  It reports the aggregate throughput in MB/s and the time taken
+as a json object on stdout.  The throughput can only grow with the number of
+workers while there are idle CPU cores for the workers and the swarms to use,
+so the number of cores is reported as well.
+
+Usage:
+
+    python benchmarks/scaling.py [--torrents N] [--size MB]
+                                 [--piece-length KB] [--seeders N]
+                                 [--workers N ...] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import json
+import logging
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+import time
+
+from loopback import start_swarm, git_commit
+from workerpool import WorkerPool
+
+from twisted.internet import reactor, task
+
+_PEER_ID = "-HS0001-" + "W" * 12
+_MB = 2**20
+
+# The workers push status updates this often, which bounds the precision with
+# which the end of the download is measured
+_STATUS_INTERVAL = 0.1
+
+
+def download(torrents, size, workers, timeout):
+    """
+    download() runs a WorkerPool of the specified number of workers in the
+    current directory until each of the torrent files, whose contents are
+    size bytes long, has been downloaded or the timeout expires and returns a
+    dictionary of measurements.  The reactor is run and stopped, so
+    download() can be called only once per process.
+    """
+    result = {'completed': 0, 'failed': 0}
+    remote = []
+    pool = WorkerPool(reactor, workers, _STATUS_INTERVAL)
+    times = {}
+
+    def check_progress():
+        done = len([t for t in remote if t.percent() >= 100])
+        result['completed'] = done
+        if done + result['failed'] == len(torrents):
+            times['end'] = time.time()
+            stop()
+
+    def stop():
+        if reactor.running:
+            pool.stop()
+            reactor.stop()
+
+    def added(torrent):
+        # The pool's workers leave starting torrents to the client's queue
+        remote.append(torrent)
+        torrent.start()
+
+    def failed(failure):
+        result['failed'] += 1
+        result.setdefault('errors', []).append(failure.getErrorMessage())
+
+    def started(_):
+        times['start'] = time.time()
+        for torrent in torrents:
+            pool.add_torrent(torrent, 6881, _PEER_ID).addCallbacks(added,
+                                                                    failed)
+        task.LoopingCall(check_progress).start(_STATUS_INTERVAL / 2)
+
+    reactor.callWhenRunning(lambda: pool.start().addCallback(started))
+    reactor.callLater(timeout, stop)
+    reactor.run()
+
+    end = times.get('end', time.time())
+    elapsed = end - times.get('start', end)
+    total = result['completed'] * size
+    result.update({'seconds': elapsed,
+                   'mb_per_second': (total / float(_MB) / elapsed
+                                     if elapsed else 0)})
+    return result
+
+
+def run(args, workers):
+    swarms = []
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    try:
+        for i in range(args.torrents):
+            swarms.append(start_swarm(args.size, args.piece_length,
+                                      args.seeders,
+                                      'payload-{}.bin'.format(i)))
+        os.chdir(directory)
+        result = download([torrent for _, _, torrent in swarms],
+                          args.size * _MB, workers, args.timeout)
+    finally:
+        os.chdir(cwd)
+        for process, seed_directory, _ in swarms:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(seed_directory, ignore_errors=True)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    result.update({'benchmark': 'scaling',
+                   'commit': git_commit(),
+                   'workers': workers,
+                   'cpus': multiprocessing.cpu_count(),
+                   'torrents': args.torrents,
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'seeders': args.seeders})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worker scaling benchmark")
+    parser.add_argument('--torrents', type=int, default=8,
+                        help="number of torrents downloaded at once")
+    parser.add_argument('--size', type=int, default=32,
+                        help="size of each torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help="piece length in KB")
+    parser.add_argument('--seeders', type=int, default=2,
+                        help="number of seeders for each torrent")
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help="numbers of workers to measure")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the downloads to complete")
+    parser.add_argument('--output', help="file to append results to")
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the output of the workers")
+    parser.add_argument('--run-once', type=int, metavar='workers',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.run_once is not None:
+        # The workers' progress messages are passed on to stderr
+        if not args.verbose:
+            sys.stderr = open(os.devnull, 'w')
+        print json.dumps(run(args, args.run_once))
+        return
+
+    # The reactor can't be restarted, so each run is made in a new process
+    for workers in args.workers:
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--run-once', str(workers),
+                   '--torrents', str(args.torrents),
+                   '--size', str(args.size),
+                   '--piece-length', str(args.piece_length),
+                   '--seeders', str(args.seeders),
+                   '--timeout', str(args.timeout)]
+        if args.verbose:
+            command.append('--verbose')
+        line = subprocess.check_output(command).strip().splitlines()[-1]
+        print line
+        sys.stdout.flush()
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
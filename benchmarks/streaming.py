@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+"""
+The streaming benchmark measures how soon the first byte of a range of a
+torrent's file is served over HTTP while the torrent is still downloading.
+It starts a local swarm from the loopback benchmark, runs a TorrentMgr behind
+the HTTPControlServer's /file route and, as soon as the torrent has started,
+requests a range of the file starting at the given fraction of its length.
+
+The range is requested once with streaming on, so that the pieces just ahead
+of the read are downloaded first, and once with streaming off, so that the
+read waits for the rarest first strategy to reach its pieces.  For each, the
+benchmark reports the time to the first byte and the time to the last byte
+of the range as a json object on stdout.
+
+Usage:
+
+    python benchmarks/streaming.py [--size MB] [--piece-length KB]
+                                   [--seeders N] [--offset fraction]
+                                   [--length KB] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import json
+import logging
+import shutil
+import subprocess
+import tempfile
+import time
+
+from httpcontrolserver import HTTPControlServer
+from loopback import start_swarm, git_commit
+from torrentmgr import TorrentMgr
+
+from twisted.internet import reactor
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+_PEER_ID = "-HS0001-" + "T" * 12
+_KEY = 'benchmark'
+
+
+class _Client(object):
+    # Stands in for the BitTorrentClient, serving the one torrent to the
+    # HTTPControlServer under _KEY
+    def __init__(self, torrent):
+        self._torrent = torrent
+
+    def get_files(self, key):
+        return self._torrent.files()
+
+    def set_streaming(self, key, enable, file_index=None):
+        self._torrent.set_streaming(enable, file_index)
+
+    def read_file(self, key, file_index, offset, length):
+        return self._torrent.read(file_index, offset, length)
+
+
+class _Body(Protocol):
+    # Records when the first and last bytes of the response arrive
+    def __init__(self, times, result):
+        self._times = times
+        self._result = result
+
+    def dataReceived(self, data):
+        if 'first' not in self._times:
+            self._times['first'] = time.time()
+        self._result['bytes'] += len(data)
+
+    def connectionLost(self, reason):
+        self._times['last'] = time.time()
+        reactor.stop()
+
+
+def fetch(torrent, offset, length, stream, timeout):
+    """
+    fetch() downloads the torrent in the current directory and, as soon as
+    it has started, requests length bytes of its file starting at offset over
+    HTTP with streaming on or off.  It returns a dictionary of measurements.
+    The reactor is run and stopped, so fetch() can be called only once per
+    process.
+    """
+    result = {'bytes': 0}
+    times = {}
+
+    torrent_mgr = TorrentMgr(torrent, 6881, _PEER_ID, reactor)
+    site = Site(HTTPControlServer(_Client(torrent_mgr)).app.resource())
+    port = reactor.listenTCP(0, site, interface='127.0.0.1').getHost().port
+
+    def request(_):
+        torrent_mgr.start()
+        times['start'] = time.time()
+        url = ("http://127.0.0.1:{}/file?key={}&index=0&stream={}"
+               .format(port, _KEY, 1 if stream else 0))
+        headers = Headers({'Range': ["bytes={}-{}".format(
+            offset, offset + length - 1)]})
+        d = Agent(reactor).request('GET', url, headers)
+        d.addCallback(lambda response: response.deliverBody(
+            _Body(times, result)))
+        d.addErrback(failed)
+
+    def failed(failure):
+        result['error'] = failure.getErrorMessage()
+        reactor.stop()
+
+    reactor.callWhenRunning(
+        lambda: torrent_mgr.initialize().addCallbacks(request, failed))
+    reactor.callLater(timeout, reactor.stop)
+
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        reactor.run()
+    finally:
+        sys.stdout = stdout
+
+    start = times.get('start')
+    result.update({'first_byte_seconds': (times['first'] - start
+                                          if 'first' in times else None),
+                   'last_byte_seconds': (times['last'] - start
+                                         if 'last' in times else None),
+                   'percent_downloaded': torrent_mgr.percent()})
+    return result
+
+
+def run(args, stream):
+    process, seed_directory, torrent = start_swarm(args.size,
+                                                   args.piece_length,
+                                                   args.seeders)
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        offset = int(args.size * 2**20 * args.offset)
+        length = min(args.length * 1024, args.size * 2**20 - offset)
+        result = fetch(torrent, offset, length, stream, args.timeout)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(seed_directory, ignore_errors=True)
+
+    result.update({'benchmark': 'streaming',
+                   'commit': git_commit(),
+                   'stream': stream,
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'seeders': args.seeders,
+                   'offset': args.offset,
+                   'length_kb': args.length})
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming time to first "
+                                                 "byte benchmark")
+    parser.add_argument('--size', type=int, default=64,
+                        help="size of the torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help="piece length in KB")
+    parser.add_argument('--seeders', type=int, default=4,
+                        help="number of seeders")
+    parser.add_argument('--offset', type=float, default=0.5,
+                        help="where the range starts as a fraction of the "
+                             "file's length")
+    parser.add_argument('--length', type=int, default=1024,
+                        help="length of the range in KB")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the range to be served")
+    parser.add_argument('--output', help="file to append results to")
+    parser.add_argument('--run-once', choices=['stream', 'rarest'],
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.run_once is not None:
+        print json.dumps(run(args, args.run_once == 'stream'))
+        return
+
+    # The reactor can't be restarted, so each run is made in a new process
+    for mode in ('stream', 'rarest'):
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--run-once', mode,
+                   '--size', str(args.size),
+                   '--piece-length', str(args.piece_length),
+                   '--seeders', str(args.seeders),
+                   '--offset', str(args.offset),
+                   '--length', str(args.length),
+                   '--timeout', str(args.timeout)]
+        line = subprocess.check_output(command).strip().splitlines()[-1]
+        print line
+        sys.stdout.flush()
+        if args.output is not None:
+            with open(args.output, 'a') as f:
+                f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""
+The webseed benchmark measures how much a web seed (BEP 19) contributes to a
+download.  It starts a local swarm from the loopback benchmark whose torrent
+lists an HTTP server on localhost, which serves the seeded file and honours
+Range requests, as a web seed and downloads the torrent with a TorrentMgr
+until every piece has been written to disk.
+
+With no seeders, or a single one, every piece is rare and the web seed is
+given pieces from the start.  With more seeders, it is only given pieces in
+the endgame.  The memory budget can be made small with --memory to see the
+web seed held back along with the peers.
+
+It reports the throughput, the bytes received from the web seed, the number
+of requests to it which failed and the number of times reading was paused by
+the memory budget, and checks that the downloaded file matches the seeded
+one.  The results are printed as a json object on stdout.
+
+Usage:
+
+    python benchmarks/webseed.py [--size MB] [--piece-length KB]
+                                 [--seeders N] [--memory MB] [--output file]
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import argparse
+import filecmp
+import json
+import logging
+import membudget
+import metrics
+import shutil
+import tempfile
+
+from loopback import git_commit, start_swarm
+from poison import download
+
+_MB = 2**20
+
+_COUNTERS = {'web_seed_bytes': 'bt_web_seed_bytes_total',
+             'web_seed_failures': 'bt_web_seed_failures_total',
+             'memory_pauses': 'bt_memory_pauses_total'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Web seed benchmark")
+    parser.add_argument('--size', type=int, default=32,
+                        help="size of the torrent in MB")
+    parser.add_argument('--piece-length', type=int, default=256,
+                        help="piece length in KB")
+    parser.add_argument('--seeders', type=int, default=1,
+                        help="number of seeders besides the web seed")
+    parser.add_argument('--memory', type=int,
+                        help="memory budget in MB")
+    parser.add_argument('--timeout', type=float, default=600,
+                        help="seconds to wait for the download to complete")
+    parser.add_argument('--output', help="file to append results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.memory is not None:
+        membudget.set_limit(args.memory * _MB)
+
+    process, seed_directory, torrent = start_swarm(args.size,
+                                                   args.piece_length,
+                                                   args.seeders,
+                                                   web_seed=True)
+    directory = tempfile.mkdtemp(prefix='bt-bench-')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        result = download(torrent, args.size * _MB, args.timeout)
+        result['intact'] = filecmp.cmp(
+            os.path.join(directory, 'payload.bin'),
+            os.path.join(seed_directory, 'payload.bin'), shallow=False)
+    finally:
+        os.chdir(cwd)
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(seed_directory, ignore_errors=True)
+
+    for key, name in _COUNTERS.iteritems():
+        result[key] = metrics.registry.get(name).value
+    result.update({'benchmark': 'webseed',
+                   'commit': git_commit(),
+                   'size_mb': args.size,
+                   'piece_length_kb': args.piece_length,
+                   'seeders': args.seeders,
+                   'memory_mb': args.memory})
+    line = json.dumps(result)
+    print line
+    if args.output is not None:
+        with open(args.output, 'a') as f:
+            f.write(line + "\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+A Bitfield is a fixed length sequence of bits, one for each piece of a
+torrent, kept in a bytearray in the layout of the peer wire protocol's
+bitfield message: the high bit of the first byte is piece 0 and the spare
+bits at the end of the last byte are always clear.  Since the layout is the
+same, a Bitfield is made from a received message without converting it and
+tobytes() returns what is sent.
+
+The operations which the TorrentMgr performs on every bitfield message, have
+message and completed piece are done a byte or a whole bitfield at a time by
+code implemented in C rather than a bit at a time in Python:
+
+    count()          counts the set bits with a single big integer
+    ones(), zeros()  skip whole bytes of clear or set bits with a regular
+                     expression and look up the bits of the remaining bytes
+                     in a table
+    &, |, and_not()  combine two bitfields as big integers
+    invert()         inverts every byte with bytearray.translate()
+    all(), any()     count whole bytes of set or clear bits
+
+Example:
+
+    have = Bitfield(num_pieces)
+    have[index] = 1
+    wanted = ~have
+    for index in wanted.and_not(reserved).ones():
+        ...
+"""
+
+import binascii
+import re
+
+# The offsets of the set bits in each byte value, highest bit first
+_ONES = [tuple(bit for bit in range(8) if value & (0x80 >> bit))
+         for value in range(256)]
+_ZEROS = [tuple(bit for bit in range(8) if not value & (0x80 >> bit))
+          for value in range(256)]
+
+_INVERT = bytearray(255 - value for value in range(256))
+
+_NOT_CLEAR = re.compile('[^\x00]')
+_NOT_SET = re.compile('[^\xff]')
+
+
+def _num_bytes(length):
+    return (length + 7) // 8
+
+
+class Bitfield(object):
+    __slots__ = ('_length', '_bytes')
+
+    def __init__(self, length, fill=False):
+        if length < 0:
+            raise ValueError("Bitfield length can't be negative")
+        self._length = length
+        self._bytes = bytearray(('\xff' if fill else '\x00') *
+                                _num_bytes(length))
+        if fill:
+            self._clear_spare()
+
+    @classmethod
+    def from_bytes(cls, data, length=None):
+        """
+        from_bytes() returns a Bitfield of the specified length, or of eight
+        bits for each byte, whose bits are the bytes of data.  A bytearray is
+        used as is rather than copied.  It raises a ValueError if data is not
+        the right size for the length or has any of its spare bits set.
+        """
+        if length is None:
+            length = 8 * len(data)
+        if len(data) != _num_bytes(length):
+            raise ValueError("Expected {} bytes for {} bits, got {}"
+                             .format(_num_bytes(length), length, len(data)))
+
+        bitfield = cls.__new__(cls)
+        bitfield._length = length
+        bitfield._bytes = (data if isinstance(data, bytearray)
+                           else bytearray(data))
+        spare = 8 * len(data) - length
+        if spare and bitfield._bytes[-1] & ((1 << spare) - 1):
+            raise ValueError("Spare bits of bitfield are set")
+        return bitfield
+
+    def _new(self, data):
+        bitfield = Bitfield.__new__(Bitfield)
+        bitfield._length = self._length
+        bitfield._bytes = data
+        return bitfield
+
+    def _clear_spare(self):
+        spare = 8 * len(self._bytes) - self._length
+        if spare:
+            self._bytes[-1] &= 0xff << spare & 0xff
+
+    def _int(self):
+        if not self._bytes:
+            return 0
+        return int(binascii.hexlify(self._bytes), 16)
+
+    def _from_int(self, value):
+        if not self._bytes:
+            return self._new(bytearray())
+        return self._new(bytearray(binascii.unhexlify(
+            '{:0{}x}'.format(value, 2 * len(self._bytes)))))
+
+    def _check_length(self, other):
+        if self._length != other._length:
+            raise ValueError("Bitfields have different lengths: {} and {}"
+                             .format(self._length, other._length))
+
+    def tobytes(self):
+        return str(self._bytes)
+
+    def copy(self):
+        return self._new(bytearray(self._bytes))
+
+    def trim(self, length):
+        """
+        trim() returns a Bitfield of the first length bits, sharing this
+        bitfield's bytes when no whole bytes are dropped.  It raises a
+        ValueError if the bitfield is shorter than length or has any bits
+        set beyond it, as a received bitfield message must not.
+        """
+        if length > self._length:
+            raise ValueError("Bitfield of {} bits is shorter than {}"
+                             .format(self._length, length))
+        if self.any(length):
+            raise ValueError("Bitfield has bits set beyond {}".format(length))
+        bitfield = Bitfield.__new__(Bitfield)
+        bitfield._length = length
+        if len(self._bytes) == _num_bytes(length):
+            bitfield._bytes = self._bytes
+        else:
+            bitfield._bytes = self._bytes[:_num_bytes(length)]
+        return bitfield
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError("Bit index out of range: {}".format(index))
+        return bool(self._bytes[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self._length:
+            raise IndexError("Bit index out of range: {}".format(index))
+        if value:
+            self._bytes[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self._bytes[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __eq__(self, other):
+        return (isinstance(other, Bitfield) and
+                self._length == other._length and
+                self._bytes == other._bytes)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Bitfield({}, {} set)".format(self._length, self.count())
+
+    def count(self):
+        """
+        count() returns the number of set bits.
+        """
+        return bin(self._int()).count('1')
+
+    def ones(self):
+        """
+        ones() returns a list of the indices of the set bits in ascending
+        order.
+        """
+        indices = []
+        extend = indices.extend
+        data = self._bytes
+        for match in _NOT_CLEAR.finditer(data):
+            i = match.start()
+            base = i << 3
+            extend([base + bit for bit in _ONES[data[i]]])
+        return indices
+
+    def zeros(self):
+        """
+        zeros() returns a list of the indices of the clear bits in ascending
+        order.
+        """
+        indices = []
+        extend = indices.extend
+        data = self._bytes
+        for match in _NOT_SET.finditer(data):
+            i = match.start()
+            base = i << 3
+            extend([base + bit for bit in _ZEROS[data[i]]])
+        while indices and indices[-1] >= self._length:
+            indices.pop()
+        return indices
+
+    def all(self, start=0, stop=None):
+        """
+        all() returns whether every bit from start up to but not including
+        stop, or the end, is set.
+        """
+        if stop is None:
+            stop = self._length
+        first = (start + 7) >> 3
+        last = stop >> 3
+        if first >= last:
+            return all(self[index] for index in xrange(start, stop))
+        return (self._bytes.count('\xff', first, last) == last - first and
+                all(self[index] for index in xrange(start, first << 3)) and
+                all(self[index] for index in xrange(last << 3, stop)))
+
+    def any(self, start=0, stop=None):
+        """
+        any() returns whether any bit from start up to but not including
+        stop, or the end, is set.
+        """
+        if stop is None:
+            stop = self._length
+        first = (start + 7) >> 3
+        last = stop >> 3
+        if first >= last:
+            return any(self[index] for index in xrange(start, stop))
+        return (self._bytes.count('\x00', first, last) != last - first or
+                any(self[index] for index in xrange(start, first << 3)) or
+                any(self[index] for index in xrange(last << 3, stop)))
+
+    def invert(self):
+        """
+        invert() inverts every bit in place.
+        """
+        self._bytes = self._bytes.translate(_INVERT)
+        self._clear_spare()
+
+    def __invert__(self):
+        bitfield = self.copy()
+        bitfield.invert()
+        return bitfield
+
+    def __and__(self, other):
+        self._check_length(other)
+        return self._from_int(self._int() & other._int())
+
+    def __or__(self, other):
+        self._check_length(other)
+        return self._from_int(self._int() | other._int())
+
+    def and_not(self, other):
+        """
+        and_not() returns a Bitfield of the bits which are set in this
+        bitfield but not in other.
+        """
+        self._check_length(other)
+        return self._from_int(self._int() & ~other._int())
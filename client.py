@@ -9,18 +9,67 @@ Initially, the client chooses a peer_id, creates an Acceptor for incoming
 connections (not implemented) and creates a control channel.  It sets up
 delayed calls to start serving the torrents specified on the command line
 and then starts the reactor.
+
+By default, the torrents are handled by TorrentMgrs in the client's own
+process.  When the client is started with a number of workers, the torrents
+are spread across that many worker processes instead (see workerpool.py) and
+the client only runs the control channels.  The metrics, lag, trace records
+and profiles which the control channels report then combine those of the
+client and of every worker, so the methods which return them return
+Deferreds whether or not there are workers.
+
+Torrents are not started as soon as they have been added.  They join the
+client's queue (see torrentqueue.py), which starts only as many of them as
+its limits on active downloads, active seeds and connections allow, so a
+queued torrent holds no sockets or open files.  The queue can be shown,
+reordered and its limits changed over the control channels.
+
+The client's torrents are kept in a session store (see session.py) so that
+they are restored, in the same queue order and with the pieces they had
+downloaded, when the client is restarted.  A restored torrent isn't loaded
+from its torrent file until the queue starts it, so thousands of torrents are
+restored in about the time it takes to read their rows from the database.
+The resume data of the loaded torrents and the order of the queue are saved
+every _SAVE_INTERVAL seconds, when the queue is reordered and when the client
+quits.  The files of a torrent are saved in the directory the client was
+running in when it was added.
+
+Usage:
+
+    python client.py [-w workers] [-m MB] [-d downloads] [-s seeds]
+                     [-c connections] [--session FILE] [file ...]
+
+The -m option sets the limit of the memory budget for block data (see
+membudget.py), which is shared equally among the workers if there are any.
+The -d, -s and -c options set the limits of the queue.  The --session option
+names the session store, session.db by default.
 """
 
+import argparse
+import lagmonitor
 import logging
 import logging.config
+import membudget
+import metrics
+import os
+import profiler
 import sys
 import time
+import tracer
 
 from ampcontrolserver import AMPControlServerFactory
 from commands import MsgError
 from httpcontrolserver import HTTPControlServer
-from torrentmgr import TorrentMgr
+from metainfo import Metainfo
+from scheduler import get_scheduler
+from session import SessionStore, StoredTorrent
+from statuspublisher import StatusPublisher
+from torrentmgr import TorrentMgr, TorrentMgrError
+from torrentqueue import TorrentQueue
+from workerpool import WorkerPool
 
+from twisted.internet.defer import Deferred, DeferredList, DeferredSemaphore
+from twisted.internet.defer import maybeDeferred, succeed
 from twisted.internet.endpoints import TCP4ServerEndpoint
 from twisted.internet import reactor
 
@@ -29,17 +78,50 @@ logger = logging.getLogger('bt')
 
 _AMP_CONTROL_PORT = 1060
 
+# The number of torrents which may be initializing at the same time when
+# torrents are added in bulk
+_ADD_CONCURRENCY = 8
+
+_SESSION = 'session.db'
+
+# The number of seconds between saves of the session
+_SAVE_INTERVAL = 60
+
 
 class BitTorrentClient(object):
-    def __init__(self, reactor, filenames):
+    def __init__(self, reactor, filenames, workers=0, memory=None,
+                 queue_limits=None, session=_SESSION):
         self._reactor = reactor
+        self._scheduler = get_scheduler(reactor)
 
         self._peer_id = "-HS0001-"+str(int(time.time())).zfill(12)
         self._torrents = {}
+        self._queue = TorrentQueue(reactor, **(queue_limits or {}))
+        self._publisher = StatusPublisher(self.get_snapshot, reactor)
+
+        # Keys of torrents being added to workers, which are reserved so that
+        # the same torrent isn't given to two workers
+        self._adding = set()
+
+        # Start the worker processes, if any
+        self._pool = None
+        started = succeed(None)
+        if workers > 0:
+            self._pool = WorkerPool(reactor, workers, memory=memory)
+            started = self._pool.start()
+        elif memory is not None:
+            membudget.set_limit(memory)
 
         # Send a placeholder for now until the Acceptor is available
         self._port = 6881
 
+        # Restore the torrents of the last session once there is somewhere
+        # to load them
+        self._store = SessionStore(session)
+        started.addCallback(lambda _: self._restore())
+        self._save_timer = self._scheduler.call_later(_SAVE_INTERVAL,
+                                                      self._save_session)
+
         # Set up an amp control channel
         d = (TCP4ServerEndpoint(reactor, _AMP_CONTROL_PORT, 5, 'localhost')
              .listen(AMPControlServerFactory(self)))
@@ -53,8 +135,11 @@ class BitTorrentClient(object):
 
         # Schedule any torrents named on the command line to be added after
         # the reactor is running
-        for filename in sys.argv[1:]:
-            self._reactor.callLater(.01, self.add_torrent, (filename))
+        if filenames:
+            self._reactor.callLater(.01, self.add_torrents, filenames)
+
+        # Measure how long callbacks keep the reactor from servicing peers
+        lagmonitor.start(self._reactor)
 
         # The following call starts the reactor
         HTTPControlServer(self).app.run('localhost', 8080)
@@ -67,20 +152,44 @@ class BitTorrentClient(object):
         handling keyed by the info hash.
         """
         torrents = {}
-        for info_hash in self._torrents:
-            status = self.get_status(info_hash)
-            torrents[info_hash] = {'name': self._torrents[info_hash].name(),
-                                   'percent': status['percent']}
+        for info_hash, torrent in self._torrents.iteritems():
+            torrents[info_hash] = {'name': torrent.name(),
+                                   'percent': "{0:1.4f}"
+                                              .format(torrent.percent())}
         return torrents
 
+    def get_snapshot(self):
+        """
+        Returns a dictionary of the full status of every torrent the client is
+        handling keyed by the info hash.
+        """
+        return {info_hash: self._torrent_status(info_hash)
+                for info_hash in self._torrents}
+
+    def subscribe(self, callback, interval=1.0, heartbeat=None):
+        """
+        Arranges for callback to be called with the status of every torrent
+        now and with the changes to the status every interval seconds
+        thereafter (see statuspublisher.py).  Returns a Subscription which can
+        be used to cancel the updates.  Raises a MsgError exception if the
+        interval is invalid.
+        """
+        try:
+            return self._publisher.subscribe(callback, interval, heartbeat)
+        except ValueError as err:
+            raise MsgError(err.message)
+
     def add_torrent(self, filename):
         """
         Returns a deferred which eventually fires with the info_hash and the
         name of the torrent specified by the filename.  In case of failure,
         a MsgError exception is raised.
         """
+        if self._pool is not None:
+            return self._add_remote_torrent(filename)
+
         torrent = TorrentMgr(filename, self._port, self._peer_id,
-                             self._reactor)
+                             self._reactor, save_path=os.getcwd())
 
         def success(value):
             info_hash = torrent.info_hash().encode('hex')
@@ -90,9 +199,9 @@ class BitTorrentClient(object):
                 raise MsgError("Already serving {} (key: {})"
                                .format(filename, info_hash))
 
-            torrent.start()
-
             self._torrents[info_hash] = torrent
+            self._store_torrent(info_hash, filename, torrent)
+            self._queue.add(info_hash, torrent)
 
             return info_hash, torrent.name()
 
@@ -101,6 +210,180 @@ class BitTorrentClient(object):
 
         return torrent.initialize().addCallbacks(success, failure)
 
+    def _add_remote_torrent(self, filename):
+        # Read the metainfo here to find the key so that the same torrent
+        # isn't added to two different workers
+        d = Deferred()
+        try:
+            info_hash = Metainfo(filename).info_hash.encode('hex')
+        except ValueError as err:
+            d.errback(MsgError(err.message))
+            return d
+        except IOError as err:
+            d.errback(MsgError(err.strerror))
+            return d
+
+        if info_hash in self._torrents or info_hash in self._adding:
+            logger.debug("Already serving {} (key: {})"
+                         .format(filename, info_hash))
+            d.errback(MsgError("Already serving {} (key: {})"
+                               .format(filename, info_hash)))
+            return d
+
+        self._adding.add(info_hash)
+
+        def success(torrent):
+            self._adding.discard(info_hash)
+            self._torrents[info_hash] = torrent
+            self._store_torrent(info_hash, filename, torrent)
+            self._queue.add(info_hash, torrent)
+            return info_hash, torrent.name()
+
+        def failure(failure):
+            self._adding.discard(info_hash)
+            raise MsgError(failure.getErrorMessage())
+
+        return (self._pool.add_torrent(filename, self._port, self._peer_id,
+                                       os.getcwd())
+                .addCallbacks(success, failure))
+
+    def _store_torrent(self, info_hash, filename, torrent):
+        # Record a newly added torrent in the session store along with its
+        # files so that they can be listed before it is loaded again
+        self._store.add(info_hash, os.path.abspath(filename), torrent.name(),
+                        os.getcwd())
+
+        def save(files):
+            self._store.save_files(info_hash, [[f['path'], f['length']]
+                                               for f in files])
+
+        def failure(failure):
+            logger.warning("Unable to save the files of {}: {}"
+                           .format(filename, failure.getErrorMessage()))
+
+        maybeDeferred(torrent.files).addCallback(save).addErrback(failure)
+
+    def _restore(self):
+        # Restore the torrents of the last session to the end of the queue
+        # as StoredTorrents, which are loaded when they are first needed
+        restored = []
+        for entry in self._store.torrents():
+            if entry['key'] in self._torrents:
+                continue
+            torrent = StoredTorrent(self._store, entry,
+                                    lambda entry=entry: self._load(entry))
+            self._torrents[entry['key']] = torrent
+            restored.append((entry['key'], torrent))
+
+        self._queue.extend(restored)
+        logger.info("Restored {} torrents".format(len(restored)))
+
+    def _load(self, entry):
+        # Returns a deferred which fires with the torrent for a restored
+        # entry of the session store once it has been initialized from its
+        # torrent file and resume data
+        resume = self._store.resume(entry['key'])
+        if self._pool is not None:
+            d = self._pool.add_torrent(entry['filename'], self._port,
+                                       self._peer_id, entry['save_path'],
+                                       resume)
+        else:
+            torrent = TorrentMgr(entry['filename'], self._port,
+                                 self._peer_id, self._reactor,
+                                 save_path=entry['save_path'], resume=resume)
+            d = torrent.initialize().addCallback(lambda _: torrent)
+
+        def check(torrent):
+            if torrent.info_hash().encode('hex') != entry['key']:
+                raise MsgError("{} no longer holds the torrent"
+                               .format(entry['filename']))
+            return torrent
+
+        return d.addCallback(check)
+
+    def _save_session(self):
+        # Save the resume data of the loaded torrents and the order of the
+        # queue.  Returns a deferred which fires once they have been saved.
+        if self._save_timer is not None and self._save_timer.active():
+            self._save_timer.cancel()
+        self._save_timer = self._scheduler.call_later(_SAVE_INTERVAL,
+                                                      self._save_session)
+
+        keys = [key for key, torrent in self._torrents.iteritems()
+                if torrent.state() not in ('lost', 'failed')]
+        ds = [maybeDeferred(self._torrents[key].resume_data)
+              for key in keys]
+
+        def save(results):
+            resumes = {key: resume
+                       for key, (success, resume) in zip(keys, results)
+                       if success and resume is not None}
+            self._store.save(resumes, self._queue.order())
+            logger.debug("Saved the session of {} torrents"
+                         .format(len(resumes)))
+
+        def failure(failure):
+            logger.error("Unable to save the session: {}"
+                         .format(failure.getErrorMessage()))
+
+        return (DeferredList(ds, consumeErrors=True)
+                .addCallback(save).addErrback(failure))
+
+    def add_torrents(self, filenames=(), directory=None,
+                     concurrency=_ADD_CONCURRENCY, result=None):
+        """
+        Adds each torrent specified in filenames and each .torrent file in
+        the specified directory, initializing no more than concurrency
+        torrents at a time.  If supplied, result is called as soon as each
+        torrent has been added or has failed to be added with a dictionary
+        containing the filename, the key and name of the torrent and an error
+        message, which is empty on success.  Returns a deferred which fires
+        with the number of torrents added and the number which failed once
+        every torrent has been dealt with.  Raises a MsgError exception if
+        the directory can't be read or the concurrency is less than 1.
+        """
+        if concurrency < 1:
+            raise MsgError("Concurrency must be at least 1")
+
+        filenames = list(filenames)
+        if directory is not None:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError as err:
+                raise MsgError("Can't read {}: {}".format(directory,
+                                                          err.strerror))
+            filenames.extend(os.path.join(directory, name) for name in names
+                             if name.endswith('.torrent'))
+
+        counts = {'added': 0, 'failed': 0}
+
+        def added((info_hash, name), filename):
+            counts['added'] += 1
+            if result is not None:
+                result(dict(filename=filename, key=info_hash, name=name,
+                            error=''))
+
+        def failed(failure, filename):
+            counts['failed'] += 1
+            logger.info("Failed to add {}: {}"
+                        .format(filename, failure.getErrorMessage()))
+            if result is not None:
+                result(dict(filename=filename, key='', name='',
+                            error=failure.getErrorMessage()))
+
+        semaphore = DeferredSemaphore(concurrency)
+        ds = [semaphore.run(self.add_torrent, filename)
+              .addCallbacks(added, failed, callbackArgs=(filename,),
+                            errbackArgs=(filename,))
+              for filename in filenames]
+
+        def done(_):
+            logger.info("Added {} torrents, {} failed"
+                        .format(counts['added'], counts['failed']))
+            return counts['added'], counts['failed']
+
+        return DeferredList(ds).addCallback(done)
+
     def get_status(self, info_hash):
         """
         Returns a dictionary of status items related to the torrent specified
@@ -108,20 +391,316 @@ class BitTorrentClient(object):
         hash is invalid.
         """
         if info_hash in self._torrents:
-            return {'percent': "{0:1.4f}"
-                               .format(self._torrents[info_hash].percent())}
+            status = self._torrent_status(info_hash)
+            del status['name'], status['state']
+            return status
+        else:
+            logger.debug("Invalid key: {}".format(info_hash))
+            raise MsgError("Invalid key: {}".format(info_hash))
+
+    def _torrent_status(self, info_hash):
+        # Torrents which the queue hasn't started are reported as queued
+        torrent = self._torrents[info_hash]
+        state = torrent.state()
+        if self._queue.state(info_hash) == 'queued':
+            state = 'queued'
+        peers, snubbed = torrent.peer_counts()
+        return {'name': torrent.name(),
+                'state': state,
+                'percent': "{0:1.4f}".format(torrent.percent()),
+                'download_rate': "{0:1.1f}".format(torrent.download_rate()),
+                'upload_rate': "{0:1.1f}".format(torrent.upload_rate()),
+                'peers': peers,
+                'snubbed': snubbed,
+                'memory': torrent.memory()}
+
+    def get_peers(self, info_hash):
+        """
+        Returns a list of dictionaries of transfer statistics for each peer
+        of the torrent specified by the supplied info_hash or, if the torrent
+        is hosted by a worker, a deferred which fires with the list.  Raises a
+        MsgError exception if the info hash is invalid.
+        """
+        if info_hash in self._torrents:
+            return self._torrents[info_hash].peer_stats()
         else:
             logger.debug("Invalid key: {}".format(info_hash))
             raise MsgError("Invalid key: {}".format(info_hash))
 
+    def _torrent(self, info_hash):
+        if info_hash not in self._torrents:
+            logger.debug("Invalid key: {}".format(info_hash))
+            raise MsgError("Invalid key: {}".format(info_hash))
+        return self._torrents[info_hash]
+
+    def get_files(self, info_hash):
+        """
+        Returns a list of dictionaries containing the path, length and
+        priority of each file of the torrent specified by the supplied
+        info_hash or, if the torrent is hosted by a worker, a deferred which
+        fires with the list.
+        Raises a MsgError exception if the info hash is invalid.
+        """
+        return self._torrent(info_hash).files()
+
+    def set_priority(self, info_hash, priority, file_indices=None):
+        """
+        Sets the priority of the specified files of the torrent specified by
+        the supplied info_hash, or of all of its files if none are specified,
+        to skip, low, normal or high.  Returns a deferred if the torrent is
+        hosted by a worker.  Raises a MsgError exception if the info hash,
+        priority or a file index is invalid.
+        """
+        torrent = self._torrent(info_hash)
+        try:
+            return torrent.set_priority(priority, file_indices)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+
+    def set_streaming(self, info_hash, enable, file_index=None):
+        """
+        Turns streaming of the specified file of the torrent specified by the
+        supplied info_hash, or of the whole torrent if no file is specified,
+        on or off.  Returns a deferred if the torrent is hosted by a worker.
+        Raises a MsgError exception if the info hash or file index is
+        invalid.
+        """
+        torrent = self._torrent(info_hash)
+        try:
+            return torrent.set_streaming(enable, file_index)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+
+    def read_file(self, info_hash, file_index, offset, length):
+        """
+        Returns a deferred which fires with length bytes of the specified file
+        of the torrent specified by the supplied info_hash starting at offset
+        once the pieces they belong to have been downloaded.  Raises a
+        MsgError exception if the info hash is invalid or the bytes are not
+        within the file.
+        """
+        torrent = self._torrent(info_hash)
+        try:
+            return torrent.read(file_index, offset, length)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+
+    def get_queue(self):
+        """
+        Returns a dictionary containing the limits of the queue and a list of
+        dictionaries containing the key, name, position, state, percent
+        downloaded and number of connections granted of each torrent in queue
+        order.
+        """
+        return dict(limits=self._queue.limits(),
+                    torrents=self._queue.entries())
+
+    def move_torrent(self, info_hash, position):
+        """
+        Moves the torrent specified by the supplied info_hash to the
+        specified position in the queue, counting from 0.  Raises a MsgError
+        exception if the info hash or position is invalid.
+        """
+        self._torrent(info_hash)
+        try:
+            self._queue.move(info_hash, position)
+        except ValueError as err:
+            raise MsgError(err.message)
+        self._save_session()
+
+    def set_queue_limits(self, downloads=None, seeds=None, connections=None):
+        """
+        Changes those of the limits of the queue on active downloads, active
+        seeds and connections which are supplied and returns a dictionary of
+        the limits.  Raises a MsgError exception if a limit is invalid.
+        """
+        try:
+            return self._queue.set_limits(downloads, seeds, connections)
+        except ValueError as err:
+            raise MsgError(err.message)
+
+    def get_metrics(self):
+        """
+        Returns a deferred which fires with the current value of every metric,
+        summed over the client and its workers, in the Prometheus text
+        exposition format.
+        """
+        if self._pool is None:
+            return succeed(metrics.registry.render())
+
+        def merge(collections):
+            return metrics.merge([metrics.registry.collect()] +
+                                 [collection for _, collection
+                                  in collections]).render()
+
+        return self._pool.collect_metrics().addCallback(merge)
+
+    def _tracing_status(self, enable=None, sample=None):
+        # Returns a deferred which fires with the state of the tracer with
+        # the records of the workers' tracers added in, after passing enable
+        # and sample on to the workers
+        if self._pool is None:
+            return succeed(tracer.status())
+
+        def merge(statuses):
+            status = tracer.status()
+            for _, worker in statuses:
+                for name in ('capacity', 'records', 'recorded'):
+                    status[name] += worker[name]
+            return status
+
+        return self._pool.set_tracing(enable, sample).addCallback(merge)
+
+    def get_tracing(self):
+        """
+        Returns a deferred which fires with a dictionary describing the state
+        of the tracer, counting the records held by the workers.
+        """
+        return self._tracing_status()
+
+    def set_tracing(self, enable, sample=None):
+        """
+        Turns hot path tracing in the client and its workers on or off.  When
+        turning tracing on, one out of every sample events is recorded.
+        Returns a deferred which fires with a dictionary describing the state
+        of the tracer.  Raises a MsgError exception if the sample rate is
+        invalid.
+        """
+        if enable:
+            try:
+                tracer.enable(sample if sample is not None else 1)
+            except ValueError as err:
+                raise MsgError(err.message)
+            logger.info("Tracing enabled")
+        else:
+            tracer.disable()
+            logger.info("Tracing disabled")
+
+        return self._tracing_status(bool(enable), sample)
+
+    def get_trace(self):
+        """
+        Returns a deferred which fires with the raw contents of the trace ring
+        buffers of the client and its workers, oldest record first.
+        """
+        if self._pool is None:
+            return succeed(tracer.dump())
+
+        def merge(dumps):
+            return tracer.merge([tracer.dump()] +
+                                [data for _, data in dumps])
+
+        return self._pool.get_trace().addCallback(merge)
+
+    def dump_trace(self, filename):
+        """
+        Returns a deferred which fires with the number of records written once
+        the raw contents of the trace ring buffers have been written to the
+        specified file.
+        """
+        def write(data):
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return len(data) // tracer.RECORD_SIZE
+
+        return self.get_trace().addCallback(write)
+
+    def get_lag(self):
+        """
+        Returns a deferred which fires with a dictionary summarizing the lag
+        of the reactors of the client and its workers and the slow turns and
+        calls which have been observed (see lagmonitor.py).
+        """
+        if self._pool is None:
+            return succeed(lagmonitor.status())
+
+        def merge(statuses):
+            return lagmonitor.merge([(None, lagmonitor.status())] + statuses)
+
+        return self._pool.get_lag().addCallback(merge)
+
+    def profile(self, duration, mode='sample', format=None):
+        """
+        Returns a deferred which fires with the result of profiling the client
+        and its workers for duration seconds with the specified profiler in
+        the specified format (see profiler.py).  Raises a MsgError exception
+        if the arguments are invalid or a profile is already being taken.
+        """
+        try:
+            d = profiler.profile(self._reactor, duration, mode, format)
+        except ValueError as err:
+            raise MsgError(err.message)
+
+        logger.info("Profiling for {} seconds ({})".format(duration, mode))
+        if self._pool is None:
+            return d
+
+        if format is None:
+            format = profiler.FORMATS[mode][0]
+        workers = self._pool.profile(duration, mode, format)
+
+        def merge(results, own):
+            return profiler.merge([('client', own)] +
+                                  [("worker {}".format(index), result)
+                                   for index, result in results], format)
+
+        return d.addCallback(lambda own: workers.addCallback(merge, own))
+
+    def dump_profile(self, duration, mode, format, filename):
+        """
+        Returns a deferred which fires with the number of bytes written once
+        the result of profiling the client for duration seconds has been
+        written to the specified file.  Raises a MsgError exception if the
+        arguments are invalid or a profile is already being taken.
+        """
+        def write(data):
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return len(data)
+
+        return self.profile(duration, mode, format).addCallback(write)
+
     def quit(self):
         """
-        Stop the client by shutting down the reactor.
+        Stop the client by saving the session and shutting down the reactor.
         """
         logger.info("Quitting BitTorrent Client")
-        self._reactor.stop()
+
+        def stop(_):
+            self._store.close()
+            if self._pool is not None:
+                self._pool.stop()
+            self._reactor.stop()
+
+        self._save_session().addBoth(stop)
 
 if __name__ == '__main__':
     logger.info("Starting BitTorrent Client")
 
-    BitTorrentClient(reactor, sys.argv)
+    parser = argparse.ArgumentParser(description="BitTorrent client")
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help="number of worker processes to spread the "
+                             "torrents across (0 handles them in this "
+                             "process)")
+    parser.add_argument('-m', '--memory', type=int, metavar='MB',
+                        help="limit in MB on the block data held in memory")
+    parser.add_argument('-d', '--downloads', type=int,
+                        help="number of torrents downloading at a time")
+    parser.add_argument('-s', '--seeds', type=int,
+                        help="number of torrents seeding at a time")
+    parser.add_argument('-c', '--connections', type=int,
+                        help="number of peer connections shared by the "
+                             "active torrents")
+    parser.add_argument('--session', default=_SESSION, metavar='FILE',
+                        help="session store in which the torrents are kept "
+                             "between runs")
+    parser.add_argument('filenames', nargs='*', metavar='file',
+                        help="torrent file")
+    args = parser.parse_args()
+
+    memory = args.memory * 2**20 if args.memory is not None else None
+    queue_limits = {name: getattr(args, name)
+                    for name in ('downloads', 'seeds', 'connections')
+                    if getattr(args, name) is not None}
+    BitTorrentClient(reactor, args.filenames, args.workers, memory,
+                     queue_limits, args.session)
@@ -15,9 +15,145 @@ class MsgAdd(amp.Command):
     errors = {MsgError: "MsgError"}
 
 
+class MsgAddMany(amp.Command):
+    """
+    Adds the torrents named in filenames and the torrent files in directory,
+    initializing at most concurrency at a time.  Since an AMP value is limited
+    to 64 KB, a long list of filenames must be split across several commands
+    or replaced by a directory.  When stream is true, a MsgAddResult is sent
+    back for each torrent as soon as it has been added or has failed.  The
+    response is sent once every torrent has been dealt with.
+    """
+    arguments = [("filenames", amp.ListOf(amp.String(), optional=True)),
+                 ("directory", amp.String(optional=True)),
+                 ("concurrency", amp.Integer(optional=True)),
+                 ("stream", amp.Boolean(optional=True))]
+    response = [("added", amp.Integer()),
+                ("failed", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgAddResult(amp.Command):
+    arguments = [("filename", amp.String()),
+                 ("key", amp.String()),
+                 ("name", amp.String()),
+                 ("error", amp.String())]
+    requiresAnswer = False
+
+
+class MsgPriority(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("priority", amp.String()),
+                 ("file", amp.Integer(optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
 class MsgStatus(amp.Command):
     arguments = [("key", amp.String())]
-    response = [("percent", amp.String())]
+    response = [("percent", amp.String()),
+                ("download_rate", amp.String()),
+                ("upload_rate", amp.String()),
+                ("peers", amp.Integer()),
+                ("snubbed", amp.Integer()),
+                ("memory", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgStream(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("enable", amp.Boolean()),
+                 ("file", amp.Integer(optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgQueue(amp.Command):
+    """
+    Responds with the limits of the queue, the number of torrents in it and a
+    json formatted string which represents the list of count torrents, or all
+    of them, from position start in queue order as described for get_queue()
+    in client.py.  Since an AMP value is limited to 64 KB, a long queue must
+    be fetched a part at a time.
+    """
+    arguments = [("start", amp.Integer(optional=True)),
+                 ("count", amp.Integer(optional=True))]
+    response = [("torrents", amp.String()),
+                ("total", amp.Integer()),
+                ("downloads", amp.Integer()),
+                ("seeds", amp.Integer()),
+                ("connections", amp.Integer())]
+
+
+class MsgQueueMove(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("position", amp.Integer())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgQueueLimits(amp.Command):
+    arguments = [("downloads", amp.Integer(optional=True)),
+                 ("seeds", amp.Integer(optional=True)),
+                 ("connections", amp.Integer(optional=True))]
+    response = [("downloads", amp.Integer()),
+                ("seeds", amp.Integer()),
+                ("connections", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgTrace(amp.Command):
+    arguments = [("enable", amp.Boolean()),
+                 ("sample", amp.Integer(optional=True))]
+    response = [("enabled", amp.Boolean()),
+                ("sample", amp.Integer()),
+                ("records", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgTraceDump(amp.Command):
+    arguments = [("filename", amp.String())]
+    response = [("records", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgSubscribe(amp.Command):
+    arguments = [("interval", amp.Float())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgUnsubscribe(amp.Command):
+    arguments = []
+    response = []
+
+
+class MsgStatusUpdate(amp.Command):
+    """
+    Sent by the client to a subscribed control channel.  The deltas are a json
+    formatted string as described in statuspublisher.py.  An update which
+    would exceed the AMP value size limit is split across several messages.
+    """
+    arguments = [("deltas", amp.String())]
+    requiresAnswer = False
+
+
+class MsgLag(amp.Command):
+    arguments = []
+    response = [("turns", amp.Integer()),
+                ("p50", amp.Float()),
+                ("p99", amp.Float()),
+                ("max", amp.Float()),
+                ("slow_turns", amp.Integer()),
+                ("last_slow_callback", amp.String())]
+
+
+class MsgProfile(amp.Command):
+    arguments = [("duration", amp.Float()),
+                 ("mode", amp.String()),
+                 ("format", amp.String(optional=True)),
+                 ("filename", amp.String())]
+    response = [("size", amp.Integer())]
     errors = {MsgError: "MsgError"}
 
 
@@ -0,0 +1,104 @@
+"""
+The connection budget divides a global limit on peer connections among the
+active torrents according to how many connections each of them can use.  The
+TorrentQueue (see torrentqueue.py) asks it for a new allocation whenever the
+set of active torrents changes and every few seconds thereafter, and tells
+each torrent the number of peers it may connect to with set_max_peers().
+
+A torrent's demand is the number of connections it can make use of:
+
+    - no more than _MAX_SLOTS
+    - no more than the number of pieces it still needs, since a peer
+      downloads one piece at a time
+    - no more than the size of its swarm, the peers it is connected to plus
+      the addresses the tracker and peer exchange have supplied which it
+      hasn't tried
+    - only _IDLE_SLOTS once it has downloaded less than _IDLE_RATE bytes per
+      second for _IDLE_TIMEOUT seconds, so that the slots of a torrent whose
+      peers have nothing to give are reclaimed for the others
+
+but never less than _MIN_SLOTS, so that every active torrent keeps at least
+one connection through which it can learn of new peers.  A complete torrent
+has no demand beyond that minimum since uploading is not implemented.  The
+demand of a torrent hosted by a worker whose needs haven't been reported yet
+is _MAX_SLOTS.
+
+The limit is divided by max-min fairness: torrents are visited in order of
+increasing demand and each is granted its demand or an equal share of what
+is left, whichever is smaller.  A torrent which can use fewer connections
+than its share leaves the rest to the torrents which can use more.  Among
+torrents with the same demand, the faster ones are visited last, so they
+receive what is left over from rounding.
+
+The number of slots granted is recorded in the metrics registry.
+"""
+
+import logging
+import metrics
+
+logger = logging.getLogger('bt.connbudget')
+
+_MIN_SLOTS = 1
+_MAX_SLOTS = 20
+_IDLE_SLOTS = 2
+_IDLE_RATE = 1024
+_IDLE_TIMEOUT = 60
+
+_granted = metrics.gauge('bt_connection_slots',
+                         "Peer connection slots granted to active torrents")
+
+
+class ConnectionBudget(object):
+    def __init__(self, reactor, limit):
+        self._reactor = reactor
+        self._limit = limit
+
+        # _busy maps the key of each torrent being allocated for to the
+        # last time it was downloading at _IDLE_RATE or more
+        self._busy = {}
+
+    def limit(self):
+        return self._limit
+
+    def set_limit(self, limit):
+        self._limit = limit
+
+    def _demand(self, key, torrent, now):
+        needed = torrent.pieces_needed()
+        swarm = torrent.swarm_size()
+        if needed is None or swarm is None:
+            return _MAX_SLOTS
+
+        if torrent.download_rate() >= _IDLE_RATE:
+            self._busy[key] = now
+        demand = min(_MAX_SLOTS, needed, swarm)
+        if now - self._busy.setdefault(key, now) >= _IDLE_TIMEOUT:
+            demand = min(demand, _IDLE_SLOTS)
+        return max(demand, _MIN_SLOTS)
+
+    def allocate(self, torrents):
+        """
+        allocate() takes a dictionary of active torrents keyed by their keys
+        and returns a dictionary mapping the same keys to the number of
+        connections each torrent may have.  There must be no more torrents
+        than the limit.
+        """
+        now = self._reactor.seconds()
+        for key in [key for key in self._busy if key not in torrents]:
+            del self._busy[key]
+
+        demands = {key: self._demand(key, torrent, now)
+                   for key, torrent in torrents.iteritems()}
+        order = sorted(torrents, key=lambda key: (demands[key],
+                                                  torrents[key]
+                                                  .download_rate()))
+
+        grants = {}
+        remaining = self._limit
+        for i, key in enumerate(order):
+            share = remaining // (len(order) - i)
+            grants[key] = max(_MIN_SLOTS, min(demands[key], share))
+            remaining -= grants[key]
+
+        _granted.set(sum(grants.itervalues()))
+        return grants
@@ -5,16 +5,29 @@ using AMP messages over the control channel on localhost:1060.
 
 User commands:
 add [-h] [-n nickname] filename
+addall [-h] [-c concurrency] directory
 status [-h] key
+priority [-h] key {skip,low,normal,high} [file ...]
+stream [-h] [-f file] key {on,off}
+queue
+move [-h] key position
+limits [-h] [-d downloads] [-s seeds] [-c connections]
+trace [-h] [-s sample] {on,off,dump} [filename]
+profile [-h] [-m {sample,cprofile}] [-f format] duration filename
+lag
 quit
 """
 
+import json
 import sys
 
 from ampy import ampy
 from argparse import ArgumentParser
 from cmd import Cmd
 
+# The number of torrents in the queue fetched with each message
+_QUEUE_PART = 200
+
 # Control channel message definitions in ampy format
 
 
@@ -28,9 +41,99 @@ class MsgAdd(ampy.Command):
     errors = {MsgError: "MsgError"}
 
 
+class MsgAddMany(ampy.Command):
+    arguments = [("directory", ampy.String(optional=True)),
+                 ("concurrency", ampy.Integer(optional=True))]
+    response = [("added", ampy.Integer()),
+                ("failed", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgPriority(ampy.Command):
+    arguments = [("key", ampy.String()),
+                 ("priority", ampy.String()),
+                 ("file", ampy.Integer(optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
 class MsgStatus(ampy.Command):
     arguments = [("key", ampy.String())]
-    response = [("percent", ampy.String())]
+    response = [("percent", ampy.String()),
+                ("download_rate", ampy.String()),
+                ("upload_rate", ampy.String()),
+                ("peers", ampy.Integer()),
+                ("snubbed", ampy.Integer()),
+                ("memory", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgStream(ampy.Command):
+    arguments = [("key", ampy.String()),
+                 ("enable", ampy.Boolean()),
+                 ("file", ampy.Integer(optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgQueue(ampy.Command):
+    arguments = [("start", ampy.Integer(optional=True)),
+                 ("count", ampy.Integer(optional=True))]
+    response = [("torrents", ampy.String()),
+                ("total", ampy.Integer()),
+                ("downloads", ampy.Integer()),
+                ("seeds", ampy.Integer()),
+                ("connections", ampy.Integer())]
+
+
+class MsgQueueMove(ampy.Command):
+    arguments = [("key", ampy.String()),
+                 ("position", ampy.Integer())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class MsgQueueLimits(ampy.Command):
+    arguments = [("downloads", ampy.Integer(optional=True)),
+                 ("seeds", ampy.Integer(optional=True)),
+                 ("connections", ampy.Integer(optional=True))]
+    response = [("downloads", ampy.Integer()),
+                ("seeds", ampy.Integer()),
+                ("connections", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgTrace(ampy.Command):
+    arguments = [("enable", ampy.Boolean()),
+                 ("sample", ampy.Integer(optional=True))]
+    response = [("enabled", ampy.Boolean()),
+                ("sample", ampy.Integer()),
+                ("records", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgTraceDump(ampy.Command):
+    arguments = [("filename", ampy.String())]
+    response = [("records", ampy.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class MsgLag(ampy.Command):
+    arguments = []
+    response = [("turns", ampy.Integer()),
+                ("p50", ampy.Float()),
+                ("p99", ampy.Float()),
+                ("max", ampy.Float()),
+                ("slow_turns", ampy.Integer()),
+                ("last_slow_callback", ampy.String())]
+
+
+class MsgProfile(ampy.Command):
+    arguments = [("duration", ampy.Float()),
+                 ("mode", ampy.String()),
+                 ("format", ampy.String(optional=True)),
+                 ("filename", ampy.String())]
+    response = [("size", ampy.Integer())]
     errors = {MsgError: "MsgError"}
 
 
@@ -51,10 +154,88 @@ class Console(Cmd):
         self.addparser.add_argument('-n', action='store',
                                     help="nickname", metavar="nickname")
 
+        self.addallparser = ArgumentParser('addall')
+        self.addallparser.add_argument('directory', action='store',
+                                       help="directory of torrent files")
+        self.addallparser.add_argument('-c', action='store', type=int,
+                                       default=8, metavar="concurrency",
+                                       help="number of torrents to "
+                                            "initialize at a time")
+
         self.statusparser = ArgumentParser('status')
         self.statusparser.add_argument('key', action='store',
                                        help="key or nickname")
 
+        self.priorityparser = ArgumentParser('priority')
+        self.priorityparser.add_argument('key', action='store',
+                                         help="key or nickname")
+        self.priorityparser.add_argument('priority', action='store',
+                                         choices=['skip', 'low', 'normal',
+                                                  'high'],
+                                         help="priority of the files")
+        self.priorityparser.add_argument('files', action='store', type=int,
+                                         nargs='*', metavar="file",
+                                         help="index of a file to set, all "
+                                              "files if none are given")
+
+        self.streamparser = ArgumentParser('stream')
+        self.streamparser.add_argument('key', action='store',
+                                       help="key or nickname")
+        self.streamparser.add_argument('action', action='store',
+                                       choices=['on', 'off'],
+                                       help="turn streaming on or off")
+        self.streamparser.add_argument('-f', action='store', type=int,
+                                       metavar="file",
+                                       help="index of the file to stream")
+
+        self.moveparser = ArgumentParser('move')
+        self.moveparser.add_argument('key', action='store',
+                                     help="key or nickname")
+        self.moveparser.add_argument('position', action='store', type=int,
+                                     help="position in the queue, counting "
+                                          "from 0")
+
+        self.limitsparser = ArgumentParser('limits')
+        self.limitsparser.add_argument('-d', action='store', type=int,
+                                       metavar="downloads",
+                                       help="number of torrents downloading "
+                                            "at a time")
+        self.limitsparser.add_argument('-s', action='store', type=int,
+                                       metavar="seeds",
+                                       help="number of torrents seeding at a "
+                                            "time")
+        self.limitsparser.add_argument('-c', action='store', type=int,
+                                       metavar="connections",
+                                       help="number of peer connections "
+                                            "shared by the active torrents")
+
+        self.traceparser = ArgumentParser('trace')
+        self.traceparser.add_argument('action', action='store',
+                                      choices=['on', 'off', 'dump'],
+                                      help="turn tracing on or off or dump "
+                                           "the trace buffer")
+        self.traceparser.add_argument('filename', action='store', nargs='?',
+                                      help="file to dump the trace buffer to")
+        self.traceparser.add_argument('-s', action='store', type=int,
+                                      default=1, metavar="sample",
+                                      help="record one out of every sample "
+                                           "events")
+
+        self.profileparser = ArgumentParser('profile')
+        self.profileparser.add_argument('duration', action='store',
+                                        type=float,
+                                        help="seconds to profile for")
+        self.profileparser.add_argument('filename', action='store',
+                                        help="file to write the profile to")
+        self.profileparser.add_argument('-m', action='store',
+                                        choices=['sample', 'cprofile'],
+                                        default='sample', metavar="mode",
+                                        help="sample (collapsed stacks) or "
+                                             "cprofile")
+        self.profileparser.add_argument('-f', action='store',
+                                        metavar="format",
+                                        help="text or pstats for cprofile")
+
         self.nicknames = {}
 
         self.proxy = ampy.Proxy('localhost', 1060)
@@ -88,6 +269,25 @@ class Console(Cmd):
 
         print "Adding {} (key: {})".format(filename, result['key'])
 
+    def do_addall(self, args):
+        try:
+            result = vars(self.addallparser.parse_args(args.split()))
+        except:
+            return
+
+        print "Adding torrents in {}...".format(result['directory'])
+
+        try:
+            response = self.proxy.callRemote(MsgAddMany,
+                                             directory=result['directory'],
+                                             concurrency=result['c'])
+        except Exception as err:
+            print err.message
+            return
+
+        print "Added {} torrents, {} failed".format(response['added'],
+                                                    response['failed'])
+
     def do_status(self, args):
         try:
             result = vars(self.statusparser.parse_args(args.split()))
@@ -105,6 +305,185 @@ class Console(Cmd):
             return
 
         print result['percent'] + "% downloaded"
+        print "Download rate: {} B/s, upload rate: {} B/s".format(
+            result['download_rate'], result['upload_rate'])
+        print "Peers: {} ({} snubbed)".format(result['peers'],
+                                              result['snubbed'])
+        print "Memory: {} B".format(result['memory'])
+
+    def do_priority(self, args):
+        try:
+            result = vars(self.priorityparser.parse_args(args.split()))
+        except:
+            return
+
+        key = result['key']
+        if key in self.nicknames:
+            key = self.nicknames[key]
+
+        # The priority of each file is set with a separate message
+        if result['files']:
+            arguments = [dict(key=key, priority=result['priority'], file=f)
+                         for f in result['files']]
+        else:
+            arguments = [dict(key=key, priority=result['priority'])]
+
+        try:
+            for kwargs in arguments:
+                self.proxy.callRemote(MsgPriority, **kwargs)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Priority set to {}".format(result['priority'])
+
+    def do_stream(self, args):
+        try:
+            result = vars(self.streamparser.parse_args(args.split()))
+        except:
+            return
+
+        key = result['key']
+        if key in self.nicknames:
+            key = self.nicknames[key]
+
+        arguments = dict(key=key, enable=(result['action'] == 'on'))
+        if result['f'] is not None:
+            arguments['file'] = result['f']
+
+        try:
+            self.proxy.callRemote(MsgStream, **arguments)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Streaming {}".format(result['action'])
+
+    def do_queue(self, args):
+        # The queue is fetched a part at a time to keep each response within
+        # the AMP value size limit
+        torrents = []
+        try:
+            while True:
+                result = self.proxy.callRemote(MsgQueue, start=len(torrents),
+                                               count=_QUEUE_PART)
+                part = json.loads(result['torrents'])
+                torrents.extend(part)
+                if part == [] or len(torrents) >= result['total']:
+                    break
+        except Exception as err:
+            print err.message
+            return
+
+        print "Limits: {} downloads, {} seeds, {} connections".format(
+            result['downloads'], result['seeds'], result['connections'])
+        for torrent in torrents:
+            print "{:4} {:11} {:6.2f}% {:3} peers {} ({})".format(
+                torrent['position'], torrent['state'], torrent['percent'],
+                torrent['connections'], torrent['name'], torrent['key'])
+
+    def do_move(self, args):
+        try:
+            result = vars(self.moveparser.parse_args(args.split()))
+        except:
+            return
+
+        key = result['key']
+        if key in self.nicknames:
+            key = self.nicknames[key]
+
+        try:
+            self.proxy.callRemote(MsgQueueMove, key=key,
+                                  position=result['position'])
+        except Exception as err:
+            print err.message
+            return
+
+        print "Moved to position {}".format(result['position'])
+
+    def do_limits(self, args):
+        try:
+            result = vars(self.limitsparser.parse_args(args.split()))
+        except:
+            return
+
+        arguments = {name: result[option]
+                     for option, name in (('d', 'downloads'), ('s', 'seeds'),
+                                          ('c', 'connections'))
+                     if result[option] is not None}
+
+        try:
+            response = self.proxy.callRemote(MsgQueueLimits, **arguments)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Limits: {} downloads, {} seeds, {} connections".format(
+            response['downloads'], response['seeds'], response['connections'])
+
+    def do_trace(self, args):
+        try:
+            result = vars(self.traceparser.parse_args(args.split()))
+        except:
+            return
+
+        try:
+            if result['action'] == 'dump':
+                if result['filename'] is None:
+                    print "A filename is required to dump the trace buffer"
+                    return
+                response = self.proxy.callRemote(
+                    MsgTraceDump, filename=result['filename'])
+                print "Dumped {} records to {}".format(response['records'],
+                                                       result['filename'])
+                return
+
+            response = self.proxy.callRemote(
+                MsgTrace, enable=(result['action'] == 'on'),
+                sample=result['s'])
+        except Exception as err:
+            print err.message
+            return
+
+        print "Tracing {} (sample 1/{}, {} records)".format(
+            "on" if response['enabled'] else "off", response['sample'],
+            response['records'])
+
+    def do_profile(self, args):
+        try:
+            result = vars(self.profileparser.parse_args(args.split()))
+        except:
+            return
+
+        print "Profiling for {} seconds...".format(result['duration'])
+
+        arguments = dict(duration=result['duration'], mode=result['m'],
+                         filename=result['filename'])
+        if result['f'] is not None:
+            arguments['format'] = result['f']
+
+        try:
+            response = self.proxy.callRemote(MsgProfile, **arguments)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Wrote {} bytes to {}".format(response['size'],
+                                            result['filename'])
+
+    def do_lag(self, args):
+        try:
+            result = self.proxy.callRemote(MsgLag)
+        except Exception as err:
+            print err.message
+            return
+
+        print "Reactor lag over {} turns: median <= {}s, 99th <= {}s, " \
+              "max {:.4f}s".format(result['turns'], result['p50'],
+                                   result['p99'], result['max'])
+        print "Slow turns: {}".format(result['slow_turns'])
+        if result['last_slow_callback'] != '':
+            print "Last slow turn: {}".format(result['last_slow_callback'])
 
     def do_quit(self, args):
         self.proxy.callRemoteNoAnswer(MsgQuit)
@@ -116,9 +495,30 @@ class Console(Cmd):
     def help_add(self):
         self.addparser.print_help()
 
+    def help_addall(self):
+        self.addallparser.print_help()
+
     def help_status(self):
         self.statusparser.print_help()
 
+    def help_priority(self):
+        self.priorityparser.print_help()
+
+    def help_stream(self):
+        self.streamparser.print_help()
+
+    def help_move(self):
+        self.moveparser.print_help()
+
+    def help_limits(self):
+        self.limitsparser.print_help()
+
+    def help_trace(self):
+        self.traceparser.print_help()
+
+    def help_profile(self):
+        self.profileparser.print_help()
+
     def postloop(self):
         print
 
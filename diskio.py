@@ -0,0 +1,134 @@
+"""
+The DiskIO runs the FileMgrs' reads and writes in a bounded pool of threads so
+that a slow disk, such as a network file system or a busy RAID, holds up the
+operations waiting for it rather than the reactor and with it every peer
+connection.  There is a single DiskIO for each reactor which is obtained by
+calling get_diskio().  It is shared by all of the TorrentMgrs so that the
+number of threads touching the disk stays fixed however many torrents there
+are.  The pool is started when the reactor starts and stopped when it shuts
+down.
+
+run() returns a deferred which fires with the result of the operation on the
+reactor thread.  An operation may be given a DeferredLock, which the FileMgr
+keeps for each file.  Operations sharing a lock are run one at a time in the
+order in which they were submitted so that blocks are written to a file in
+order and a read sees every write submitted before it, while operations on
+different files proceed in parallel.
+
+The DiskIO counts the operations which have been submitted but have not
+completed, including those waiting for their file's lock.  When the count
+reaches _HIGH_WATER, the DiskIO is congested and stays congested until the
+count falls back to _LOW_WATER.  The TorrentMgrs stop issuing new requests to
+peers while it is congested so that received blocks don't pile up in memory
+faster than the disk can absorb them.  drained() returns a deferred which
+fires once the DiskIO is no longer congested.
+
+The number of pending operations and the time each operation takes, from
+being submitted to completing, are recorded in the metrics registry.
+"""
+
+import logging
+import metrics
+import time
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+logger = logging.getLogger('bt.diskio')
+
+_THREADS = 4
+_HIGH_WATER = 256
+_LOW_WATER = 64
+
+_queue_depth = metrics.gauge('bt_disk_queue_depth',
+                             "Disk operations submitted but not completed")
+_op_seconds = metrics.histogram('bt_disk_op_seconds',
+                                "Time taken by a disk operation from being "
+                                "submitted to completing", ('op',))
+
+_diskios = {}
+
+
+def get_diskio(reactor):
+    """
+    get_diskio() returns the DiskIO for the specified reactor, creating it if
+    necessary.
+    """
+    if reactor not in _diskios:
+        _diskios[reactor] = DiskIO(reactor)
+    return _diskios[reactor]
+
+
+class DiskIO(object):
+    def __init__(self, reactor, threads=_THREADS, high_water=_HIGH_WATER,
+                 low_water=_LOW_WATER):
+        self._reactor = reactor
+        self._high_water = high_water
+        self._low_water = low_water
+
+        self._pool = ThreadPool(1, threads, name='diskio')
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', self._pool.stop)
+
+        self._pending = 0
+        self._congested = False
+
+        # _drain_waiters is a list of deferreds to fire when the DiskIO is
+        # no longer congested
+        self._drain_waiters = []
+
+    def run(self, op, lock, function, *args, **kwargs):
+        """
+        run() arranges for function to be called with the supplied arguments
+        in the thread pool once the lock, if one is supplied, is acquired.
+        op names the kind of operation for the latency metric.  It returns a
+        deferred which fires with the result of the call.
+        """
+        self._pending += 1
+        _queue_depth.inc()
+        if self._pending >= self._high_water and not self._congested:
+            self._congested = True
+            logger.debug("Disk I/O is congested with {} pending operations"
+                         .format(self._pending))
+
+        start = time.time()
+        if lock is None:
+            d = deferToThreadPool(self._reactor, self._pool, function, *args,
+                                  **kwargs)
+        else:
+            d = lock.run(deferToThreadPool, self._reactor, self._pool,
+                         function, *args, **kwargs)
+
+        def done(result):
+            _op_seconds.labels(op).observe(time.time() - start)
+            self._completed()
+            return result
+        return d.addBoth(done)
+
+    def pending(self):
+        return self._pending
+
+    def congested(self):
+        return self._congested
+
+    def drained(self):
+        """
+        drained() returns a deferred which fires once the DiskIO is no longer
+        congested.
+        """
+        if not self._congested:
+            return succeed(None)
+        d = Deferred()
+        self._drain_waiters.append(d)
+        return d
+
+    def _completed(self):
+        self._pending -= 1
+        _queue_depth.dec()
+        if self._congested and self._pending <= self._low_water:
+            self._congested = False
+            logger.debug("Disk I/O is no longer congested")
+            waiters, self._drain_waiters = self._drain_waiters, []
+            for d in waiters:
+                d.callback(None)
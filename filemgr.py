@@ -1,98 +1,284 @@
 """
 The FileMgr reads and writes the set of torrent files.  If the files exist, it
-opens them and creates a bitfield to reflect which pieces are present (not
-implemented).  If not, it creates the files.  The FileMgr maps locations
-in the set of pieces to where they appear in the files and vice versa.
+opens them.  If not, it creates the files.  The files are not hashed to find
+out which pieces are present (not implemented), but check() confirms which of
+the pieces recorded in resume data are still on disk.  The FileMgr maps
+locations in the set of pieces to where they appear in the files and vice
+versa.
+
+The files are placed under the supplied save path, the current directory by
+default.  A file, along with its directory, is only created when a block is
+first written to it so that the files which are not being downloaded don't
+take up space.  Only the parts of those files which share a piece with a file
+being downloaded are ever written.  Empty files are created right away.
+
+Reads and writes are run in the thread pool of the DiskIO (see diskio.py)
+so that a slow disk doesn't stall the reactor, and read() and write_block()
+return deferreds.  Each file has a DeferredLock so that the operations on a
+file are carried out in the order in which they were submitted.  Since a
+piece is verified from the blocks as they are received, written() lets the
+TorrentMgr wait until the blocks of a verified piece are actually on disk
+before treating the piece as available.
+
+The blocks waiting to be written and the data being read are charged to the
+torrent's memory budget account (see membudget.py) until they have been
+written or handed over.
 
 Files are flushed after every write.  Otherwise, received blocks which have
 been written might be lost on premature termination of the program.
 
-Right now, the FileMgr keeps every file in the torrent open.  This may present
-a problem if the client is serving many torrents.  It might be better to keep
-open only those files that are actively being downloaded or uploaded.
+The FileMgr keeps every file it has opened open until close() is called,
+which the TorrentMgr does when it is stopped, so that only the torrents which
+the client's queue has made active hold open files.  A file is reopened the
+next time it is read or written.
+
+The number of blocks and bytes written and the time taken by each flush are
+recorded in the metrics registry.  A flush only hands the write to the
+operating system, which is not asked to sync it to the disk, so the flush
+time is not the latency of the disk itself.
 """
 
 import errno
+import lagmonitor
 import logging
+import metrics
 import os
-from bitstring import BitArray
+import time
+from bitfield import Bitfield
+from diskio import get_diskio
+
+from twisted.internet.defer import DeferredList, DeferredLock, gatherResults
 
 logger = logging.getLogger('bt.filemgr')
 
+_blocks_written = metrics.counter('bt_filemgr_blocks_written_total',
+                                  "Blocks written to disk")
+_bytes_written = metrics.counter('bt_filemgr_bytes_written_total',
+                                 "Bytes written to disk")
+_flush_seconds = metrics.histogram('bt_filemgr_flush_seconds',
+                                   "Time taken to hand a write to the "
+                                   "operating system (not fsync)")
+
 
 class FileMgr(object):
-    def __init__(self, metainfo):
+    def __init__(self, metainfo, reactor, account, save_path=''):
         self._metainfo = metainfo
-        self._have = BitArray(self._metainfo.num_pieces)
-
-        directory = metainfo.directory
-        if directory != '':
-            try:
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-            except OSError as err:
-                if err.errno != errno.EEXIST:
-                    raise
-
-        files = metainfo.files
+        self._account = account
+        self._diskio = get_diskio(reactor)
+        self._have = Bitfield(self._metainfo.num_pieces)
 
         # _files is a list of files in the torrent.  Each entry is a
-        # tuple containing the file descriptor, length of the file and
-        # offset of the file within the torrent
+        # tuple containing the name of the file, length of the file and
+        # offset of the file within the torrent.  _fds maps the index of
+        # each file which has been opened to its file descriptor.
         self._files = []
+        self._fds = {}
+        self._locks = [DeferredLock() for _ in metainfo.files]
+
+        # _pending maps the index of each piece with blocks being written to
+        # a list of the deferreds for those writes.  _failed is the set of
+        # pieces for which a write has failed since written() was last
+        # called for the piece.
+        self._pending = {}
+        self._failed = set()
 
         offset = 0
-        subdirs = []
-        for path, length in files:
-            dirname = directory+"/".join(path[0:-1])
-
-            if dirname != '' and dirname not in subdirs:
-                subdirs.append(dirname)
-                try:
-                    if not os.path.exists(dirname):
-                        os.makedirs(dirname)
-                except OSError as err:
-                    if err.errno != errno.EEXIST:
-                        raise
-
-            if dirname == '':
-                filename = path[-1]
-            else:
-                filename = dirname+"/"+path[-1]
+        for index, (path, length) in enumerate(metainfo.files):
+            filename = os.path.join(save_path, metainfo.directory, *path)
+            self._files.append((filename, length, offset))
+            offset += length
 
-            try:
-                open(filename, 'a').close()
-                fd = open(filename, 'rb+')
-            except IOError:
-                logger.critical("Unable to open file {}".format(filename))
+            # Files are otherwise created when they are first written to, so
+            # create the empty ones now
+            if length == 0:
+                self._open(index)
+                self._close_file(index)
+
+    def _open(self, file_index):
+        # Returns the file descriptor of the file, opening and, if
+        # necessary, creating the file and its directory
+        if file_index in self._fds:
+            return self._fds[file_index]
+
+        filename = self._files[file_index][0]
+        dirname = os.path.dirname(filename)
+        try:
+            if dirname != '' and not os.path.exists(dirname):
+                os.makedirs(dirname)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
                 raise
 
-            self._files.append((fd, length, offset))
-            offset += length
+        try:
+            open(filename, 'a').close()
+            fd = open(filename, 'rb+')
+        except IOError:
+            logger.critical("Unable to open file {}".format(filename))
+            raise
+
+        self._fds[file_index] = fd
+        return fd
+
+    def _close_file(self, file_index):
+        # Closes the file if it is open
+        fd = self._fds.pop(file_index, None)
+        if fd is not None:
+            fd.close()
+
+    def close(self):
+        """
+        close() closes every open file once the reads and writes already
+        submitted for it are done.  It returns a deferred which fires once
+        the files have been closed.
+        """
+        ds = [self._diskio.run('close', lock, self._close_file, index)
+              for index, lock in enumerate(self._locks)
+              if index in self._fds or lock.locked]
+        return DeferredList(ds)
 
     def _file_index(self, offset):
-        for i, (fd, length, begin) in enumerate(self._files):
+        for i, (_, length, begin) in enumerate(self._files):
             if offset >= begin and offset < begin + length:
                 return i
 
+    def _segments(self, offset_in_torrent, length):
+        # Returns a list of tuples containing the index of a file, the offset
+        # within the file and the number of bytes for each part of the span
+        # of the torrent which falls in a different file
+        segments = []
+        file_index = self._file_index(offset_in_torrent)
+        while length > 0:
+            _, file_length, file_offset_in_torrent = self._files[file_index]
+            offset_in_file = offset_in_torrent - file_offset_in_torrent
+            n = min(length, file_length - offset_in_file)
+            if n > 0:
+                segments.append((file_index, offset_in_file, n))
+            offset_in_torrent += n
+            length -= n
+            file_index += 1
+        return segments
+
     def have(self):
         return self._have.copy()
 
-    def write_block(self, piece_index, offset_in_piece, buf, file_index=None):
+    def check(self, bitfield):
+        """
+        check() returns a copy of the bitfield of pieces which were on disk
+        when the torrent was last served, keeping only the pieces whose files
+        still exist and are long enough to hold them.  The pieces are not
+        hashed.
+        """
+        sizes = []
+        for filename, _, _ in self._files:
+            try:
+                sizes.append(os.path.getsize(filename))
+            except OSError:
+                sizes.append(-1)
+
+        have = bitfield.copy()
+        piece_length = self._metainfo.piece_length
+        for index in bitfield.ones():
+            length = min(piece_length,
+                         self._metainfo.total_length - index * piece_length)
+            for file_index, offset_in_file, n in self._segments(
+                    index * piece_length, length):
+                if sizes[file_index] < offset_in_file + n:
+                    have[index] = 0
+                    break
+        return have
+
+    def read(self, offset_in_torrent, length):
+        """
+        read() returns a deferred which fires with length bytes of the
+        torrent starting at the specified offset, which may span several
+        files, once they have been read from disk.
+        """
+        self._account.charge('read', length)
+        ds = [self._diskio.run('read', self._locks[file_index],
+                               self._read_segment, file_index,
+                               offset_in_file, n)
+              for file_index, offset_in_file, n
+              in self._segments(offset_in_torrent, length)]
+
+        def done(result):
+            self._account.release('read', length)
+            return result
+
+        return (gatherResults(ds, consumeErrors=True)
+                .addBoth(done).addCallback(lambda data: ''.join(data)))
+
+    def _read_segment(self, file_index, offset_in_file, n):
+        # Runs in the thread pool
+        fd = self._open(file_index)
+        fd.seek(offset_in_file)
+        return fd.read(n)
+
+    @lagmonitor.watch('FileMgr.write_block')
+    def write_block(self, piece_index, offset_in_piece, buf):
+        """
+        write_block() submits the block to be written and returns a deferred
+        which fires once it has been written.  A failure to write is logged
+        and reported by written() rather than through the deferred.
+        """
         offset_in_torrent = (piece_index * self._metainfo.piece_length +
                              offset_in_piece)
+        _blocks_written.value += 1
+        self._account.charge('write', len(buf))
 
-        if file_index is None:
-            file_index = self._file_index(offset_in_torrent)
-        fd, file_length, file_offset_in_torrent = self._files[file_index]
-        offset_in_file = offset_in_torrent - file_offset_in_torrent
+        ds = []
+        start = 0
+        for file_index, offset_in_file, n in self._segments(offset_in_torrent,
+                                                            len(buf)):
+            ds.append(self._diskio.run('write', self._locks[file_index],
+                                       self._write_segment, file_index,
+                                       offset_in_file,
+                                       buf[start:start+n]))
+            start += n
+
+        d = gatherResults(ds, consumeErrors=True)
+        pending = self._pending.setdefault(piece_index, [])
+        pending.append(d)
+
+        def success(flush_times):
+            for flush_time in flush_times:
+                _flush_seconds.observe(flush_time)
+            _bytes_written.value += len(buf)
+
+        def failure(failure):
+            self._failed.add(piece_index)
+            logger.error("Unable to write block {}:{} of {}: {}"
+                         .format(piece_index, offset_in_piece,
+                                 self._metainfo.name,
+                                 failure.value.subFailure.getErrorMessage()))
+
+        def done(_):
+            self._account.release('write', len(buf))
+            pending.remove(d)
+            if pending == [] and self._pending.get(piece_index) is pending:
+                del self._pending[piece_index]
+
+        return d.addCallbacks(success, failure).addCallback(done)
+
+    def _write_segment(self, file_index, offset_in_file, buf):
+        # Runs in the thread pool.  Returns the time taken by the flush, which
+        # empties Python's buffer into the operating system's without fsync.
+        fd = self._open(file_index)
         fd.seek(offset_in_file)
-        if len(buf) <= file_length - offset_in_file:
-            fd.write(buf)
-            fd.flush()
-        else:
-            to_write = file_length - offset_in_file
-            fd.write(buf[:to_write])
-            fd.flush()
-            self.write_block(piece_index, offset_in_piece + to_write,
-                             buf[to_write:], file_index+1)
+        fd.write(buf)
+        start = time.time()
+        fd.flush()
+        return time.time() - start
+
+    def written(self, piece_index):
+        """
+        written() returns a deferred which fires once every block of the
+        piece which has been submitted so far has been written or fails with
+        an IOError if any of them could not be written.
+        """
+        def check(_):
+            if piece_index in self._failed:
+                self._failed.discard(piece_index)
+                raise IOError("Unable to write piece {}".format(piece_index))
+
+        pending = self._pending.get(piece_index, [])
+        return DeferredList(list(pending)).addCallback(check)
@@ -26,11 +26,18 @@ next part of the message expected.
 
 A readerwriter must implement set_receiver(), unset_receiver() and tx_bytes()
 
+The eight reserved bytes of the handshake advertise the extensions to the peer
+wire protocol which a peer supports.  Each extension is identified by a byte
+and a bit within that byte.  make_reserved() builds the reserved bytes for a
+set of extensions and supports() tells whether the reserved bytes received
+from a peer advertise an extension.
+
 Right now, the HandshakeTranslor reports the handshake after it has received
 the peer_id but documentation seems to indicate it should do this right after
 receiving the info_hash.
 """
 
+import lagmonitor
 import logging
 import struct
 
@@ -39,6 +46,33 @@ logger = logging.getLogger('bt.handshaketranslator')
 _BUFFER_SIZE = 48
 _LENGTH_LEN = 1
 _REST_LEN = 48
+_RESERVED_LEN = 8
+
+# The Fast Extension (BEP 6)
+FAST_EXTENSION = (7, 0x04)
+
+# The Extension Protocol (BEP 10)
+EXTENSION_PROTOCOL = (5, 0x10)
+
+
+def make_reserved(*extensions):
+    """
+    make_reserved() returns the reserved bytes of a handshake which
+    advertise the specified extensions.
+    """
+    reserved = bytearray(_RESERVED_LEN)
+    for index, mask in extensions:
+        reserved[index] |= mask
+    return str(reserved)
+
+
+def supports(reserved, extension):
+    """
+    supports() returns whether the reserved bytes of a handshake advertise the
+    specified extension.
+    """
+    index, mask = extension
+    return bool(ord(reserved[index]) & mask)
 
 
 class HandshakeTranslator(object):
@@ -80,6 +114,7 @@ class HandshakeTranslator(object):
     def get_rx_buffer(self):
         return self._view[self._bytes_received:], self._bytes_needed
 
+    @lagmonitor.watch('HandshakeTranslator.rx_bytes')
     def rx_bytes(self, n):
         self._bytes_received += n
         self._bytes_needed -= n
@@ -121,6 +156,6 @@ class HandshakeTranslator(object):
         if self._readerwriter is not None:
             bp = list('BitTorrent protocol')
             self._readerwriter.tx_bytes(struct.pack('B19c', 19, *bp))
-            self._readerwriter.tx_bytes(struct.pack('8B', *([0]*8)))
+            self._readerwriter.tx_bytes(reserved)
             self._readerwriter.tx_bytes(info_hash)
             self._readerwriter.tx_bytes(peer_id)
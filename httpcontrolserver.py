@@ -6,11 +6,220 @@ sending the appropriate HTTP response.
 """
 
 import json
+import logging
+import profiler
+import tracer
 
 from commands import MsgError
 from klein import Klein
+from twisted.internet.defer import CancelledError, maybeDeferred, succeed
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
 from twisted.web.static import File
 
+logger = logging.getLogger('bt.httpcontrolserver')
+
+_HEARTBEAT = 15
+
+# The number of bytes of a file read from the client at a time when serving
+# it, which must be small enough to be read from a worker over AMP
+_READ_SIZE = 2**15
+
+
+def _parse_range(header, length):
+    # Returns the offsets at which the byte range requested by a Range header
+    # starts and ends (exclusive) or None if the whole file should be served
+    # because there is no header or it isn't a single valid byte range.
+    # Raises a ValueError if the range can't be satisfied.
+    if header is None or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first == '':
+            # A suffix range asks for the last bytes of the file
+            start, end = length - min(int(last), length), length
+        else:
+            start = int(first)
+            end = int(last) + 1 if last != '' else length
+    except ValueError:
+        return None
+
+    if start >= length:
+        raise ValueError("Unsatisfiable range")
+    if end <= start:
+        return None
+    return start, min(end, length)
+
+
+class _RangeProducer(object):
+    """
+    A _RangeProducer writes a range of a file of a torrent to a request,
+    reading _READ_SIZE bytes at a time from the client, which supplies them
+    once the pieces they belong to have been downloaded.  It stops reading
+    while the transport's buffer is full.
+    """
+
+    def __init__(self, client, key, file_index, request, start, end):
+        self._client = client
+        self._key = key
+        self._file_index = file_index
+        self._request = request
+        self._offset = start
+        self._end = end
+
+        self._paused = False
+        self._stopped = False
+        self._producing = False
+        self._reading = None
+
+    def start(self):
+        self._request.registerProducer(self, True)
+        self._request.notifyFinish().addErrback(
+            lambda _: self.stopProducing())
+        self._produce()
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def resumeProducing(self):
+        self._paused = False
+        self._produce()
+
+    def stopProducing(self):
+        self._stopped = True
+        if self._reading is not None:
+            self._reading.cancel()
+
+    def _produce(self):
+        # Reads which complete right away are handled by this loop rather
+        # than recursively so that serving a downloaded file doesn't exhaust
+        # the stack
+        if self._producing:
+            return
+
+        self._producing = True
+        try:
+            while (not self._paused and not self._stopped and
+                   self._reading is None):
+                if self._offset >= self._end:
+                    self._stopped = True
+                    self._request.unregisterProducer()
+                    self._request.finish()
+                    break
+
+                length = min(_READ_SIZE, self._end - self._offset)
+                self._reading = maybeDeferred(self._client.read_file,
+                                              self._key, self._file_index,
+                                              self._offset, length)
+                self._reading.addCallbacks(self._read, self._failed)
+        finally:
+            self._producing = False
+
+    def _read(self, data):
+        self._reading = None
+        if self._stopped:
+            return
+        self._offset += len(data)
+        self._request.write(data)
+        self._produce()
+
+    def _failed(self, failure):
+        self._reading = None
+        if self._stopped or failure.check(CancelledError):
+            return
+
+        # The headers have already been sent, so the only way left to report
+        # the error is to cut the response short
+        logger.error("Can't serve file {} of {}: {}"
+                     .format(self._file_index, self._key,
+                             failure.getErrorMessage()))
+        self._stopped = True
+        self._request.unregisterProducer()
+        self._request.transport.loseConnection()
+
+
+class _FileStream(Resource):
+    """
+    A _FileStream is a resource which serves the contents of a file of a
+    torrent, or the byte range of them requested in a Range header, as the
+    pieces they belong to are downloaded.
+    """
+    isLeaf = True
+
+    def __init__(self, client, key, file_index, length):
+        Resource.__init__(self)
+        self._client = client
+        self._key = key
+        self._file_index = file_index
+        self._length = length
+
+    def render_GET(self, request):
+        request.setHeader('Accept-Ranges', 'bytes')
+        request.setHeader('Content-Type', 'application/octet-stream')
+
+        try:
+            byte_range = _parse_range(request.getHeader('range'),
+                                      self._length)
+        except ValueError:
+            request.setResponseCode(416)
+            request.setHeader('Content-Range',
+                              "bytes */{}".format(self._length))
+            return ''
+
+        if byte_range is None:
+            start, end = 0, self._length
+        else:
+            start, end = byte_range
+            request.setResponseCode(206)
+            request.setHeader('Content-Range', "bytes {}-{}/{}".format(
+                start, end - 1, self._length))
+
+        request.setHeader('Content-Length', str(end - start))
+        if start == end:
+            return ''
+
+        _RangeProducer(self._client, self._key, self._file_index, request,
+                       start, end).start()
+        return NOT_DONE_YET
+
+
+class _EventStream(Resource):
+    """
+    An _EventStream is a resource which subscribes to status updates from the
+    client and sends each one as a server-sent event for as long as the
+    connection stays open.
+    """
+    isLeaf = True
+
+    def __init__(self, client, interval):
+        Resource.__init__(self)
+        self._client = client
+        self._interval = interval
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/event-stream')
+        request.setHeader('Cache-Control', 'no-cache')
+
+        def send(deltas):
+            if deltas:
+                request.write("event: status\ndata: {}\n\n"
+                              .format(json.dumps(deltas)))
+            else:
+                # A comment keeps the connection open
+                request.write(":\n\n")
+
+        try:
+            subscription = self._client.subscribe(send, self._interval,
+                                                  _HEARTBEAT)
+        except MsgError as err:
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.message))
+
+        request.notifyFinish().addBoth(lambda _: subscription.cancel())
+        return NOT_DONE_YET
+
 
 class HTTPControlServer(object):
     app = Klein()
@@ -37,6 +246,30 @@ class HTTPControlServer(object):
         """
         return json.dumps(self._client.get_torrents())
 
+    @app.route('/events')
+    def events(self, request):
+        """
+        The route handler for get requests to /events responds with a stream
+        of server-sent events.  The data of the first status event is a json
+        formatted string which represents a dictionary containing the status
+        of each torrent keyed by info hash: its name, state, percent
+        downloaded, download and upload rates, numbers of peers and snubbed
+        peers and bytes of block data held in memory.  Subsequent status
+        events, sent at most once every interval seconds (1 by default),
+        contain only the fields which have changed, with null for torrents
+        which are no longer being handled.  If the interval is invalid, it
+        responds with a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        try:
+            interval = float(request.args.get('interval', ['1'])[0])
+        except ValueError as err:
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return _EventStream(self._client, interval)
+
     @app.route('/add', methods=['POST'])
     def add(self, request):
         """
@@ -66,15 +299,61 @@ class HTTPControlServer(object):
                               callbackArgs=(request, requestid),
                               errbackArgs=(request, requestid)))
 
+    @app.route('/add/bulk', methods=['POST'])
+    def add_bulk(self, request):
+        """
+        The route handler for post requests to /add/bulk asks the client to
+        start handling every torrent specified by a filename argument (which
+        may be repeated) and every torrent file in the directory specified by
+        the directory argument, initializing at most concurrency torrents at a
+        time.  It streams a response consisting of a json formatted string on
+        a line of its own for each torrent as soon as it has been added,
+        representing a dictionary containing the filename, key, name and an
+        error message, which is empty on success.  The last line represents a
+        dictionary containing the numbers of torrents added and failed.  If
+        the arguments are invalid, it responds with a 400 status code along
+        with a json formatted string containing the error message.
+        """
+        filenames = request.args.get('filename', [])
+        directory = request.args.get('directory', [None])[0]
+        finished = []
+
+        request.notifyFinish().addBoth(finished.append)
+
+        def result(outcome):
+            # Stop streaming if the requestor has gone away
+            if not finished:
+                request.write(json.dumps(outcome) + "\n")
+
+        def done((added, failed)):
+            return json.dumps(dict(added=added, failed=failed)) + "\n"
+
+        try:
+            kwargs = {}
+            if 'concurrency' in request.args:
+                kwargs['concurrency'] = int(request.args['concurrency'][0])
+            d = self._client.add_torrents(filenames, directory, result=result,
+                                          **kwargs)
+        except (ValueError, MsgError) as err:
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        request.setHeader('Content-Type', 'application/x-ndjson')
+        return d.addCallback(done)
+
     @app.route('/status')
     def status(self, request):
         """
         The route handler for get requests to /status asks the client for the
         status of the torrent with the supplied key.  It responds with a json
-        formatted string which represents status information about the torrent,
-        currently only the percent downloaded.  If the client is not handling
-        a torrent with the specified key, it responds with a 400 status code
-        along with a json formatted string containing the error message.
+        formatted string which represents status information about the torrent:
+        the percent downloaded, the download and upload rates in bytes per
+        second, the number of peers and snubbed peers and the number of bytes
+        of block data held in memory.  If the client is not
+        handling a torrent with the specified key, it responds with a 400
+        status code along with a json formatted string containing the error
+        message.
         """
         key = request.args.get('key', [""])[0]
         request.setHeader('Content-Type', 'application/json')
@@ -87,6 +366,329 @@ class HTTPControlServer(object):
 
         return json.dumps(status)
 
+    @app.route('/peers')
+    def peers(self, request):
+        """
+        The route handler for get requests to /peers asks the client for
+        transfer statistics about each peer of the torrent with the supplied
+        key.  It responds with a json formatted string which represents a
+        list of dictionaries containing the address, download and upload rates,
+        bytes transferred, numbers of pieces which passed and failed the hash
+        check, number of pieces it has been found to have sent bad data for,
+        times of last activity and whether the peer is snubbed or is a web
+        seed.  If the client is not handling a torrent with the specified
+        key, it responds with a 400 status code along with a json formatted
+        string containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        def success(peers):
+            return json.dumps(peers)
+
+        def failure(err):
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.getErrorMessage()))
+
+        # The peers of a torrent hosted by a worker arrive later
+        return (maybeDeferred(self._client.get_peers, key)
+                .addCallbacks(success, failure))
+
+    @app.route('/files')
+    def files(self, request):
+        """
+        The route handler for get requests to /files responds with a json
+        formatted string which represents a list of dictionaries containing
+        the path and length of each file of the torrent with the supplied key.
+        If the client is not handling a torrent with the specified key, it
+        responds with a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        def success(files):
+            return json.dumps(files)
+
+        def failure(err):
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.getErrorMessage()))
+
+        return (maybeDeferred(self._client.get_files, key)
+                .addCallbacks(success, failure))
+
+    @app.route('/file')
+    def file(self, request):
+        """
+        The route handler for get requests to /file responds with the
+        contents of the file with the supplied index (0 by default) of the
+        torrent with the supplied key, or the byte range of them requested in
+        a Range header, sending each part as soon as the pieces it belongs to
+        have been downloaded.  Unless the stream argument is 0, it turns on
+        streaming of the file so that the pieces just ahead of the part being
+        read are downloaded first.  If the client is not handling a torrent
+        with the specified key or the index is invalid, it responds with a 400
+        status code along with a json formatted string containing the error
+        message.  If the range can't be satisfied, it responds with a 416
+        status code.
+        """
+        key = request.args.get('key', [""])[0]
+
+        def failure(err):
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.getErrorMessage()))
+
+        try:
+            index = int(request.args.get('index', ['0'])[0])
+            stream = int(request.args.get('stream', ['1'])[0])
+        except ValueError as err:
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        def found(files):
+            if not 0 <= index < len(files):
+                raise MsgError("Invalid file index: {}".format(index))
+            if stream:
+                d = maybeDeferred(self._client.set_streaming, key, True,
+                                  index)
+            else:
+                d = succeed(None)
+            return d.addCallback(lambda _: _FileStream(
+                self._client, key, index, files[index]['length']))
+
+        return (maybeDeferred(self._client.get_files, key)
+                .addCallback(found).addErrback(failure))
+
+    @app.route('/stream', methods=['POST'])
+    def stream(self, request):
+        """
+        The route handler for post requests to /stream turns streaming of the
+        torrent with the supplied key on or off depending on whether the
+        enable argument is 1 or 0.  If the file argument is supplied, only
+        that file is streamed.  While a torrent is streamed, the pieces just
+        ahead of the most recent read from /file are downloaded first.  It
+        responds with an empty json object or, if the arguments are invalid,
+        a 400 status code along with a json formatted string containing the
+        error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        def failure(err):
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.getErrorMessage()))
+
+        try:
+            enable = int(request.args.get('enable', ['1'])[0])
+            file_index = request.args.get('file', [None])[0]
+            if file_index is not None:
+                file_index = int(file_index)
+        except ValueError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return (maybeDeferred(self._client.set_streaming, key, bool(enable),
+                              file_index)
+                .addCallbacks(lambda _: json.dumps({}), failure))
+
+    @app.route('/priority', methods=['POST'])
+    def priority(self, request):
+        """
+        The route handler for post requests to /priority sets the priority of
+        files of the torrent with the supplied key to the priority argument:
+        skip, low, normal or high.  The file argument, which may be repeated,
+        is the index of a file to set.  If it is not supplied, every file is
+        set.  Only the pieces of files which are not skipped are downloaded.
+        It responds with an empty json object or, if the arguments are
+        invalid, a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        priority = request.args.get('priority', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        def failure(err):
+            request.setResponseCode(400)
+            return json.dumps(dict(message=err.getErrorMessage()))
+
+        try:
+            file_indices = [int(index) for index
+                            in request.args.get('file', [])]
+        except ValueError as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return (maybeDeferred(self._client.set_priority, key, priority,
+                              file_indices or None)
+                .addCallbacks(lambda _: json.dumps({}), failure))
+
+    @app.route('/queue', methods=['GET'])
+    def queue(self, request):
+        """
+        The route handler for get requests to /queue responds with a json
+        formatted string which represents a dictionary containing the limits
+        of the queue on active downloads, active seeds and connections and a
+        list of dictionaries containing the key, name, position, state
+        (downloading, seeding, queued or lost), percent downloaded and number
+        of connections granted of each torrent in queue order.
+        """
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self._client.get_queue())
+
+    @app.route('/queue/move', methods=['POST'])
+    def queue_move(self, request):
+        """
+        The route handler for post requests to /queue/move moves the torrent
+        with the supplied key to the supplied position in the queue, counting
+        from 0.  It responds with an empty json object or, if the arguments
+        are invalid, a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        key = request.args.get('key', [""])[0]
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            position = int(request.args.get('position', [''])[0])
+            self._client.move_torrent(key, position)
+        except (ValueError, MsgError) as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return json.dumps({})
+
+    @app.route('/queue/limits', methods=['POST'])
+    def queue_limits(self, request):
+        """
+        The route handler for post requests to /queue/limits changes the
+        limits of the queue given by the downloads, seeds and connections
+        arguments, each of which is optional.  It responds with a json
+        formatted string which represents the limits or, if the arguments are
+        invalid, a 400 status code along with a json formatted string
+        containing the error message.
+        """
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            kwargs = {name: int(request.args[name][0])
+                      for name in ('downloads', 'seeds', 'connections')
+                      if name in request.args}
+            limits = self._client.set_queue_limits(**kwargs)
+        except (ValueError, MsgError) as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return json.dumps(limits)
+
+    @app.route('/metrics')
+    def metrics(self, request):
+        """
+        The route handler for get requests to /metrics responds with the
+        current value of every metric the client and its workers record,
+        summed over the processes, in the Prometheus text exposition format.
+        """
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self._client.get_metrics()
+
+    @app.route('/trace', methods=['GET'])
+    def trace_status(self, request):
+        """
+        The route handler for get requests to /trace responds with a json
+        formatted string which represents the state of the tracer: whether it
+        is enabled, the sample rate, the capacity of the ring buffers and the
+        number of records they hold, counting those of the workers.
+        """
+        request.setHeader('Content-Type', 'application/json')
+        return self._client.get_tracing().addCallback(json.dumps)
+
+    @app.route('/trace', methods=['POST'])
+    def trace(self, request):
+        """
+        The route handler for post requests to /trace turns tracing on or off
+        depending on whether the enable argument is 1 or 0.  When turning
+        tracing on, the optional sample argument specifies that one out of
+        every sample events should be recorded.  It responds with a json
+        formatted string which represents the state of the tracer or, if the
+        arguments are invalid, a 400 status code along with a json formatted
+        string containing the error message.
+        """
+        request.setHeader('Content-Type', 'application/json')
+
+        try:
+            enable = int(request.args.get('enable', ['1'])[0])
+            sample = int(request.args.get('sample', ['1'])[0])
+            d = self._client.set_tracing(enable, sample)
+        except (ValueError, MsgError) as err:
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        return d.addCallback(json.dumps)
+
+    @app.route('/trace/dump')
+    def trace_dump(self, request):
+        """
+        The route handler for get requests to /trace/dump responds with the
+        contents of the trace ring buffers of the client and its workers,
+        oldest record first.  By default, the raw binary records are sent.
+        If the format argument is json, it responds with a json formatted
+        string which represents a list of decoded records, each naming the
+        worker which recorded it, instead.
+        """
+        d = self._client.get_trace()
+
+        if request.args.get('format', ['binary'])[0] == 'json':
+            request.setHeader('Content-Type', 'application/json')
+            return d.addCallback(lambda data: json.dumps(tracer.decode(data)))
+
+        request.setHeader('Content-Type', 'application/octet-stream')
+        return d
+
+    @app.route('/lag')
+    def lag(self, request):
+        """
+        The route handler for get requests to /lag responds with a json
+        formatted string which represents a summary of the lag of the reactors
+        of the client and its workers: the number of turns measured, the mean,
+        median, 99th percentile and maximum lag in seconds, the number of slow
+        turns and the most recent slow turns and slow calls along with the
+        callbacks responsible and the workers they happened in.
+        """
+        request.setHeader('Content-Type', 'application/json')
+        return self._client.get_lag().addCallback(json.dumps)
+
+    @app.route('/profile')
+    def profile(self, request):
+        """
+        The route handler for get requests to /profile profiles the client and
+        its workers for the number of seconds given by the duration argument
+        (10 by default) and then responds with the result.  The mode argument
+        selects the profiler: sample (the default) responds with collapsed
+        stacks for flame graphs, rooted at the process they were sampled in,
+        and cprofile responds with a pstats report for each process or, if
+        the format argument is pstats, with the raw stats of all of them
+        added together.  If the arguments are
+        invalid or a profile is already being taken, it responds with a 400
+        status code along with a json formatted string containing the error
+        message.
+        """
+        mode = request.args.get('mode', ['sample'])[0]
+        format = request.args.get('format', [None])[0]
+
+        try:
+            duration = float(request.args.get('duration', ['10'])[0])
+            d = self._client.profile(duration, mode, format)
+        except (ValueError, MsgError) as err:
+            request.setHeader('Content-Type', 'application/json')
+            request.setResponseCode(400)
+            return json.dumps(dict(message=str(err)))
+
+        if format == 'pstats':
+            request.setHeader('Content-Type', 'application/octet-stream')
+        else:
+            request.setHeader('Content-Type', 'text/plain')
+        return d
+
     @app.route('/quit', methods=['POST'])
     def quit(self, request):
         """
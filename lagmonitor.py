@@ -0,0 +1,218 @@
+"""
+The lag monitor measures how long the reactor takes to get around to running
+a delayed call after it becomes due.  While one callback blocks the reactor,
+for example by sorting every piece, iterating over a large bitfield or waiting
+for a flush to reach the disk, no other peer connection is serviced and the
+lag grows by the time the callback takes.
+
+Once start() has been called, the monitor schedules a delayed call every
+interval seconds and records the difference between the time it runs and the
+time it was due in the bt_reactor_lag_seconds histogram.  A turn whose lag is
+at least threshold seconds is counted as a slow turn.
+
+Functions which are suspected of blocking the reactor are decorated with
+watch(), which times each call.  Time spent in a watched function which is
+called from another watched function is charged to the inner function only, so
+the function charged with the most time since the previous check, adding up
+all of its calls, is the one which actually did the work.  That function and
+its total are recorded along with each slow turn.  Each call which takes at
+least threshold seconds on its own is also counted per function in
+bt_slow_callbacks_total and kept in a short history.
+
+Example:
+
+    class FileMgr(object):
+        @lagmonitor.watch('FileMgr.write_block')
+        def write_block(self, piece_index, offset_in_piece, buf):
+            ...
+
+status() returns a summary of the lag along with the recent slow turns and
+slow calls.  Each worker process (see worker.py) runs its own monitor and
+merge() combines the summaries of the client and its workers.
+"""
+
+import collections
+import functools
+import logging
+import metrics
+import time
+
+logger = logging.getLogger('bt.lagmonitor')
+
+_INTERVAL = 0.05
+_THRESHOLD = 0.1
+_HISTORY = 50
+
+_lag = metrics.histogram('bt_reactor_lag_seconds',
+                         "Delay between a reactor call becoming due and "
+                         "running",
+                         buckets=(.001, .0025, .005, .01, .025, .05, .1, .25,
+                                  .5, 1, 2.5, 5, 10))
+_slow_turns = metrics.counter('bt_reactor_slow_turns_total',
+                              "Reactor turns whose lag exceeded the threshold")
+_slow_calls = metrics.counter('bt_slow_callbacks_total',
+                              "Watched calls which exceeded the threshold",
+                              ('callback',))
+
+threshold = _THRESHOLD
+
+_reactor = None
+_interval = _INTERVAL
+_call = None
+_due = None
+_max_lag = 0
+
+# _stack holds, for each watched call in progress, the time spent so far in
+# the watched calls made from it
+_stack = []
+
+# _charged holds, for each watched function, the total time charged to it
+# since the previous check
+_charged = collections.defaultdict(float)
+
+_recent_turns = collections.deque(maxlen=_HISTORY)
+_recent_calls = collections.deque(maxlen=_HISTORY)
+
+
+def watch(name):
+    """
+    watch() returns a decorator which times each call of the decorated
+    function under the specified name.
+    """
+    def decorator(function):
+        counter = _slow_calls.labels(name)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            _stack.append(0)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                own = elapsed - _stack.pop()
+                if _stack:
+                    _stack[-1] += elapsed
+
+                _charged[name] += own
+
+                if own >= threshold:
+                    counter.value += 1
+                    _recent_calls.append({'time': start,
+                                          'callback': name,
+                                          'seconds': own})
+
+        return wrapper
+    return decorator
+
+
+def start(reactor, interval=_INTERVAL, slow=_THRESHOLD):
+    """
+    start() starts measuring the lag of the reactor every interval seconds.
+    Turns and watched calls which take at least slow seconds are recorded.
+    """
+    global _reactor, _interval, threshold
+
+    if interval <= 0 or slow <= 0:
+        raise ValueError("Interval and threshold must be positive")
+
+    stop()
+    _reactor = reactor
+    _interval = interval
+    threshold = slow
+    _schedule()
+
+
+def stop():
+    global _call
+    if _call is not None and _call.active():
+        _call.cancel()
+    _call = None
+
+
+def running():
+    return _call is not None
+
+
+def _schedule():
+    global _call, _due
+    _due = time.time() + _interval
+    _call = _reactor.callLater(_interval, _check)
+
+
+def _check():
+    global _max_lag
+
+    lag = max(0, time.time() - _due)
+    _lag.observe(lag)
+    _max_lag = max(_max_lag, lag)
+
+    if lag >= threshold:
+        name, seconds = None, 0
+        for charged_name, charged_seconds in _charged.iteritems():
+            if charged_seconds > seconds:
+                name, seconds = charged_name, charged_seconds
+        _slow_turns.value += 1
+        _recent_turns.append({'time': _due,
+                              'lag': lag,
+                              'callback': name,
+                              'callback_seconds': seconds})
+        logger.warning("Reactor lagged {:.3f}s, most time in watched calls: "
+                       "{} ({:.3f}s)".format(lag, name, seconds))
+
+    _charged.clear()
+    _schedule()
+
+
+def status():
+    """
+    status() returns a dictionary summarizing the lag measured so far:
+    whether the monitor is running, the interval and threshold, the number
+    of turns measured, the mean, median, 99th percentile and maximum lag in
+    seconds, the number of slow turns, the most recent slow turns with the
+    watched function charged with the most time in total during each and the
+    most recent slow calls.  Percentiles are upper bounds given by the
+    buckets of the histogram, capped at the maximum.
+    """
+    count = _lag.count()
+    return {'running': running(),
+            'interval': _interval,
+            'threshold': threshold,
+            'turns': count,
+            'mean': _lag.sum / count if count else 0,
+            'p50': min(_lag.quantile(0.5), _max_lag),
+            'p99': min(_lag.quantile(0.99), _max_lag),
+            'max': _max_lag,
+            'slow_turns': _slow_turns.value,
+            'recent_slow_turns': list(_recent_turns),
+            'recent_slow_calls': list(_recent_calls)}
+
+
+def merge(statuses):
+    """
+    merge() combines the summaries returned by status() in several processes,
+    supplied as a list of (worker, summary) pairs where worker is None for
+    the client, into one summary.  Turns are counted across the processes
+    and the percentiles are the largest of the processes' percentiles, which
+    are still upper bounds.  The recent slow turns and calls of all the
+    processes are given the worker in which they happened and only the most
+    recent are kept.
+    """
+    merged = dict(statuses[0][1])
+    turns = sum(status['turns'] for _, status in statuses)
+    merged.update(
+        running=any(status['running'] for _, status in statuses),
+        turns=turns,
+        mean=(sum(status['mean'] * status['turns']
+                  for _, status in statuses) / turns if turns else 0),
+        p50=max(status['p50'] for _, status in statuses),
+        p99=max(status['p99'] for _, status in statuses),
+        max=max(status['max'] for _, status in statuses),
+        slow_turns=sum(status['slow_turns'] for _, status in statuses))
+
+    for name in ('recent_slow_turns', 'recent_slow_calls'):
+        recent = [dict(entry, worker=worker) for worker, status in statuses
+                  for entry in status[name]]
+        recent.sort(key=lambda entry: entry['time'])
+        merged[name] = recent[-_HISTORY:]
+    return merged
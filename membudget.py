@@ -0,0 +1,148 @@
+"""
+The memory budget bounds the number of bytes of block data that the process
+holds at any one time: the buffers into which peer wire messages are received,
+the blocks waiting to be written to disk and the data read from disk which
+has not yet been handed over.  There is a single budget for the process,
+budget, whose limit is set with set_limit().  Its usage is tracked through
+an Account for each torrent so that the usage can be reported per torrent.
+
+Memory is charged to an account when it is allocated and released when it is
+no longer needed.  The budget pushes back in two steps.  Once the usage
+passes _PRESSURE of the limit, the budget is under pressure and the
+TorrentMgrs keep only one request outstanding with each peer instead of a
+full pipeline.  Once the usage reaches the limit, the budget is exhausted and
+it pauses reading from the transports of every peer connection so that no
+more blocks arrive.  Reading is resumed once the usage falls to _RESUME of
+the limit or once nothing but receive buffers is charged, since the partly
+received messages of paused connections can't be completed while they are
+paused.  Transports register themselves with the budget when they connect.
+
+The usage of each kind of memory and the number of times reading was paused
+are recorded in the metrics registry.
+"""
+
+import logging
+import metrics
+
+logger = logging.getLogger('bt.membudget')
+
+_LIMIT = 256 * 2**20
+_PRESSURE = 0.5
+_RESUME = 0.75
+
+KINDS = ('receive', 'write', 'read')
+
+_usage = metrics.gauge('bt_memory_bytes',
+                       "Bytes of block data held by the process",
+                       ('kind',))
+_pauses = metrics.counter('bt_memory_pauses_total',
+                          "Times reading from peers was paused because the "
+                          "memory budget was exhausted")
+
+
+class Account(object):
+    def __init__(self, budget, name):
+        self._budget = budget
+        self.name = name
+        self.used = 0
+
+    def charge(self, kind, n):
+        self.used += n
+        self._budget._charge(kind, n)
+
+    def release(self, kind, n):
+        self.used -= n
+        self._budget._release(kind, n)
+
+
+class MemoryBudget(object):
+    def __init__(self, limit=_LIMIT):
+        self._limit = limit
+        self._used = 0
+
+        # _kinds maps each kind of memory to the number of bytes of it which
+        # are charged and to its gauge
+        self._kinds = {kind: 0 for kind in KINDS}
+        self._gauges = {kind: _usage.labels(kind) for kind in KINDS}
+
+        # _transports is the set of transports of peer connections and
+        # _paused is whether reading from them is paused
+        self._transports = set()
+        self._paused = False
+
+    def set_limit(self, limit):
+        if limit < 1:
+            raise ValueError("Memory limit must be at least 1 byte")
+        self._limit = limit
+        self._check()
+
+    def limit(self):
+        return self._limit
+
+    def used(self):
+        return self._used
+
+    def account(self, name):
+        return Account(self, name)
+
+    def pressure(self):
+        """
+        pressure() returns whether the usage has passed the point at which
+        request pipelines are shortened.
+        """
+        return self._used > self._limit * _PRESSURE
+
+    def exhausted(self):
+        return self._paused
+
+    def register(self, transport):
+        self._transports.add(transport)
+        if self._paused:
+            transport.pauseProducing()
+
+    def unregister(self, transport):
+        self._transports.discard(transport)
+
+    def _charge(self, kind, n):
+        self._used += n
+        self._kinds[kind] += n
+        self._gauges[kind].value += n
+        if not self._paused and self._used >= self._limit:
+            self._pause()
+
+    def _release(self, kind, n):
+        self._used -= n
+        self._kinds[kind] -= n
+        self._gauges[kind].value -= n
+        if self._paused:
+            self._check()
+
+    def _check(self):
+        if self._paused:
+            if (self._used <= self._limit * _RESUME or
+                    self._used == self._kinds['receive']):
+                self._resume()
+        elif self._used >= self._limit:
+            self._pause()
+
+    def _pause(self):
+        logger.info("Memory budget of {} bytes exhausted, pausing {} peers"
+                    .format(self._limit, len(self._transports)))
+        _pauses.value += 1
+        self._paused = True
+        for transport in self._transports:
+            transport.pauseProducing()
+
+    def _resume(self):
+        logger.info("Memory budget has room again, resuming {} peers"
+                    .format(len(self._transports)))
+        self._paused = False
+        for transport in self._transports:
+            transport.resumeProducing()
+
+
+budget = MemoryBudget()
+
+
+def set_limit(limit):
+    budget.set_limit(limit)
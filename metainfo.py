@@ -61,6 +61,14 @@ class Metainfo(object):
     def announce_list(self):
         return self._metainfo.get('announce-list', None)
 
+    @property
+    def url_list(self):
+        # The web seeds (BEP 19), which may be given as a single url
+        urls = self._metainfo.get('url-list', [])
+        if isinstance(urls, str):
+            urls = [urls]
+        return [url for url in urls if isinstance(url, str) and url]
+
     @property
     def creation_date(self):
         return self._metainfo.get('creation date', None)
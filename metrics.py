@@ -0,0 +1,278 @@
+"""
+The metrics module keeps counters, gauges and histograms describing what the
+client is doing and renders them in the Prometheus text exposition format.
+
+Metrics are created once, usually at module level, by calling counter(),
+gauge() or histogram(), which register them with the default Registry.  A
+metric with labels has a child for each combination of label values which is
+obtained by calling labels().  Children are created on first use and cached so
+that hot paths can look up their children ahead of time and then update them
+with a single attribute increment.  An update costs about as much as an
+attribute assignment, which allows metrics to be left on in production.
+
+Example:
+
+    _blocks = metrics.counter('bt_blocks_total', "Blocks received")
+    _messages = metrics.counter('bt_messages_total', "Messages received",
+                                ('type',))
+    _choke = _messages.labels('choke')
+
+    _blocks.inc()
+    _choke.inc()
+
+Each process has its own registry.  collect() returns the values of the
+metrics of a registry in a form which can be sent to another process as json
+and merge() adds up the values collected from several processes, such as the
+client and its workers, into a new Registry which can then be rendered.
+"""
+
+import bisect
+
+_DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                    .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                              .replace('"', '\\"')
+                                              .replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric(object):
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        # _children maps a tuple of label values to the child metric for
+        # those values.  A metric without labels is its own only child.
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self
+
+    def labels(self, *values):
+        """
+        labels() returns the child of the metric for the supplied label values,
+        creating it if necessary.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError("Expected {} label values for {}"
+                             .format(len(self.labelnames), self.name))
+        if values not in self._children:
+            self._children[values] = self._child()
+        return self._children[values]
+
+    def collect(self):
+        return {'name': self.name,
+                'type': self.type,
+                'documentation': self.documentation,
+                'labelnames': list(self.labelnames),
+                'children': [[list(values), child._value()]
+                             for values, child
+                             in sorted(self._children.items())]}
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child._samples(self.name, self.labelnames, values))
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.value = 0
+        _Metric.__init__(self, name, documentation, labelnames)
+
+    def _child(self):
+        return Counter(self.name, self.documentation)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _value(self):
+        return self.value
+
+    def _add(self, value):
+        self.value += value
+
+    def _samples(self, name, labelnames, values):
+        return ["{}{} {}".format(name, _format_labels(labelnames, values),
+                                 _format_value(self.value))]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def _child(self):
+        return Gauge(self.name, self.documentation)
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=_DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        _Metric.__init__(self, name, documentation, labelnames)
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def count(self):
+        return sum(self.counts)
+
+    def collect(self):
+        collected = _Metric.collect(self)
+        collected['buckets'] = list(self.buckets)
+        return collected
+
+    def _value(self):
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+    def _add(self, value):
+        self.counts = [count + added for count, added
+                       in zip(self.counts, value['counts'])]
+        self.sum += value['sum']
+
+    def quantile(self, q):
+        """
+        quantile() returns the upper bound of the bucket containing the q
+        quantile of the observed values, 0 if nothing has been observed or
+        infinity if the quantile lies beyond the largest bucket.
+        """
+        total = self.count()
+        if total == 0:
+            return 0
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            if cumulative >= q * total:
+                return bound
+        return float('inf')
+
+    def _samples(self, name, labelnames, values):
+        lines = []
+        cumulative = 0
+        bucket_labels = labelnames + ('le',)
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                name, _format_labels(bucket_labels,
+                                     values + (_format_value(bound),)),
+                cumulative))
+        labels = _format_labels(labelnames, values)
+        lines.append("{}_sum{} {}".format(name, labels,
+                                          _format_value(self.sum)))
+        lines.append("{}_count{} {}".format(name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} is already registered"
+                             .format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        """
+        render() returns the current value of every registered metric in the
+        Prometheus text exposition format.
+        """
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+    def collect(self):
+        """
+        collect() returns a list of dictionaries, which can be converted to
+        json, holding the current value of every registered metric.
+        """
+        return [self._metrics[name].collect()
+                for name in sorted(self._metrics)]
+
+
+registry = Registry()
+
+_TYPES = {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}
+
+
+def _str(value):
+    # Values collected by another process have been through json
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def merge(collections):
+    """
+    merge() returns a new Registry holding the sum of the values of each
+    metric in the supplied results of Registry.collect().  A metric missing
+    from some of them is summed over the others.
+    """
+    merged = Registry()
+    for collection in collections:
+        for collected in collection:
+            name = _str(collected['name'])
+            if name in merged._metrics:
+                metric = merged.get(name)
+            else:
+                kwargs = {}
+                if 'buckets' in collected:
+                    kwargs['buckets'] = collected['buckets']
+                metric = merged.register(_TYPES[collected['type']](
+                    name, _str(collected['documentation']),
+                    [_str(labelname) for labelname
+                     in collected['labelnames']], **kwargs))
+
+            for values, value in collected['children']:
+                metric.labels(*[_str(v) for v in values])._add(value)
+    return merged
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return registry.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=_DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames,
+                                       buckets))
@@ -20,24 +20,106 @@ the state is changed to Peer_to_Peer.  When a bitfield message is received in
 any state other than Bitfield_Allowed, the connection is dropped and the state
 is changed to Disconnected.
 
+The PeerProxy advertises the Fast Extension (BEP 6) in its handshake and uses
+it when the peer advertises it too.  A have all or have none message then
+takes the place of the bitfield and is subject to the same rules, and this
+client sends one instead of its bitfield when it has all or none of the
+pieces.  With the Fast Extension, a choke no longer discards the outstanding
+requests.  The peer rejects each request it won't serve instead, so that the
+client can reassign it right away, and it may name pieces which it will serve
+even while choking.  Fast Extension messages from a peer which didn't
+advertise the extension cause the connection to be dropped.  Suggestions are
+accepted but ignored.
+
+The PeerProxy also advertises the Extension Protocol (BEP 10).  When the peer
+supports it too, the PeerProxy sends an extended handshake after its bitfield
+offering Peer Exchange (ut_pex) unless the torrent is private.  The addresses
+which the peer sends in ut_pex messages are passed on to the client, and the
+client supplies the addresses of its own connected peers through
+exchange_peers(), which sends the peer only the addresses added and dropped
+since the last ut_pex message.
+
 The PeerProxy uses a translator to interpret the incoming stream of bytes into
 higher level messages and to construct outgoing messages into a stream of
 bytes.  Initially, the PeerProxy uses a HandshakeTranslator to translate the
 "handshake" protocol.  After the handshake has been established, it sets up a
-PeerWireTranslator to translate the peer wire protocol.
+PeerWireTranslator to translate the peer wire protocol, which charges the
+messages it receives to the memory budget account supplied by the client.
+
+The PeerProxy keeps moving averages of the rates at which piece data is
+downloaded from and uploaded to the peer along with the times of the most
+recent activity in each direction.  When requests to the peer have been
+outstanding for longer than the snub timeout without any piece data arriving,
+the peer is considered to be snubbing this client.  A request which is sent
+again after timing out is not counted twice.  The snubbed state is cleared as
+soon as the peer delivers a block or chokes or this client cancels its
+requests or loses interest in the peer, which discards the requests.
+
+The number of peers in each state other than Disconnected is kept in the
+metrics registry along with the number of peers which have become
+disconnected.
 
 Currently, the PeerProxy does not handle or generate keep alives at all.
 """
 
+import bencode
 import logging
+import metrics
+import socket
+import struct
 
-from handshaketranslator import HandshakeTranslator
+from handshaketranslator import EXTENSION_PROTOCOL, FAST_EXTENSION
+from handshaketranslator import HandshakeTranslator, make_reserved, supports
 from peerwiretranslator import PeerWireTranslator
 from protocoladapter import ProtocolAdapterFactory
+from ratemeter import RateMeter
 from twisted.internet.endpoints import TCP4ClientEndpoint
 
 logger = logging.getLogger('bt.peerproxy')
 
+_SNUB_TIMEOUT = 60
+_RESERVED = make_reserved(FAST_EXTENSION, EXTENSION_PROTOCOL)
+
+# Extended message ids.  The extended handshake always has id 0 while the id
+# of each extension is chosen by the peer receiving its messages.
+_EXTENDED_HANDSHAKE = 0
+_UT_PEX = 1
+
+_VERSION = "bt-twisted"
+
+# The most addresses added or dropped in one ut_pex message (BEP 11)
+_MAX_PEX_ADDRS = 50
+
+# Sent in added.f for each added address: the peer accepts connections
+_PEX_CONNECTABLE = 0x10
+
+_peers = metrics.gauge('bt_peers', "Peers in each connection state",
+                       ('state',))
+_disconnects = metrics.counter('bt_peer_disconnects_total',
+                               "Peers which have become disconnected")
+
+
+def _decode_compact(data):
+    # Returns a list of the (ip, port) addresses in a string of compact
+    # peer addresses
+    addrs = []
+    for offset in xrange(0, len(data) - len(data) % 6, 6):
+        (port,) = struct.unpack('>H', data[offset+4:offset+6])
+        addrs.append((socket.inet_ntoa(data[offset:offset+4]), port))
+    return addrs
+
+
+def _encode_compact(addrs):
+    # Returns a string of compact peer addresses, skipping addresses which
+    # are not IPv4 addresses
+    compact = []
+    for ip, port in addrs:
+        try:
+            compact.append(socket.inet_aton(ip) + struct.pack('>H', port))
+        except socket.error:
+            pass
+    return ''.join(compact)
+
 
 class PeerProxy(object):
     class _States(object):
@@ -45,19 +127,51 @@ class PeerProxy(object):
          Bitfield_Allowed, Peer_to_Peer, Disconnected) = range(6)
 
     def __init__(self, client, peer_id, addr, reactor,
-                 protocol=None, info_hash=None):
+                 protocol=None, info_hash=None, snub_timeout=_SNUB_TIMEOUT,
+                 pex=True, account=None):
         self._client = client
         self._reactor = reactor
         self._protocol = protocol
         self._info_hash = info_hash
         self._peer_id = peer_id
         self._addr = addr
+        self._snub_timeout = snub_timeout
+        self._pex = pex
+        self._account = account
+        self._state = None
 
         self._choked = True
         self._interested = False
         self._peer_choked = True
         self._peer_interested = False
 
+        # _fast is whether both ends support the Fast Extension and
+        # _allowed_fast is the set of pieces which the peer will serve even
+        # while it is choking this client
+        self._fast = False
+        self._allowed_fast = set()
+
+        # _extended is whether both ends support the Extension Protocol and
+        # _pex_id is the extended message id under which the peer accepts
+        # ut_pex messages (None if it doesn't).  _pex_sent is the set of
+        # addresses which the peer has been told about.
+        self._extended = False
+        self._pex_id = None
+        self._pex_sent = set()
+
+        # Transfer statistics.  _pending is the set of the index, begin and
+        # length of the block requests which have been sent to the peer
+        # without the block being received in return and _pending_since is
+        # the time at which the peer last made progress on those requests.
+        now = reactor.seconds()
+        self._download = RateMeter(reactor)
+        self._upload = RateMeter(reactor)
+        self._last_rx = now
+        self._last_tx = now
+        self._last_block = None
+        self._pending = set()
+        self._pending_since = now
+
         if len(peer_id) != 20:
             raise ValueError("Peer id must be 20 bytes long")
 
@@ -66,16 +180,27 @@ class PeerProxy(object):
                 raise ValueError("Info hash must be a 20 byte value")
 
             self._translator = None
+            self._set_state(self._States.Awaiting_Connection)
 
             host, port = addr
             d = (TCP4ClientEndpoint(reactor, host, port)
                  .connect(ProtocolAdapterFactory(self)))
             d.addErrback(self.connection_failed)
-
-            self._state = self._States.Awaiting_Connection
         else:
             self._setup_handshake_translator()
-            self._state = self._States.Awaiting_Handshake
+            self._set_state(self._States.Awaiting_Handshake)
+
+    def _set_state(self, state):
+        # Keep the number of peers in each state up to date.  Disconnected
+        # peers are counted by the number of disconnections since they are no
+        # longer referenced once they are disconnected.
+        if self._state in _state_gauges:
+            _state_gauges[self._state].value -= 1
+        if state in _state_gauges:
+            _state_gauges[state].value += 1
+        elif state != self._state:
+            _disconnects.value += 1
+        self._state = state
 
     def _setup_handshake_translator(self):
         self._translator = HandshakeTranslator(self, self._protocol)
@@ -89,25 +214,34 @@ class PeerProxy(object):
         if self._protocol is not None:
             self._protocol.stop()
 
-        self._state = self._States.Disconnected
+        self._set_state(self._States.Disconnected)
 
         if notify_client:
             self._client.peer_unconnected(self)
 
     def _valid_rx_state(self):
+        self._last_rx = self._reactor.seconds()
         if self._state != self._States.Peer_to_Peer:
             if self._state == self._States.Bitfield_Allowed:
-                self._state = self._States.Peer_to_Peer
+                self._set_state(self._States.Peer_to_Peer)
             else:
                 if self._state != self._States.Disconnected:
                     self._drop_connection()
                 return False
         return True
 
+    def _valid_fast_rx_state(self):
+        if not self._fast:
+            if self._state != self._States.Disconnected:
+                self._drop_connection()
+            return False
+        return self._valid_rx_state()
+
     def _valid_tx_state(self):
+        self._last_tx = self._reactor.seconds()
         if self._state != self._States.Peer_to_Peer:
             if self._state == self._States.Bitfield_Allowed:
-                self._state = self._States.Peer_to_Peer
+                self._set_state(self._States.Peer_to_Peer)
             else:
                 return False
         return True
@@ -127,16 +261,71 @@ class PeerProxy(object):
     def is_peer_interested(self):
         return self._peer_interested
 
+    def supports_fast(self):
+        return self._fast
+
+    def is_allowed_fast(self, index):
+        return index in self._allowed_fast
+
+    def is_connected(self):
+        return self._state in (self._States.Bitfield_Allowed,
+                               self._States.Peer_to_Peer)
+
+    def download_rate(self):
+        return self._download.rate()
+
+    def upload_rate(self):
+        return self._upload.rate()
+
+    def downloaded(self):
+        return self._download.total()
+
+    def uploaded(self):
+        return self._upload.total()
+
+    def last_activity(self):
+        """
+        last_activity() returns the times at which a message was last received
+        from and sent to the peer and the time at which a block was last
+        received from the peer (None if no block has been received).
+        """
+        return self._last_rx, self._last_tx, self._last_block
+
+    def is_snubbed(self):
+        return (bool(self._pending) and
+                self._reactor.seconds() - self._pending_since >=
+                self._snub_timeout)
+
+    def snub_deadline(self):
+        """
+        snub_deadline() returns the time at which the peer will be considered
+        snubbed unless a block arrives before then or None if no requests are
+        outstanding.
+        """
+        if not self._pending:
+            return None
+        return self._pending_since + self._snub_timeout
+
     # Callbacks which result from TCP4ClientEndpoint.connect()
 
     def connection_complete(self, protocol):
+        # The connection may have been dropped while it was being made
+        if self._state == self._States.Disconnected:
+            protocol.unset_receiver()
+            protocol.stop()
+            return
+
         self._protocol = protocol
         self._setup_handshake_translator()
 
-        self._translator.tx_handshake(0, self._info_hash, self._peer_id)
-        self._state = self._States.Handshake_Initiated
+        self._translator.tx_handshake(_RESERVED, self._info_hash,
+                                      self._peer_id)
+        self._set_state(self._States.Handshake_Initiated)
 
     def connection_failed(self, reason):
+        if self._state == self._States.Disconnected:
+            return
+        self._set_state(self._States.Disconnected)
         self._client.peer_unconnected(self)
 
     # Translator callbacks
@@ -154,10 +343,25 @@ class PeerProxy(object):
                 self._translator.unset_receiver()
                 self._translator.unset_readerwriter()
 
-                self._translator = PeerWireTranslator(self, self._protocol)
-                self._state = self._States.Bitfield_Allowed
-
-                self._translator.tx_bitfield(self._client.get_bitfield())
+                self._fast = supports(reserved, FAST_EXTENSION)
+                self._extended = supports(reserved, EXTENSION_PROTOCOL)
+                self._translator = PeerWireTranslator(self, self._protocol,
+                                                      self._account)
+                self._set_state(self._States.Bitfield_Allowed)
+
+                bitfield = self._client.get_bitfield()
+                if self._fast and bitfield.all():
+                    self._translator.tx_have_all()
+                elif self._fast and not bitfield.any():
+                    self._translator.tx_have_none()
+                else:
+                    self._translator.tx_bitfield(bitfield)
+
+                if self._extended:
+                    extensions = {'ut_pex': _UT_PEX} if self._pex else {}
+                    self._translator.tx_extended(
+                        _EXTENDED_HANDSHAKE,
+                        bencode.bencode({'m': extensions, 'v': _VERSION}))
 
     def rx_non_handshake(self):
         self._drop_connection()
@@ -165,18 +369,39 @@ class PeerProxy(object):
     # PeerWireTranslator callbacks
 
     def rx_bitfield(self, bitfield):
+        self._last_rx = self._reactor.seconds()
         if self._state == self._States.Bitfield_Allowed:
-            self._state = self._States.Peer_to_Peer
+            self._set_state(self._States.Peer_to_Peer)
             self._client.peer_bitfield(self, bitfield)
         else:
             self._drop_connection()
 
+    def rx_have_all(self):
+        self._last_rx = self._reactor.seconds()
+        if self._fast and self._state == self._States.Bitfield_Allowed:
+            self._set_state(self._States.Peer_to_Peer)
+            self._client.peer_has_all(self)
+        else:
+            self._drop_connection()
+
+    def rx_have_none(self):
+        self._last_rx = self._reactor.seconds()
+        if self._fast and self._state == self._States.Bitfield_Allowed:
+            self._set_state(self._States.Peer_to_Peer)
+            self._client.peer_has_none(self)
+        else:
+            self._drop_connection()
+
     def rx_keep_alive(self):
-        pass
+        self._last_rx = self._reactor.seconds()
 
     def rx_choke(self):
         if self._valid_rx_state():
             self._peer_choked = True
+            # Without the Fast Extension, a choke implicitly discards the
+            # outstanding requests.  With it, each is rejected explicitly.
+            if not self._fast:
+                self._pending.clear()
             self._client.peer_choked(self)
 
     def rx_unchoke(self):
@@ -200,18 +425,97 @@ class PeerProxy(object):
 
     def rx_request(self, index, begin, length):
         if self._valid_rx_state():
-            self._client.peer_requests(self, index, begin, length)
+            self._client.peer_request(self, index, begin, length)
 
     def rx_piece(self, index, begin, buf):
         if self._valid_rx_state():
+            self._download.update(len(buf))
+            self._last_block = self._pending_since = self._last_rx
+            self._pending.discard((index, begin, len(buf)))
             self._client.peer_sent_block(self, index, begin, buf)
 
     def rx_cancel(self, index, begin, length):
         if self._valid_rx_state():
             self._client.peer_canceled(self, index, begin, length)
 
+    def rx_suggest_piece(self, index):
+        self._valid_fast_rx_state()
+
+    def rx_reject_request(self, index, begin, length):
+        if self._valid_fast_rx_state():
+            self._pending.discard((index, begin, length))
+            self._allowed_fast.discard(index)
+            self._client.peer_rejected(self, index, begin, length)
+
+    def rx_allowed_fast(self, index):
+        if self._valid_fast_rx_state():
+            self._allowed_fast.add(index)
+            self._client.peer_allowed_fast(self, index)
+
+    def rx_extended(self, extended_id, payload):
+        if not self._extended:
+            if self._state != self._States.Disconnected:
+                self._drop_connection()
+            return
+
+        if self._valid_rx_state():
+            try:
+                message = bencode.bdecode(str(payload))
+            except bencode.BTFailure:
+                logger.debug("Invalid extended message from peer {}"
+                             .format(str(self._addr)))
+                return
+            if not isinstance(message, dict):
+                return
+
+            if extended_id == _EXTENDED_HANDSHAKE:
+                self._rx_extended_handshake(message)
+            elif extended_id == _UT_PEX and self._pex:
+                self._rx_pex(message)
+
+    def _rx_extended_handshake(self, message):
+        # A peer may send further extended handshakes to update what it
+        # supports.  An id of 0 turns an extension off.
+        extensions = message.get('m')
+        if isinstance(extensions, dict) and 'ut_pex' in extensions:
+            pex_id = extensions['ut_pex']
+            if isinstance(pex_id, int) and 0 < pex_id < 256 and self._pex:
+                self._pex_id = pex_id
+            else:
+                self._pex_id = None
+
+    def _rx_pex(self, message):
+        added = message.get('added', '')
+        if isinstance(added, str):
+            addrs = _decode_compact(added)
+            if addrs:
+                self._client.peer_exchanged(self, addrs)
+
     # Client calls
 
+    def exchange_peers(self, addrs):
+        """
+        exchange_peers() sends the peer a ut_pex message with the addresses
+        added to and dropped from the supplied list of the addresses of
+        connected peers since the last ut_pex message, provided that the peer
+        accepts ut_pex messages and something has changed.
+        """
+        if self._pex_id is None or not self._valid_tx_state():
+            return
+
+        current = set(addrs)
+        current.discard(self._addr)
+        added = list(current - self._pex_sent)[:_MAX_PEX_ADDRS]
+        dropped = list(self._pex_sent - current)[:_MAX_PEX_ADDRS]
+        if added or dropped:
+            self._pex_sent.difference_update(dropped)
+            self._pex_sent.update(added)
+            compact = _encode_compact(added)
+            self._translator.tx_extended(self._pex_id, bencode.bencode(
+                {'added': compact,
+                 'added.f': chr(_PEX_CONNECTABLE) * (len(compact) // 6),
+                 'dropped': _encode_compact(dropped)}))
+
     def drop_connection(self):
         self._drop_connection(False)
 
@@ -233,20 +537,46 @@ class PeerProxy(object):
     def not_interested(self):
         if self._valid_tx_state():
             self._interested = False
+            self._pending.clear()
             self._translator.tx_not_interested()
 
     def have(self, index):
         if self._valid_tx_state():
             self._translator.tx_have(index)
 
+    def haves(self, indices):
+        if self._valid_tx_state():
+            self._translator.tx_haves(indices)
+
     def request(self, index, begin, length):
         if self._valid_tx_state():
+            if not self._pending:
+                self._pending_since = self._last_tx
+            self._pending.add((index, begin, length))
             self._translator.tx_request(index, begin, length)
 
+    def reject_request(self, index, begin, length):
+        if self._fast and self._valid_tx_state():
+            self._translator.tx_reject_request(index, begin, length)
+
     def piece(self, index, begin, buf, offset):
         if self._valid_tx_state():
+            self._upload.update(len(buf))
             self._translator.tx_piece(index, begin, buf)
 
     def cancel(self, index, begin, length):
         if self._valid_tx_state():
+            self._pending.discard((index, begin, length))
             self._translator.tx_cancel(index, begin, length)
+
+
+_state_gauges = {PeerProxy._States.Awaiting_Handshake:
+                 _peers.labels('awaiting_handshake'),
+                 PeerProxy._States.Awaiting_Connection:
+                 _peers.labels('awaiting_connection'),
+                 PeerProxy._States.Handshake_Initiated:
+                 _peers.labels('handshake_initiated'),
+                 PeerProxy._States.Bitfield_Allowed:
+                 _peers.labels('bitfield_allowed'),
+                 PeerProxy._States.Peer_to_Peer:
+                 _peers.labels('peer_to_peer')}
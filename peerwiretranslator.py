@@ -20,6 +20,19 @@ A receiver must implement the following methods: rx_keep_alive(), rx_choke(),
 rx_unchoke(), rx_interested(), rx_not_interested, rx_bitfield(), rx_have(),
 rx_request(), rx_piece() and rx_cancel() and connection_lost().
 
+The PeerWireTranslator also translates the messages of the Fast Extension
+(BEP 6): suggest piece, have all, have none, reject request and allowed fast.
+A receiver which negotiates the Fast Extension in the handshake must also
+implement rx_suggest_piece(), rx_have_all(), rx_have_none(),
+rx_reject_request() and rx_allowed_fast().  The translator doesn't know
+whether the extension was negotiated, so it is up to the receiver to treat
+these messages as errors when it was not.
+
+Likewise, a receiver which negotiates the Extension Protocol (BEP 10) must
+implement rx_extended(), which is passed the extended message id and the
+payload of each extended message.  The payload is left for the receiver to
+decode since its format depends on the extension.
+
 On the readerwriter side, when incoming bytes are available, the readerwriter
 asks the PeerWireTranslator for a buffer to put them into and after it has
 done that, it notifies the translator that bytes have been received.  This
@@ -29,11 +42,20 @@ data to be placed in one buffer even if it is received over multiple socket
 reads.
 
 A readerwriter must implement set_receiver(), unset_receiver() and tx_bytes()
+
+When the PeerWireTranslator is given a memory budget account (see
+membudget.py), the buffer for each message is charged to the account while
+the message is being received and handled.
+
+The number of messages and bytes of each message type received and
+transmitted are counted in the metrics registry.
 """
 
+import lagmonitor
 import logging
+import metrics
 import struct
-from bitstring import BitArray
+from bitfield import Bitfield
 
 logger = logging.getLogger('bt.bttranslator')
 
@@ -48,13 +70,56 @@ _MSG_BITFIELD = 5
 _MSG_REQUEST = 6
 _MSG_PIECE = 7
 _MSG_CANCEL = 8
+_MSG_SUGGEST_PIECE = 13
+_MSG_HAVE_ALL = 14
+_MSG_HAVE_NONE = 15
+_MSG_REJECT_REQUEST = 16
+_MSG_ALLOWED_FAST = 17
+_MSG_EXTENDED = 20
+
+_MSG_NAMES = {None: 'keep_alive',
+              _MSG_CHOKE: 'choke',
+              _MSG_UNCHOKE: 'unchoke',
+              _MSG_INTERESTED: 'interested',
+              _MSG_NOT_INTERESTED: 'not_interested',
+              _MSG_HAVE: 'have',
+              _MSG_BITFIELD: 'bitfield',
+              _MSG_REQUEST: 'request',
+              _MSG_PIECE: 'piece',
+              _MSG_CANCEL: 'cancel',
+              _MSG_SUGGEST_PIECE: 'suggest_piece',
+              _MSG_HAVE_ALL: 'have_all',
+              _MSG_HAVE_NONE: 'have_none',
+              _MSG_REJECT_REQUEST: 'reject_request',
+              _MSG_ALLOWED_FAST: 'allowed_fast',
+              _MSG_EXTENDED: 'extended'}
+
+_messages = metrics.counter('bt_peerwire_messages_total',
+                            "Peer wire messages by direction and type",
+                            ('direction', 'type'))
+_bytes = metrics.counter('bt_peerwire_bytes_total',
+                         "Peer wire bytes by direction and message type",
+                         ('direction', 'type'))
+_invalid = metrics.counter('bt_peerwire_invalid_messages_total',
+                           "Peer wire messages received with an invalid id")
+
+# The children for each message type are looked up ahead of time so that
+# counting a message costs only an attribute increment
+_rx_counters = {msg_id: (_messages.labels('rx', name),
+                         _bytes.labels('rx', name))
+                for msg_id, name in _MSG_NAMES.items()}
+_tx_counters = {msg_id: (_messages.labels('tx', name),
+                         _bytes.labels('tx', name))
+                for msg_id, name in _MSG_NAMES.items()}
 
 
 class PeerWireTranslator(object):
     class _States(object):
         Length, Message = range(2)
 
-    def __init__(self, receiver=None, readerwriter=None):
+    def __init__(self, receiver=None, readerwriter=None, account=None):
+        self._account = account
+        self._charged = 0
         self._length_buf = bytearray(_LENGTH_LEN)
         self._length_view = memoryview(self._length_buf)
         self._length_state_setup()
@@ -77,15 +142,28 @@ class PeerWireTranslator(object):
                               _MSG_BITFIELD: self.rx_bitfield,
                               _MSG_REQUEST: self.rx_request,
                               _MSG_PIECE: self.rx_piece,
-                              _MSG_CANCEL: self.rx_cancel}
+                              _MSG_CANCEL: self.rx_cancel,
+                              _MSG_SUGGEST_PIECE: self.rx_suggest_piece,
+                              _MSG_HAVE_ALL: self.rx_have_all,
+                              _MSG_HAVE_NONE: self.rx_have_none,
+                              _MSG_REJECT_REQUEST: self.rx_reject_request,
+                              _MSG_ALLOWED_FAST: self.rx_allowed_fast,
+                              _MSG_EXTENDED: self.rx_extended}
 
     def _length_state_setup(self):
+        self._release()
         self._rx_state = self._States.Length
         self._bytes_needed = _LENGTH_LEN
         self._bytes_received = 0
         self._current_buf = self._length_buf
         self._current_view = self._length_view
 
+    def _release(self):
+        # Release the memory charged for the buffer of the message
+        if self._charged:
+            self._account.release('receive', self._charged)
+            self._charged = 0
+
     def set_receiver(self, receiver):
         self._receiver = receiver
 
@@ -99,10 +177,12 @@ class PeerWireTranslator(object):
     def unset_readerwriter(self):
         self._readerwriter.unset_receiver()
         self._readerwriter = None
+        self._release()
 
     def get_rx_buffer(self):
         return self._current_view[self._bytes_received:], self._bytes_needed
 
+    @lagmonitor.watch('PeerWireTranslator.rx_bytes')
     def rx_bytes(self, n):
         self._bytes_received += n
         self._bytes_needed -= n
@@ -111,6 +191,9 @@ class PeerWireTranslator(object):
             if self._rx_state == self._States.Length:
                 (length,) = struct.unpack('>i', buffer(self._length_buf))
                 if length == 0:
+                    messages, nbytes = _rx_counters[None]
+                    messages.value += 1
+                    nbytes.value += _LENGTH_LEN
                     self.rx_keep_alive()
                     self._length_state_setup()
                 else:
@@ -119,16 +202,25 @@ class PeerWireTranslator(object):
                     self._bytes_received = 0
 
                     self._current_buf = bytearray(length)
+                    if self._account is not None:
+                        self._account.charge('receive', length)
+                        self._charged = length
                     self._current_view = memoryview(self._current_buf)
             else:
                 (message_id,) = struct.unpack("B",
                                               buffer(self._current_buf[0:1]))
 
                 try:
-                    self._rx_functions[message_id]()
+                    function = self._rx_functions[message_id]
                 except KeyError:
+                    _invalid.value += 1
                     logger.debug("Received message with invalid msg id: {}"
                                  .format(message_id))
+                else:
+                    messages, nbytes = _rx_counters[message_id]
+                    messages.value += 1
+                    nbytes.value += _LENGTH_LEN + self._bytes_received
+                    function()
 
                 self._length_state_setup()
 
@@ -159,7 +251,8 @@ class PeerWireTranslator(object):
 
     def rx_bitfield(self):
         if self._receiver is not None:
-            bits = BitArray(bytes=self._current_buf[1:self._bytes_received])
+            bits = Bitfield.from_bytes(
+                self._current_buf[1:self._bytes_received])
             self._receiver.rx_bitfield(bits)
 
     def rx_request(self):
@@ -181,57 +274,138 @@ class PeerWireTranslator(object):
             index, begin, length, = struct.unpack(">3I", buf)
             self._receiver.rx_cancel(index, begin, length)
 
+    def rx_suggest_piece(self):
+        if self._receiver is not None:
+            (index,) = struct.unpack(">I", buffer(self._current_buf[1:5]))
+            self._receiver.rx_suggest_piece(index)
+
+    def rx_have_all(self):
+        if self._receiver is not None:
+            self._receiver.rx_have_all()
+
+    def rx_have_none(self):
+        if self._receiver is not None:
+            self._receiver.rx_have_none()
+
+    def rx_reject_request(self):
+        if self._receiver is not None:
+            buf = buffer(self._current_buf[1:])
+            index, begin, length, = struct.unpack(">3I", buf)
+            self._receiver.rx_reject_request(index, begin, length)
+
+    def rx_allowed_fast(self):
+        if self._receiver is not None:
+            (index,) = struct.unpack(">I", buffer(self._current_buf[1:5]))
+            self._receiver.rx_allowed_fast(index)
+
+    def rx_extended(self):
+        if self._receiver is not None and self._bytes_received >= 2:
+            self._receiver.rx_extended(
+                self._current_buf[1],
+                buffer(self._current_buf, 2, self._bytes_received - 2))
+
+    def _tx(self, message_id, message):
+        messages, nbytes = _tx_counters[message_id]
+        messages.value += 1
+        nbytes.value += len(message)
+        self._readerwriter.tx_bytes(message)
+
     def tx_keep_alive(self):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('B', 0))
+            self._tx(None, struct.pack('>I', 0))
 
     def tx_choke(self):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_CHOKE))
+            self._tx(_MSG_CHOKE, struct.pack('>IB', 1, _MSG_CHOKE))
 
     def tx_unchoke(self):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_UNCHOKE))
+            self._tx(_MSG_UNCHOKE, struct.pack('>IB', 1, _MSG_UNCHOKE))
 
     def tx_interested(self):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB', 1, _MSG_INTERESTED))
+            self._tx(_MSG_INTERESTED, struct.pack('>IB', 1, _MSG_INTERESTED))
 
     def tx_not_interested(self):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB', 1,
-                                                    _MSG_NOT_INTERESTED))
+            self._tx(_MSG_NOT_INTERESTED, struct.pack('>IB', 1,
+                                                      _MSG_NOT_INTERESTED))
 
     def tx_have(self, index):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IBI', 5,
-                                                    _MSG_HAVE, index))
+            self._tx(_MSG_HAVE, struct.pack('>IBI', 5, _MSG_HAVE, index))
+
+    def tx_haves(self, indices):
+        """
+        tx_haves() sends a have message for each of the indices in a single
+        write.
+        """
+        if self._readerwriter is not None and indices:
+            message = ''.join(struct.pack('>IBI', 5, _MSG_HAVE, index)
+                              for index in indices)
+            messages, nbytes = _tx_counters[_MSG_HAVE]
+            messages.value += len(indices)
+            nbytes.value += len(message)
+            self._readerwriter.tx_bytes(message)
 
     def tx_bitfield(self, bits):
         if self._readerwriter is not None:
             bitfield = bits.tobytes()
             length = len(bitfield)
-            self._readerwriter.tx_bytes(struct.pack('>IB{}s'.format(length),
-                                                    1+length, _MSG_BITFIELD,
-                                                    bitfield))
+            self._tx(_MSG_BITFIELD, struct.pack('>IB{}s'.format(length),
+                                                1+length, _MSG_BITFIELD,
+                                                bitfield))
 
     def tx_request(self, index, begin, length):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB3I', 13, _MSG_REQUEST,
-                                                    index, begin, length))
+            self._tx(_MSG_REQUEST, struct.pack('>IB3I', 13, _MSG_REQUEST,
+                                               index, begin, length))
 
     def tx_piece(self, index, begin, block):
         if self._readerwriter is not None:
             length = len(block)
-            self._readerwriter.tx_bytes(struct.pack('>IB2I{}s'.format(length),
-                                                    9+length, _MSG_PIECE,
-                                                    index, begin, block))
+            self._tx(_MSG_PIECE, struct.pack('>IB2I{}s'.format(length),
+                                             9+length, _MSG_PIECE,
+                                             index, begin, block))
 
     def tx_cancel(self, index, begin, length):
         if self._readerwriter is not None:
-            self._readerwriter.tx_bytes(struct.pack('>IB3I', 13, _MSG_CANCEL,
-                                                    index, begin, length))
+            self._tx(_MSG_CANCEL, struct.pack('>IB3I', 13, _MSG_CANCEL,
+                                              index, begin, length))
+
+    def tx_suggest_piece(self, index):
+        if self._readerwriter is not None:
+            self._tx(_MSG_SUGGEST_PIECE, struct.pack('>IBI', 5,
+                                                     _MSG_SUGGEST_PIECE,
+                                                     index))
+
+    def tx_have_all(self):
+        if self._readerwriter is not None:
+            self._tx(_MSG_HAVE_ALL, struct.pack('>IB', 1, _MSG_HAVE_ALL))
+
+    def tx_have_none(self):
+        if self._readerwriter is not None:
+            self._tx(_MSG_HAVE_NONE, struct.pack('>IB', 1, _MSG_HAVE_NONE))
+
+    def tx_reject_request(self, index, begin, length):
+        if self._readerwriter is not None:
+            self._tx(_MSG_REJECT_REQUEST, struct.pack('>IB3I', 13,
+                                                      _MSG_REJECT_REQUEST,
+                                                      index, begin, length))
+
+    def tx_allowed_fast(self, index):
+        if self._readerwriter is not None:
+            self._tx(_MSG_ALLOWED_FAST, struct.pack('>IBI', 5,
+                                                    _MSG_ALLOWED_FAST, index))
+
+    def tx_extended(self, extended_id, payload):
+        if self._readerwriter is not None:
+            length = len(payload)
+            self._tx(_MSG_EXTENDED, struct.pack('>IBB{}s'.format(length),
+                                                2+length, _MSG_EXTENDED,
+                                                extended_id, payload))
 
     def connection_lost(self):
+        self._release()
         if self._receiver is not None:
             self._receiver.connection_lost()
@@ -0,0 +1,200 @@
+"""
+The profiler profiles the running client for a fixed period so that the
+cause of a saturated reactor can be found without restarting the client under
+a profiler.  Only one profile can be taken at a time.
+
+Two kinds of profiler are available:
+
+    cprofile  a deterministic profiler which records every function call.
+              It measures exactly how often each function is called and how
+              long it takes, but slows the client down considerably while it
+              runs.  The result is either a pstats report sorted by
+              cumulative time or the raw stats, which can be loaded with
+              pstats.Stats() or tools such as snakeviz.
+
+    sample    a statistical profiler which interrupts the process every
+              interval seconds of CPU time with SIGPROF and records the stack
+              of the reactor thread.  Its overhead is low enough to be used on
+              a busy client.  The result is in the collapsed stack format, one
+              stack per line with a count of the samples in which it was seen,
+              which can be turned into a flame graph by flamegraph.pl or
+              speedscope.
+
+profile() starts a profiler, stops it after the requested duration and returns
+a Deferred which fires with the result.  start() and stop() can be used
+directly instead when the period isn't known in advance.
+
+Each worker process (see worker.py) is profiled separately and merge()
+combines the results of the client and its workers.
+"""
+
+import cProfile
+import marshal
+import os
+import pstats
+import signal
+
+from StringIO import StringIO
+from twisted.internet import task
+
+MODES = ('cprofile', 'sample')
+FORMATS = {'cprofile': ('text', 'pstats'),
+           'sample': ('collapsed',)}
+
+_DEFAULT_INTERVAL = 0.005
+_TEXT_LINES = 60
+
+_mode = None
+_profile = None
+_samples = None
+
+
+def running():
+    return _mode is not None
+
+
+def start(mode='sample', interval=_DEFAULT_INTERVAL):
+    """
+    start() starts a profiler of the specified mode.  For the sampling
+    profiler, interval is the number of seconds of CPU time between samples.
+    It raises a ValueError if the arguments are invalid or a profiler is
+    already running.
+    """
+    global _mode, _profile, _samples
+
+    if mode not in MODES:
+        raise ValueError("Unknown profiler: {}".format(mode))
+    if _mode is not None:
+        raise ValueError("A {} profile is already running".format(_mode))
+
+    if mode == 'cprofile':
+        _profile = cProfile.Profile()
+        _profile.enable()
+    else:
+        if interval <= 0:
+            raise ValueError("Interval must be positive")
+        _samples = {}
+        signal.signal(signal.SIGPROF, _sample)
+
+        # Restart system calls such as the reactor's select() rather than
+        # failing them with EINTR when a sample is taken
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+    _mode = mode
+
+
+def stop(format=None):
+    """
+    stop() stops the running profiler and returns its result in the
+    specified format, which defaults to the first format listed for the mode
+    in FORMATS.  It raises a ValueError if no profiler is running or the
+    format is invalid.
+    """
+    global _mode, _profile, _samples
+
+    if _mode is None:
+        raise ValueError("No profile is running")
+
+    mode = _mode
+    if format is None:
+        format = FORMATS[mode][0]
+
+    if mode == 'cprofile':
+        _profile.disable()
+        profile, _profile = _profile, None
+    else:
+        # The handler is left installed because a signal may already be
+        # pending.  It ignores signals which arrive after the profile stops.
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        samples, _samples = _samples, None
+
+    _mode = None
+
+    if format not in FORMATS[mode]:
+        raise ValueError("Unknown format for {} profile: {}"
+                         .format(mode, format))
+
+    if format == 'text':
+        stream = StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(_TEXT_LINES)
+        return stream.getvalue()
+
+    if format == 'pstats':
+        profile.create_stats()
+        return marshal.dumps(profile.stats)
+
+    return ''.join("{} {}\n".format(stack, count)
+                   for stack, count in sorted(samples.items()))
+
+
+def profile(reactor, duration, mode='sample', format=None,
+            interval=_DEFAULT_INTERVAL):
+    """
+    profile() profiles the client for duration seconds and returns a
+    Deferred which fires with the result in the specified format.  It raises
+    a ValueError if the arguments are invalid or a profiler is already
+    running.
+    """
+    if duration <= 0:
+        raise ValueError("Duration must be positive")
+    if mode in FORMATS and format is not None and format not in FORMATS[mode]:
+        raise ValueError("Unknown format for {} profile: {}"
+                         .format(mode, format))
+
+    start(mode, interval)
+    return task.deferLater(reactor, duration, stop, format)
+
+
+class _Stats(object):
+    # Presents raw stats to pstats.Stats as if they were a profile
+    def __init__(self, data):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+def merge(results, format):
+    """
+    merge() combines the results of profiles taken in the specified format
+    by several processes, supplied as a list of (process name, result) pairs,
+    into a single result in that format.  The collapsed stacks of each
+    process are rooted at its name, a text report is given for each process
+    under its name and raw stats are added together.
+    """
+    if format == 'pstats':
+        # pstats.Stats refuses empty stats
+        profiles = [_Stats(result) for _, result in results]
+        profiles = [profile for profile in profiles if profile.stats]
+        if not profiles:
+            return marshal.dumps({})
+        return marshal.dumps(pstats.Stats(*profiles).stats)
+
+    if format == 'text':
+        return '\n'.join("{}\n{}\n{}".format(name, '=' * len(name), result)
+                         for name, result in results)
+
+    return ''.join("{};{}".format(name, line) for name, result in results
+                   for line in result.splitlines(True))
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name,
+                               os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+
+def _sample(signum, frame):
+    # Record the stack, outermost frame first, in the collapsed format
+    if _samples is None:
+        return
+
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    stack = ';'.join(reversed(names))
+    _samples[stack] = _samples.get(stack, 0) + 1
@@ -18,10 +18,17 @@ A receiver must implement the functions rx_bytes() and connection_lost().
 On the send side, the ProtocolAdapter simply passes on the string of bytes
 presented to it to the transport.
 
+The transport of each connection is registered with the memory budget (see
+membudget.py) while the connection is up so that reading from it can be
+paused when the process is holding too much block data.
+
 Then name of the ProtocolAdapter reflects the effort to integrate the twisted
 framework into the existing BitTorrent structure.
 """
 
+import lagmonitor
+import membudget
+
 from twisted.internet import protocol
 
 
@@ -35,6 +42,7 @@ class ProtocolAdapter(protocol.Protocol):
     def unset_receiver(self):
         self._receiver = None
 
+    @lagmonitor.watch('ProtocolAdapter.dataReceived')
     def dataReceived(self, data):
         if self._receiver is not None:
             buf = buffer(data)
@@ -48,10 +56,12 @@ class ProtocolAdapter(protocol.Protocol):
                 self._receiver.rx_bytes(n)
 
     def connectionMade(self):
+        membudget.budget.register(self.transport)
         if self._receiver is not None:
             self._receiver.connection_complete(self)
 
     def connectionLost(self, reason):
+        membudget.budget.unregister(self.transport)
         if self._receiver is not None:
             self._receiver.connection_lost()
 
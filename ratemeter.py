@@ -0,0 +1,50 @@
+"""
+The RateMeter measures the rate at which bytes are transferred over a
+connection.  The rate is a moving average over a window of recent time so
+that a burst of data is gradually forgotten once it falls out of the window.
+Each time bytes are transferred, the RateMeter is told how many and it folds
+them into the average.  The rate can be read at any time and decays toward
+zero when no bytes are being transferred.
+
+The RateMeter gets the current time from a clock which must implement
+seconds().  The reactor can be used as the clock.
+"""
+
+_RATE_PERIOD = 20.0
+_RATE_FUDGE = 1.0
+
+
+class RateMeter(object):
+    def __init__(self, clock, period=_RATE_PERIOD):
+        self._clock = clock
+        self._period = period
+
+        now = clock.seconds()
+        self._rate = 0.0
+        self._total = 0
+        self._last = now
+        self._since = now - _RATE_FUDGE
+
+    def update(self, amount):
+        """
+        update() records the transfer of the specified number of bytes.
+        """
+        now = self._clock.seconds()
+        self._total += amount
+
+        self._rate = ((self._rate * (self._last - self._since) + amount) /
+                      (now - self._since))
+        self._last = now
+        if self._since < now - self._period:
+            self._since = now - self._period
+
+    def rate(self):
+        """
+        rate() returns the average number of bytes per second transferred
+        over the period.
+        """
+        self.update(0)
+        return self._rate
+
+    def total(self):
+        return self._total
@@ -0,0 +1,148 @@
+"""
+The Scheduler runs functions when their deadlines arrive.  There is a single
+Scheduler for each reactor which is obtained by calling get_scheduler().  It
+is shared by all of the TorrentMgrs so that the per-request and per-peer
+deadlines of every torrent are kept in one place.
+
+Pending deadlines are kept in a heap ordered by the time at which they expire
+so that adding a deadline and expiring the earliest one each take O(log n)
+time.  The Scheduler keeps exactly one delayed call with the reactor, which is
+set to fire at the earliest deadline in the heap, and moves that delayed call
+whenever a new deadline comes before it.  A deadline therefore expires as soon
+as the reactor can get to it rather than on the next turn of a periodic scan.
+
+call_later() and call_at() return a Timer which can be used to cancel the
+deadline.  Cancelled Timers are left in the heap and discarded when they reach
+the top, unless cancelled Timers make up most of the heap, in which case the
+heap is rebuilt without them.
+"""
+
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger('bt.scheduler')
+
+_schedulers = {}
+
+
+def get_scheduler(reactor):
+    """
+    get_scheduler() returns the Scheduler for the specified reactor, creating
+    it if necessary.
+    """
+    if reactor not in _schedulers:
+        _schedulers[reactor] = Scheduler(reactor)
+    return _schedulers[reactor]
+
+
+class Timer(object):
+    def __init__(self, scheduler, deadline, function, args, kwargs):
+        self._scheduler = scheduler
+        self.deadline = deadline
+        self._function = function
+        self._args = args
+        self._kwargs = kwargs
+        self._active = True
+
+    def active(self):
+        return self._active
+
+    def cancel(self):
+        if self._active:
+            self._active = False
+            self._function = self._args = self._kwargs = None
+            self._scheduler._cancelled()
+
+    def _fire(self):
+        self._active = False
+        function, args, kwargs = self._function, self._args, self._kwargs
+        self._function = self._args = self._kwargs = None
+        function(*args, **kwargs)
+
+
+class Scheduler(object):
+    def __init__(self, reactor):
+        self._reactor = reactor
+
+        # _heap is a heap of tuples containing the deadline of a Timer, a
+        # sequence number which keeps Timers with the same deadline in the
+        # order they were added and the Timer itself
+        self._heap = []
+        self._sequence = itertools.count()
+        self._num_cancelled = 0
+
+        # _call is the reactor delayed call which fires at the earliest
+        # deadline in the heap
+        self._call = None
+
+    def seconds(self):
+        return self._reactor.seconds()
+
+    def call_at(self, deadline, function, *args, **kwargs):
+        """
+        call_at() arranges for function to be called with the supplied
+        arguments at the specified time.  It returns a Timer which can be used
+        to cancel the call.
+        """
+        timer = Timer(self, deadline, function, args, kwargs)
+        heapq.heappush(self._heap, (deadline, next(self._sequence), timer))
+        if self._call is None or deadline < self._call.getTime():
+            self._arm(deadline)
+        return timer
+
+    def call_later(self, delay, function, *args, **kwargs):
+        """
+        call_later() arranges for function to be called with the supplied
+        arguments after delay seconds.  It returns a Timer which can be used
+        to cancel the call.
+        """
+        return self.call_at(self._reactor.seconds() + delay, function,
+                            *args, **kwargs)
+
+    def pending(self):
+        return len(self._heap) - self._num_cancelled
+
+    def _cancelled(self):
+        self._num_cancelled += 1
+
+        # Rebuild the heap when it consists mostly of cancelled Timers so
+        # that it doesn't grow without bound
+        if (self._num_cancelled > 64 and
+                self._num_cancelled > len(self._heap) / 2):
+            self._heap = [entry for entry in self._heap if entry[2].active()]
+            heapq.heapify(self._heap)
+            self._num_cancelled = 0
+
+    def _arm(self, deadline):
+        # Set the delayed call to fire at the deadline.  There is only ever
+        # one delayed call, so one which is already set is moved.
+        delay = max(0, deadline - self._reactor.seconds())
+        if self._call is None:
+            self._call = self._reactor.callLater(delay, self._expire)
+        else:
+            self._call.reset(delay)
+
+    def _expire(self):
+        self._call = None
+
+        now = self._reactor.seconds()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self._heap)
+            if not timer.active():
+                self._num_cancelled -= 1
+                continue
+
+            try:
+                timer._fire()
+            except Exception:
+                logger.exception("Exception raised by scheduled call")
+
+        while self._heap and not self._heap[0][2].active():
+            heapq.heappop(self._heap)
+            self._num_cancelled -= 1
+
+        # The functions which were called may have added deadlines and set up
+        # a delayed call already
+        if self._heap:
+            self._arm(self._heap[0][0])
@@ -0,0 +1,303 @@
+"""
+The SessionStore keeps the client's torrents in an SQLite database so that
+they survive a restart.  For each torrent, it records the torrent file, the
+name, the directory its files are saved under, its position in the queue, its
+files and its resume data (see TorrentMgr.resume_data()), which holds the
+pieces on disk, the file priorities and the addresses of peers learned from
+the tracker and peer exchange.  The numbers of wanted and needed pieces are
+also kept in columns of their own so that the progress of a torrent can be
+reported without decoding its resume data.
+
+Restoring thousands of torrents must not mean parsing thousands of torrent
+files and contacting thousands of trackers, so the client restores each one
+as a StoredTorrent, which is made from a row of the torrents table alone.  A
+StoredTorrent stands in for the TorrentMgr or RemoteTorrent in the client's
+torrents and queue and only loads the torrent, with the help of a function
+supplied by the client, when it is first started or something which needs
+the torrent itself, such as reading from it, is asked of it.  Until then, its
+status comes from the table and its files from the files column.  The resume
+data is read from the database when the torrent is loaded.
+
+The client saves the resume data of the loaded torrents and the order of the
+queue every _SAVE_INTERVAL seconds and when it quits.  The database is written
+on the reactor's thread in a single transaction for each save, which is small
+since only the torrents which have been loaded are saved.
+
+The schema is:
+
+    torrents(key, position, filename, name, save_path, wanted, needed, files,
+             resume)
+
+where files is a json formatted list of the path and length of each file
+and resume is the bencoded resume data.
+"""
+
+import bencode
+import json
+import logging
+import sqlite3
+
+from torrentmgr import PRIORITIES, NORMAL
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+logger = logging.getLogger('bt.session')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS torrents (
+    key TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    name TEXT NOT NULL,
+    save_path TEXT NOT NULL,
+    wanted INTEGER,
+    needed INTEGER,
+    files TEXT,
+    resume BLOB
+)
+"""
+
+
+class SessionStore(object):
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.text_factory = str
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def torrents(self):
+        """
+        torrents() returns a list of dictionaries containing the key,
+        filename, name, save path and numbers of wanted and needed pieces of
+        each stored torrent in queue order.  The numbers of pieces are None
+        if no resume data has been saved for the torrent.
+        """
+        rows = self._db.execute("SELECT key, filename, name, save_path, "
+                                "wanted, needed FROM torrents "
+                                "ORDER BY position")
+        return [dict(key=key, filename=filename, name=name,
+                     save_path=save_path, wanted=wanted, needed=needed)
+                for key, filename, name, save_path, wanted, needed in rows]
+
+    def add(self, key, filename, name, save_path):
+        """
+        add() records a new torrent at the end of the queue.
+        """
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO torrents (key, position, "
+                             "filename, name, save_path) VALUES (?, (SELECT "
+                             "COALESCE(MAX(position), -1) + 1 FROM "
+                             "torrents), ?, ?, ?)",
+                             (key, filename, name, save_path))
+
+    def files(self, key):
+        """
+        files() returns a list of the path and length of each file of the
+        torrent or None if they haven't been saved.
+        """
+        row = self._db.execute("SELECT files FROM torrents WHERE key = ?",
+                               (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def save_files(self, key, files):
+        with self._db:
+            self._db.execute("UPDATE torrents SET files = ? WHERE key = ?",
+                             (json.dumps(files), key))
+
+    def resume(self, key):
+        """
+        resume() returns the resume data saved for the torrent or None if
+        there is none.
+        """
+        row = self._db.execute("SELECT resume FROM torrents WHERE key = ?",
+                               (key,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return bencode.bdecode(str(row[0]))
+
+    def save(self, resumes, order):
+        """
+        save() saves the resume data in resumes, a dictionary keyed by the
+        keys of the torrents, and the order of the queue, a list of keys, in
+        one transaction.
+        """
+        with self._db:
+            self._db.executemany(
+                "UPDATE torrents SET wanted = ?, needed = ?, resume = ? "
+                "WHERE key = ?",
+                [(resume['wanted'], resume['needed'],
+                  sqlite3.Binary(bencode.bencode(resume)), key)
+                 for key, resume in resumes.iteritems()])
+            self._db.executemany(
+                "UPDATE torrents SET position = ? WHERE key = ?",
+                list(enumerate(order)))
+
+    def close(self):
+        self._db.close()
+
+
+class StoredTorrent(object):
+    """
+    A StoredTorrent stands in for a torrent restored from the session store
+    until it is loaded, after which it passes every call on to the loaded
+    torrent.  load is called with no arguments the first time the torrent is
+    needed and returns a Deferred which fires with the loaded torrent.
+    """
+
+    def __init__(self, store, entry, load):
+        self._store = store
+        self._entry = entry
+        self._load = load
+        self._torrent = None
+        self._loading = False
+        self._failed = False
+        self._waiters = []
+        self._max_peers = None
+
+    def _when_loaded(self):
+        # Returns a Deferred which fires with the loaded torrent, loading it
+        # if this is the first time it is needed
+        if self._torrent is not None:
+            return succeed(self._torrent)
+
+        d = Deferred()
+        self._waiters.append(d)
+        if not self._loading:
+            self._loading = True
+            logger.info("Loading {}".format(self._entry['name']))
+            maybeDeferred(self._load).addCallbacks(self._loaded,
+                                                   self._load_failed)
+        return d
+
+    def _loaded(self, torrent):
+        self._torrent = torrent
+        self._loading = False
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(torrent)
+
+    def _load_failed(self, failure):
+        logger.error("Unable to load {}: {}"
+                     .format(self._entry['name'], failure.getErrorMessage()))
+        self._failed = True
+        self._loading = False
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.errback(failure)
+
+    def loaded(self):
+        return self._torrent is not None
+
+    def name(self):
+        return self._entry['name']
+
+    def state(self):
+        if self._torrent is not None:
+            return self._torrent.state()
+        return 'failed' if self._failed else 'initialized'
+
+    def percent(self):
+        if self._torrent is not None:
+            return self._torrent.percent()
+        wanted, needed = self._entry['wanted'], self._entry['needed']
+        if wanted is None:
+            return 0.0
+        if wanted == 0:
+            return 100.0
+        return 100 * (1 - (needed / float(wanted)))
+
+    def download_rate(self):
+        if self._torrent is not None:
+            return self._torrent.download_rate()
+        return 0.0
+
+    def upload_rate(self):
+        if self._torrent is not None:
+            return self._torrent.upload_rate()
+        return 0.0
+
+    def peer_counts(self):
+        if self._torrent is not None:
+            return self._torrent.peer_counts()
+        return 0, 0
+
+    def memory(self):
+        if self._torrent is not None:
+            return self._torrent.memory()
+        return 0
+
+    def pieces_needed(self):
+        if self._torrent is not None:
+            return self._torrent.pieces_needed()
+        return self._entry['needed']
+
+    def swarm_size(self):
+        if self._torrent is not None:
+            return self._torrent.swarm_size()
+        return None
+
+    def set_max_peers(self, max_peers):
+        self._max_peers = max_peers
+        if self._torrent is not None:
+            return self._torrent.set_max_peers(max_peers)
+
+    def start(self):
+        def start(torrent):
+            d = succeed(None)
+            if self._max_peers is not None:
+                d = maybeDeferred(torrent.set_max_peers, self._max_peers)
+            return d.addCallback(lambda _: torrent.start())
+
+        return self._when_loaded().addCallback(start)
+
+    def stop(self):
+        if self._torrent is None and not self._loading:
+            return succeed(None)
+        return self._when_loaded().addCallback(lambda torrent:
+                                               torrent.stop())
+
+    def resume_data(self):
+        """
+        resume_data() returns the resume data of the loaded torrent or None
+        if it hasn't been loaded, in which case the saved data is current.
+        """
+        if self._torrent is not None:
+            return self._torrent.resume_data()
+        return None
+
+    def peer_stats(self):
+        if self._torrent is not None:
+            return self._torrent.peer_stats()
+        return []
+
+    def files(self):
+        if self._torrent is not None:
+            return self._torrent.files()
+
+        files = self._store.files(self._entry['key'])
+        resume = self._store.resume(self._entry['key'])
+        if files is None:
+            return self._when_loaded().addCallback(lambda torrent:
+                                                   torrent.files())
+
+        if resume is not None and len(resume['priorities']) == len(files):
+            priorities = [int(digit) for digit in resume['priorities']]
+        else:
+            priorities = [NORMAL] * len(files)
+        return [{'path': path, 'length': length,
+                 'priority': PRIORITIES[priority]}
+                for (path, length), priority in zip(files, priorities)]
+
+    def set_priority(self, priority, file_indices=None):
+        return self._when_loaded().addCallback(
+            lambda torrent: torrent.set_priority(priority, file_indices))
+
+    def set_streaming(self, enable, file_index=None):
+        return self._when_loaded().addCallback(
+            lambda torrent: torrent.set_streaming(enable, file_index))
+
+    def read(self, file_index, offset, length):
+        return self._when_loaded().addCallback(
+            lambda torrent: torrent.read(file_index, offset, length))
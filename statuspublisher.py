@@ -0,0 +1,157 @@
+"""
+The StatusPublisher pushes the status of the torrents a client is handling to
+subscribers so that dashboards don't have to poll for the status of each
+torrent.
+
+A subscriber supplies a callback and the interval at which it wants to be
+updated.  The first update contains the full status of every torrent.  After
+that, each update contains only the fields which have changed since the
+previous update sent to that subscriber, so however often a torrent's status
+changes between updates, the subscriber receives at most one delta per torrent
+per interval.  When nothing has changed, no update is sent unless a heartbeat
+was requested, in which case an empty update is sent once heartbeat seconds
+have passed without an update so that idle connections are kept open.
+
+An update is a dictionary keyed by the torrent's key.  The value is a
+dictionary of the fields which have changed or None if the torrent is no
+longer being handled.
+
+The status of the torrents is obtained from the source supplied to the
+StatusPublisher, which returns a dictionary of status dictionaries keyed by
+torrent key.  It is obtained at most once every _MIN_INTERVAL seconds no
+matter how many subscribers there are.
+
+split_update() splits an update into json formatted strings no longer than a
+given size for channels, such as AMP, which limit the size of a message.
+"""
+
+import json
+import logging
+
+from scheduler import get_scheduler
+
+logger = logging.getLogger('bt.statuspublisher')
+
+_MIN_INTERVAL = 0.1
+
+
+def split_update(deltas, limit):
+    """
+    split_update() returns a list of json formatted strings, each no longer
+    than limit bytes unless the delta for a single torrent is, which together
+    represent the supplied update.  An empty update is represented by a
+    single string.
+    """
+    chunks = []
+    chunk = {}
+    size = 2
+    for key, delta in deltas.iteritems():
+        encoded = len(json.dumps({key: delta}))
+        if chunk and size + encoded > limit:
+            chunks.append(json.dumps(chunk))
+            chunk = {}
+            size = 2
+        chunk[key] = delta
+        size += encoded
+    chunks.append(json.dumps(chunk))
+    return chunks
+
+
+class Subscription(object):
+    def __init__(self, publisher, callback, interval, heartbeat):
+        self._publisher = publisher
+        self._callback = callback
+        self.interval = interval
+        self._heartbeat = heartbeat
+
+        # _sent maps the key of each torrent to the fields most recently sent
+        # to the subscriber
+        self._sent = {}
+        self._last_update = None
+        self._timer = None
+
+    def cancel(self):
+        self._publisher._unsubscribe(self)
+
+
+class StatusPublisher(object):
+    def __init__(self, source, reactor):
+        self._source = source
+        self._scheduler = get_scheduler(reactor)
+        self._subscriptions = set()
+
+        self._snapshot = None
+        self._snapshot_time = None
+
+    def subscribe(self, callback, interval=1.0, heartbeat=None):
+        """
+        subscribe() arranges for callback to be called with an update now and
+        then every interval seconds when the status of the torrents changes.
+        It returns a Subscription which can be used to cancel the updates.  It
+        raises a ValueError if the interval is too short.
+        """
+        if interval < _MIN_INTERVAL:
+            raise ValueError("Interval must be at least {} seconds"
+                             .format(_MIN_INTERVAL))
+
+        subscription = Subscription(self, callback, interval, heartbeat)
+        self._subscriptions.add(subscription)
+        self._update(subscription)
+        return subscription
+
+    def subscribers(self):
+        return len(self._subscriptions)
+
+    def _unsubscribe(self, subscription):
+        self._subscriptions.discard(subscription)
+        if subscription._timer is not None:
+            subscription._timer.cancel()
+            subscription._timer = None
+
+    def _current(self):
+        # Share one snapshot of the status among the subscribers which are
+        # updated at about the same time
+        now = self._scheduler.seconds()
+        if (self._snapshot is None or
+                now - self._snapshot_time >= _MIN_INTERVAL):
+            self._snapshot = self._source()
+            self._snapshot_time = now
+        return self._snapshot
+
+    def _update(self, subscription):
+        subscription._timer = None
+        if subscription not in self._subscriptions:
+            return
+
+        current = self._current()
+        sent = subscription._sent
+
+        deltas = {}
+        for key, status in current.iteritems():
+            previous = sent.setdefault(key, {})
+            changed = {field: value for field, value in status.iteritems()
+                       if field not in previous or previous[field] != value}
+            if changed:
+                previous.update(changed)
+                deltas[key] = changed
+
+        for key in [key for key in sent if key not in current]:
+            del sent[key]
+            deltas[key] = None
+
+        now = self._scheduler.seconds()
+        if (deltas or subscription._last_update is None or
+                (subscription._heartbeat is not None and
+                 now - subscription._last_update >= subscription._heartbeat)):
+            subscription._last_update = now
+            try:
+                subscription._callback(deltas)
+            except Exception:
+                logger.exception("Status subscriber failed, unsubscribing")
+                self._unsubscribe(subscription)
+                return
+
+        # The callback may have cancelled the subscription
+        if subscription in self._subscriptions:
+            subscription._timer = self._scheduler.call_later(
+                subscription.interval, self._update, subscription)
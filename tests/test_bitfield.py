@@ -0,0 +1,81 @@
+import pytest
+
+from bitfield import Bitfield
+
+
+def test_set_and_get():
+    bitfield = Bitfield(10)
+    bitfield[0] = 1
+    bitfield[9] = 1
+    assert bitfield[0] and bitfield[9] and not bitfield[1]
+    assert bitfield.tobytes() == '\x80\x40'
+    bitfield[0] = 0
+    assert not bitfield[0]
+    with pytest.raises(IndexError):
+        bitfield[10]
+    with pytest.raises(IndexError):
+        bitfield[-1] = 1
+
+
+def test_fill_clears_spare_bits():
+    bitfield = Bitfield(10, fill=True)
+    assert bitfield.tobytes() == '\xff\xc0'
+    assert bitfield.count() == 10
+    assert bitfield.zeros() == []
+
+
+def test_from_bytes():
+    bitfield = Bitfield.from_bytes('\xa0\x40', 10)
+    assert bitfield.ones() == [0, 2, 9]
+    assert len(Bitfield.from_bytes('\x00\x01')) == 16
+    with pytest.raises(ValueError):
+        Bitfield.from_bytes('\x00', 10)
+    with pytest.raises(ValueError):
+        Bitfield.from_bytes('\x00\x20', 10)
+
+
+def test_ones_zeros_and_count():
+    bitfield = Bitfield(20)
+    for index in (0, 7, 8, 19):
+        bitfield[index] = 1
+    assert bitfield.ones() == [0, 7, 8, 19]
+    assert bitfield.zeros() == [index for index in range(20)
+                                if index not in (0, 7, 8, 19)]
+    assert bitfield.count() == 4
+    assert Bitfield(0).count() == 0
+
+
+def test_all_and_any():
+    bitfield = Bitfield(30)
+    for index in range(5, 25):
+        bitfield[index] = 1
+    assert bitfield.all(5, 25)
+    assert not bitfield.all(4, 25)
+    assert not bitfield.all()
+    assert bitfield.any(24)
+    assert not bitfield.any(25)
+    assert not bitfield.any(0, 5)
+    assert bitfield.all(10, 10)
+
+
+def test_combining():
+    a = Bitfield.from_bytes('\xf0\x80', 10)
+    b = Bitfield.from_bytes('\x3c\x40', 10)
+    assert (a & b).tobytes() == '\x30\x00'
+    assert (a | b).tobytes() == '\xfc\xc0'
+    assert a.and_not(b).tobytes() == '\xc0\x80'
+    assert (~a).tobytes() == '\x0f\x40'
+    assert ~~a == a
+    with pytest.raises(ValueError):
+        a & Bitfield(11)
+
+
+def test_trim():
+    bitfield = Bitfield.from_bytes('\xa0\x00')
+    trimmed = bitfield.trim(3)
+    assert len(trimmed) == 3
+    assert trimmed.ones() == [0, 2]
+    with pytest.raises(ValueError):
+        bitfield.trim(2)
+    with pytest.raises(ValueError):
+        bitfield.trim(17)
@@ -0,0 +1,72 @@
+import pytest
+
+import connbudget
+from connbudget import ConnectionBudget
+from twisted.internet.task import Clock
+
+
+class FakeTorrent(object):
+    def __init__(self, needed=100, swarm=100, rate=0):
+        self.needed = needed
+        self.swarm = swarm
+        self.rate = rate
+
+    def pieces_needed(self):
+        return self.needed
+
+    def swarm_size(self):
+        return self.swarm
+
+    def download_rate(self):
+        return self.rate
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def test_demand_is_capped(clock):
+    budget = ConnectionBudget(clock, 100)
+    grants = budget.allocate({'a': FakeTorrent(),
+                              'b': FakeTorrent(needed=3),
+                              'c': FakeTorrent(swarm=5),
+                              'd': FakeTorrent(needed=0)})
+    assert grants == {'a': connbudget._MAX_SLOTS, 'b': 3, 'c': 5,
+                      'd': connbudget._MIN_SLOTS}
+
+
+def test_unreported_torrent_demands_the_maximum(clock):
+    budget = ConnectionBudget(clock, 100)
+    grants = budget.allocate({'a': FakeTorrent(needed=None)})
+    assert grants == {'a': connbudget._MAX_SLOTS}
+
+
+def test_max_min_fairness(clock):
+    budget = ConnectionBudget(clock, 30)
+    grants = budget.allocate({'a': FakeTorrent(needed=4),
+                              'b': FakeTorrent(),
+                              'c': FakeTorrent()})
+    assert grants == {'a': 4, 'b': 13, 'c': 13}
+
+
+def test_faster_torrent_gets_the_remainder(clock):
+    budget = ConnectionBudget(clock, 5)
+    grants = budget.allocate({'slow': FakeTorrent(rate=2000),
+                              'fast': FakeTorrent(rate=5000)})
+    assert grants == {'slow': 2, 'fast': 3}
+
+
+def test_idle_torrent_is_cut_back(clock):
+    budget = ConnectionBudget(clock, 100)
+    idle = FakeTorrent()
+    busy = FakeTorrent(rate=connbudget._IDLE_RATE)
+    budget.allocate({'idle': idle, 'busy': busy})
+    clock.advance(connbudget._IDLE_TIMEOUT)
+    grants = budget.allocate({'idle': idle, 'busy': busy})
+    assert grants == {'idle': connbudget._IDLE_SLOTS,
+                      'busy': connbudget._MAX_SLOTS}
+
+    # It gets its slots back once it is downloading again
+    idle.rate = connbudget._IDLE_RATE
+    assert budget.allocate({'idle': idle})['idle'] == connbudget._MAX_SLOTS
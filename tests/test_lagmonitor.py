@@ -0,0 +1,62 @@
+import mock
+
+import lagmonitor
+from twisted.internet.task import Clock
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_slow_turn_is_charged_to_the_most_time_in_total():
+    fake = FakeTime()
+
+    def work(seconds):
+        fake.now += seconds
+
+    short = lagmonitor.watch('test.short')(work)
+    long_ = lagmonitor.watch('test.long')(work)
+
+    with mock.patch.object(lagmonitor, 'time', fake):
+        clock = Clock()
+        lagmonitor.start(clock, interval=1, slow=0.1)
+        try:
+            # Three short calls add up to more than the single long one
+            for _ in range(3):
+                short(0.04)
+            long_(0.08)
+            fake.now += 1
+            clock.advance(1)
+        finally:
+            lagmonitor.stop()
+
+    turn = lagmonitor.status()['recent_slow_turns'][-1]
+    assert turn['callback'] == 'test.short'
+    assert abs(turn['callback_seconds'] - 0.12) < 1e-9
+    assert abs(turn['lag'] - 0.2) < 1e-9
+
+
+def test_merge_combines_the_processes():
+    def status(turns, p99, slow):
+        return {'running': True, 'interval': 0.05, 'threshold': 0.1,
+                'turns': turns, 'mean': 0.01, 'p50': 0.005, 'p99': p99,
+                'max': p99, 'slow_turns': len(slow),
+                'recent_slow_turns': [{'time': t, 'lag': 0.2,
+                                       'callback': None,
+                                       'callback_seconds': 0}
+                                      for t in slow],
+                'recent_slow_calls': []}
+
+    merged = lagmonitor.merge([(None, status(10, 0.01, [2.0])),
+                               (0, status(30, 0.25, [1.0, 3.0]))])
+    assert merged['turns'] == 40
+    assert merged['p99'] == 0.25
+    assert merged['slow_turns'] == 3
+    assert [(turn['time'], turn['worker'])
+            for turn in merged['recent_slow_turns']] == [(1.0, 0),
+                                                          (2.0, None),
+                                                          (3.0, 0)]
@@ -0,0 +1,75 @@
+import mock
+import pytest
+
+from membudget import MemoryBudget
+
+
+@pytest.fixture
+def budget():
+    return MemoryBudget(limit=1000)
+
+
+def test_accounts_track_usage(budget):
+    a = budget.account('a')
+    b = budget.account('b')
+    a.charge('write', 100)
+    b.charge('read', 50)
+    assert (a.used, b.used, budget.used()) == (100, 50, 150)
+    a.release('write', 100)
+    assert (a.used, budget.used()) == (0, 50)
+
+
+def test_pressure(budget):
+    account = budget.account('a')
+    account.charge('write', 500)
+    assert not budget.pressure()
+    account.charge('write', 1)
+    assert budget.pressure()
+
+
+def test_pause_and_resume(budget):
+    transport = mock.Mock()
+    budget.register(transport)
+    account = budget.account('a')
+
+    account.charge('write', 1000)
+    assert budget.exhausted()
+    transport.pauseProducing.assert_called_once_with()
+
+    # A transport connecting while the budget is exhausted starts paused
+    late = mock.Mock()
+    budget.register(late)
+    late.pauseProducing.assert_called_once_with()
+
+    account.release('write', 200)
+    assert budget.exhausted()
+    account.release('write', 50)
+    assert not budget.exhausted()
+    transport.resumeProducing.assert_called_once_with()
+    late.resumeProducing.assert_called_once_with()
+
+
+def test_resume_when_only_receive_buffers_are_charged(budget):
+    transport = mock.Mock()
+    budget.register(transport)
+    account = budget.account('a')
+    account.charge('write', 100)
+    account.charge('receive', 950)
+    assert budget.exhausted()
+
+    account.release('write', 100)
+    assert not budget.exhausted()
+    transport.resumeProducing.assert_called_once_with()
+
+
+def test_set_limit(budget):
+    account = budget.account('a')
+    account.charge('read', 600)
+    budget.set_limit(500)
+    assert budget.exhausted()
+    budget.set_limit(1000)
+    assert not budget.exhausted()
+    account.release('read', 600)
+
+    with pytest.raises(ValueError):
+        budget.set_limit(0)
@@ -0,0 +1,83 @@
+import json
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Registry, merge
+
+
+def test_counter_and_gauge():
+    counter = Counter('test_total', "Test")
+    counter.inc()
+    counter.value += 2
+    assert counter.value == 3
+
+    gauge = Gauge('test', "Test")
+    gauge.set(5)
+    gauge.dec(2)
+    assert gauge.value == 3
+
+
+def test_labels_are_cached_children():
+    counter = Counter('test_total', "Test", ('type',))
+    child = counter.labels('choke')
+    assert counter.labels('choke') is child
+    child.inc()
+    assert counter.labels('unchoke').value == 0
+    with pytest.raises(ValueError):
+        counter.labels('choke', 'extra')
+
+
+def test_histogram_buckets_and_quantile():
+    histogram = Histogram('test_seconds', "Test", buckets=(1, 2, 5))
+    assert histogram.quantile(0.5) == 0
+    for value in (0.5, 1, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.count() == 5
+    assert histogram.sum == 16
+    assert histogram.quantile(0.4) == 1
+    assert histogram.quantile(0.6) == 2
+    assert histogram.quantile(1) == float('inf')
+
+
+def test_registry_render():
+    registry = Registry()
+    counter = registry.register(Counter('b_total', "B", ('type',)))
+    counter.labels('x"y').inc()
+    histogram = registry.register(Histogram('a_seconds', "A", buckets=(1,)))
+    histogram.observe(0.5)
+
+    assert registry.render() == (
+        '# HELP a_seconds A\n'
+        '# TYPE a_seconds histogram\n'
+        'a_seconds_bucket{le="1"} 1\n'
+        'a_seconds_bucket{le="+Inf"} 1\n'
+        'a_seconds_sum 0.5\n'
+        'a_seconds_count 1\n'
+        '# HELP b_total B\n'
+        '# TYPE b_total counter\n'
+        'b_total{type="x\\"y"} 1\n')
+
+
+def test_registry_rejects_duplicates():
+    registry = Registry()
+    registry.register(Counter('test_total', "Test"))
+    with pytest.raises(ValueError):
+        registry.register(Gauge('test_total', "Test"))
+    assert registry.get('test_total').type == 'counter'
+
+
+def test_merge_sums_collected_values():
+    def process(blocks, lag):
+        registry = Registry()
+        counter = registry.register(Counter('b_total', "B", ('type',)))
+        counter.labels('choke').inc(blocks)
+        histogram = registry.register(Histogram('a_seconds', "A",
+                                                buckets=(1,)))
+        histogram.observe(lag)
+        return json.loads(json.dumps(registry.collect()))
+
+    merged = merge([process(1, 0.5), process(2, 3)])
+    assert merged.get('b_total').labels('choke').value == 3
+    assert merged.get('a_seconds').counts == [1, 1]
+    assert merged.get('a_seconds').sum == 3.5
+    assert 'b_total{type="choke"} 3\n' in merged.render()
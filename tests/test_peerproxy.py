@@ -0,0 +1,55 @@
+import mock
+
+from peerproxy import PeerProxy
+from twisted.internet.task import Clock
+
+_SNUB_TIMEOUT = 60
+
+
+def make_proxy():
+    # Return a PeerProxy and its Clock which has completed the handshake,
+    # with a stand-in for the peer wire translator
+    clock = Clock()
+    clock.advance(1000)
+    proxy = PeerProxy(mock.Mock(), 'a' * 20, ('127.0.0.1', 6881), clock,
+                      protocol=mock.Mock(), snub_timeout=_SNUB_TIMEOUT)
+    proxy._translator = mock.Mock()
+    proxy._set_state(PeerProxy._States.Peer_to_Peer)
+    return proxy, clock
+
+
+def test_resent_request_is_counted_once():
+    proxy, clock = make_proxy()
+    proxy.request(0, 0, 2**14)
+    proxy.request(0, 0, 2**14)
+    assert proxy._translator.tx_request.call_count == 2
+
+    clock.advance(_SNUB_TIMEOUT)
+    assert proxy.is_snubbed()
+    proxy.rx_piece(0, 0, bytearray(2**14))
+    assert not proxy.is_snubbed()
+    assert proxy.snub_deadline() is None
+
+
+def test_losing_interest_forgets_the_requests():
+    proxy, clock = make_proxy()
+    proxy.interested()
+    proxy.request(0, 0, 2**14)
+    proxy.request(0, 2**14, 2**14)
+    proxy.not_interested()
+    assert proxy.snub_deadline() is None
+
+    clock.advance(_SNUB_TIMEOUT)
+    assert not proxy.is_snubbed()
+
+
+def test_cancel_forgets_the_request():
+    proxy, clock = make_proxy()
+    proxy.request(0, 0, 2**14)
+    proxy.request(0, 2**14, 2**14)
+    proxy.cancel(0, 0, 2**14)
+    assert proxy.snub_deadline() == clock.seconds() + _SNUB_TIMEOUT
+
+    proxy.cancel(0, 2**14, 2**14)
+    clock.advance(_SNUB_TIMEOUT)
+    assert not proxy.is_snubbed()
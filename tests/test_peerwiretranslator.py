@@ -0,0 +1,34 @@
+import mock
+
+from peerwiretranslator import PeerWireTranslator
+
+
+def receive(translator, data):
+    # Feed the bytes to the translator the way a readerwriter does
+    while data:
+        buf, needed = translator.get_rx_buffer()
+        n = min(needed, len(data))
+        buf[:n] = data[:n]
+        data = data[n:]
+        translator.rx_bytes(n)
+
+
+def test_keep_alive_is_four_zero_bytes():
+    readerwriter = mock.Mock()
+    translator = PeerWireTranslator(readerwriter=readerwriter)
+    translator.tx_keep_alive()
+    readerwriter.tx_bytes.assert_called_once_with('\x00\x00\x00\x00')
+
+
+def test_keep_alive_round_trip():
+    readerwriter = mock.Mock()
+    sender = PeerWireTranslator(readerwriter=readerwriter)
+    sender.tx_keep_alive()
+    sender.tx_have(7)
+
+    receiver = mock.Mock()
+    translator = PeerWireTranslator(receiver=receiver)
+    receive(translator, ''.join(args[0] for args, _
+                                in readerwriter.tx_bytes.call_args_list))
+    receiver.rx_keep_alive.assert_called_once_with()
+    receiver.rx_have.assert_called_once_with(7)
@@ -0,0 +1,27 @@
+import marshal
+
+import profiler
+
+
+def test_merge_roots_collapsed_stacks_at_each_process():
+    merged = profiler.merge([('client', "a;b 2\n"),
+                             ('worker 0', "a;b 1\nc 3\n")], 'collapsed')
+    assert merged == "client;a;b 2\nworker 0;a;b 1\nworker 0;c 3\n"
+
+
+def test_merge_adds_raw_stats_together():
+    def work():
+        return sum(range(10))
+
+    results = []
+    for calls in (1, 2):
+        profiler.start('cprofile')
+        for _ in range(calls):
+            work()
+        results.append(("worker {}".format(calls), profiler.stop('pstats')))
+    results.append(('client', marshal.dumps({})))
+
+    stats = marshal.loads(profiler.merge(results, 'pstats'))
+    [(_, ncalls, _, _, _)] = [stat for func, stat in stats.items()
+                              if func[2] == 'work']
+    assert ncalls == 3
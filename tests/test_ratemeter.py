@@ -0,0 +1,47 @@
+import pytest
+
+from ratemeter import RateMeter
+from twisted.internet.task import Clock
+
+
+@pytest.fixture
+def clock():
+    clock = Clock()
+    clock.advance(1000)
+    return clock
+
+
+def test_new_meter_has_no_rate(clock):
+    meter = RateMeter(clock)
+    assert meter.rate() == 0
+    assert meter.total() == 0
+
+
+def test_rate_and_total(clock):
+    meter = RateMeter(clock, period=20)
+    for _ in range(10):
+        clock.advance(1)
+        meter.update(1000)
+    assert meter.total() == 10000
+    assert 800 <= meter.rate() <= 1000
+
+
+def test_rate_decays_when_idle(clock):
+    meter = RateMeter(clock, period=20)
+    for _ in range(20):
+        clock.advance(1)
+        meter.update(1000)
+    busy = meter.rate()
+    clock.advance(10)
+    idle = meter.rate()
+    assert 0 < idle < busy
+    clock.advance(100)
+    assert meter.rate() < idle / 2
+
+
+def test_burst_is_forgotten_after_period(clock):
+    meter = RateMeter(clock, period=20)
+    meter.update(10**6)
+    clock.advance(200)
+    assert meter.rate() < 10**6 / 20.0 / 5
+    assert meter.total() == 10**6
@@ -0,0 +1,89 @@
+import pytest
+
+from scheduler import Scheduler
+from twisted.internet.task import Clock
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def scheduler(clock):
+    return Scheduler(clock)
+
+
+def test_calls_fire_in_deadline_order(clock, scheduler):
+    fired = []
+    scheduler.call_later(3, fired.append, 'c')
+    scheduler.call_later(1, fired.append, 'a')
+    scheduler.call_later(2, fired.append, 'b')
+    clock.advance(1)
+    assert fired == ['a']
+    clock.advance(5)
+    assert fired == ['a', 'b', 'c']
+    assert scheduler.pending() == 0
+
+
+def test_calls_with_same_deadline_fire_in_order_added(clock, scheduler):
+    fired = []
+    for n in range(5):
+        scheduler.call_at(10, fired.append, n)
+    clock.advance(10)
+    assert fired == range(5)
+
+
+def test_cancelled_call_does_not_fire(clock, scheduler):
+    fired = []
+    timer = scheduler.call_later(1, fired.append, 'x')
+    assert timer.active()
+    timer.cancel()
+    assert not timer.active()
+    assert scheduler.pending() == 0
+    clock.advance(2)
+    assert fired == []
+
+
+def test_one_delayed_call_moved_to_earliest_deadline(clock, scheduler):
+    scheduler.call_later(10, lambda: None)
+    scheduler.call_later(5, lambda: None)
+    calls = clock.getDelayedCalls()
+    assert len(calls) == 1
+    assert calls[0].getTime() == 5
+
+
+def test_call_added_by_fired_call_reuses_delayed_call(clock, scheduler):
+    fired = []
+
+    def again(n):
+        fired.append(n)
+        if n < 3:
+            scheduler.call_later(1, again, n + 1)
+
+    scheduler.call_later(1, again, 0)
+    scheduler.call_later(10, fired.append, 'last')
+    for _ in range(3):
+        clock.advance(1)
+        assert len(clock.getDelayedCalls()) == 1
+    clock.advance(10)
+    assert fired == [0, 1, 2, 3, 'last']
+    assert clock.getDelayedCalls() == []
+
+
+def test_exception_in_call_does_not_stop_others(clock, scheduler):
+    fired = []
+    scheduler.call_later(1, lambda: 1 // 0)
+    scheduler.call_later(1, fired.append, 'ok')
+    clock.advance(1)
+    assert fired == ['ok']
+
+
+def test_heap_is_rebuilt_without_cancelled_timers(clock, scheduler):
+    timers = [scheduler.call_later(n + 1, lambda: None) for n in range(200)]
+    for timer in timers[:150]:
+        timer.cancel()
+    assert scheduler.pending() == 50
+    assert len(scheduler._heap) < 200
+    clock.advance(1000)
+    assert scheduler.pending() == 0
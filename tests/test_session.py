@@ -0,0 +1,97 @@
+import mock
+import pytest
+
+from session import SessionStore, StoredTorrent
+from twisted.internet.defer import Deferred, fail, succeed
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = SessionStore(str(tmpdir.join('session.db')))
+    yield store
+    store.close()
+
+
+def resume(wanted, needed, priorities='1'):
+    return {'have': '\x00', 'priorities': priorities, 'peers': [],
+            'wanted': wanted, 'needed': needed}
+
+
+def test_torrents_in_queue_order(store):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    store.add('b', 'b.torrent', 'B', '/tmp')
+    assert [entry['key'] for entry in store.torrents()] == ['a', 'b']
+    assert store.torrents()[0]['needed'] is None
+
+    store.save({'a': resume(4, 1)}, ['b', 'a'])
+    entries = store.torrents()
+    assert [entry['key'] for entry in entries] == ['b', 'a']
+    assert (entries[1]['wanted'], entries[1]['needed']) == (4, 1)
+
+
+def test_files_and_resume_round_trip(store, tmpdir):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    assert store.files('a') is None
+    assert store.resume('a') is None
+
+    store.save_files('a', [['x', 10], ['y', 20]])
+    store.save({'a': resume(2, 2, '01')}, ['a'])
+    store.close()
+
+    store = SessionStore(str(tmpdir.join('session.db')))
+    assert store.files('a') == [['x', 10], ['y', 20]]
+    assert store.resume('a')['priorities'] == '01'
+
+
+def test_stored_torrent_reports_from_the_table(store):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    store.save_files('a', [['x', 10], ['y', 20]])
+    store.save({'a': resume(4, 1, '01')}, ['a'])
+    load = mock.Mock()
+    torrent = StoredTorrent(store, store.torrents()[0], load)
+
+    assert torrent.name() == 'A'
+    assert torrent.state() == 'initialized'
+    assert torrent.percent() == 75.0
+    assert torrent.pieces_needed() == 1
+    assert [f['priority'] for f in torrent.files()] == ['skip', 'low']
+    assert not load.called
+
+
+def test_stored_torrent_loads_once_when_started(store):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    loading = Deferred()
+    load = mock.Mock(return_value=loading)
+    torrent = StoredTorrent(store, store.torrents()[0], load)
+
+    torrent.set_max_peers(7)
+    torrent.start()
+    torrent.read(0, 0, 10)
+    assert load.call_count == 1
+
+    loaded = mock.Mock()
+    loaded.set_max_peers.return_value = None
+    loaded.read.return_value = 'data'
+    loading.callback(loaded)
+    assert torrent.loaded()
+    loaded.set_max_peers.assert_called_once_with(7)
+    loaded.start.assert_called_once_with()
+    loaded.read.assert_called_once_with(0, 0, 10)
+
+
+def test_stored_torrent_which_fails_to_load(store):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    torrent = StoredTorrent(store, store.torrents()[0],
+                            lambda: fail(IOError("No such file")))
+    failures = []
+    torrent.start().addErrback(failures.append)
+    assert len(failures) == 1
+    assert torrent.state() == 'failed'
+
+
+def test_stopping_unloaded_torrent_doesnt_load_it(store):
+    store.add('a', 'a.torrent', 'A', '/tmp')
+    load = mock.Mock(return_value=succeed(mock.Mock()))
+    torrent = StoredTorrent(store, store.torrents()[0], load)
+    torrent.stop()
+    assert not load.called
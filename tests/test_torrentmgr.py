@@ -0,0 +1,405 @@
+import bencode
+import hashlib
+import mock
+import pytest
+
+import torrentmgr
+from bitfield import Bitfield
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+_BLOCK = torrentmgr._BLOCK_SIZE
+_PIECE_LENGTH = 4 * _BLOCK
+_PIECES = 2
+_PEER_ID = "-HS0001-" + "T" * 12
+
+
+class FakePeer(object):
+    """
+    A stand-in for a PeerProxy which records the blocks requested of it and
+    sends good or bad data for them when told to.
+    """
+
+    def __init__(self, port, data):
+        self._addr = ('10.0.0.1', port)
+        self._data = data
+        self.bad = False
+        self.requests = []
+        self.cancels = []
+        self.choked = False
+        self.interested_in = False
+        self.dropped = False
+        self.snubbed = False
+        self.deadline = None
+
+    def addr(self):
+        return self._addr
+
+    def request(self, index, begin, length):
+        self.requests.append((index, begin, length))
+
+    def cancel(self, index, begin, length):
+        # A cancel for a block which is no longer outstanding is ignored
+        self.cancels.append((index, begin, length))
+        if (index, begin, length) in self.requests:
+            self.requests.remove((index, begin, length))
+
+    def send(self, mgr, count=None):
+        # Send the requested blocks in order
+        sent = 0
+        while self.requests and (count is None or sent < count):
+            index, begin, length = self.requests.pop(0)
+            offset = index * _PIECE_LENGTH + begin
+            buf = self._data[offset:offset + length]
+            if self.bad:
+                buf = chr(ord(buf[0]) ^ 0xff) + buf[1:]
+            mgr.peer_sent_block(self, index, begin, buf)
+            sent += 1
+
+    def choke(self, mgr):
+        self.choked = True
+        self.requests = []
+        mgr.peer_choked(self)
+
+    def unchoke(self, mgr):
+        self.choked = False
+        mgr.peer_unchoked(self)
+
+    def reject(self, mgr, index):
+        # Reject the outstanding requests for blocks of the piece
+        rejected = [request for request in self.requests
+                    if request[0] == index]
+        self.requests = [request for request in self.requests
+                         if request[0] != index]
+        for request in rejected:
+            mgr.peer_rejected(self, *request)
+
+    def interested(self):
+        self.interested_in = True
+
+    def not_interested(self):
+        self.interested_in = False
+
+    def is_interested(self):
+        return self.interested_in
+
+    def drop_connection(self):
+        self.dropped = True
+
+    def is_snubbed(self):
+        return self.snubbed
+
+    def snub_deadline(self):
+        return self.deadline
+
+    def is_peer_choked(self):
+        return self.choked
+
+    def is_allowed_fast(self, index):
+        return False
+
+    def supports_fast(self):
+        return False
+
+    def is_connected(self):
+        return True
+
+    def download_rate(self):
+        return 0.0
+
+    def upload_rate(self):
+        return 0.0
+
+    def downloaded(self):
+        return 0
+
+    def uploaded(self):
+        return 0
+
+    def last_activity(self):
+        return 0, 0, None
+
+    def haves(self, indices):
+        pass
+
+    def exchange_peers(self, addrs):
+        pass
+
+
+class Swarm(object):
+    """
+    A TorrentMgr for a two piece torrent whose tracker, files and disk are
+    replaced by stand-ins, along with the peers it connects to.  The peers
+    stand in for PeerProxies until close() is called.
+    """
+
+    def __init__(self, directory, num_peers,
+                 max_peers=torrentmgr._MAX_PEERS):
+        self.data = ''.join(hashlib.sha512(str(n)).digest()
+                            for n in range(_PIECES * _PIECE_LENGTH // 64))
+        pieces = ''.join(hashlib.sha1(self.data[offset:offset +
+                                                _PIECE_LENGTH]).digest()
+                         for offset in range(0, len(self.data),
+                                             _PIECE_LENGTH))
+        filename = str(directory.join('test.torrent'))
+        with open(filename, 'wb') as f:
+            f.write(bencode.bencode({'announce': 'http://127.0.0.1:0/',
+                                     'info': {'name': 'test.bin',
+                                              'length': len(self.data),
+                                              'piece length': _PIECE_LENGTH,
+                                              'pieces': pieces}}))
+
+        self.clock = Clock()
+        self.peers = [FakePeer(6881 + n, self.data) for n in range(num_peers)]
+        by_addr = {peer.addr(): peer for peer in self.peers}
+
+        tracker = mock.Mock()
+        tracker.start.return_value = succeed(None)
+        addrs = [{'ip': peer.addr()[0], 'port': peer.addr()[1]}
+                 for peer in self.peers]
+        tracker.get_peers.side_effect = lambda n: succeed(
+            [addrs.pop(0) for _ in range(min(n, len(addrs)))])
+        tracker.available_peers.return_value = []
+
+        filemgr = mock.Mock()
+        filemgr.have.return_value = Bitfield(_PIECES)
+        filemgr.written.return_value = succeed(None)
+        self.filemgr = filemgr
+
+        diskio = mock.Mock()
+        diskio.congested.return_value = False
+
+        self._peer_proxy = mock.patch('torrentmgr.PeerProxy',
+                                      side_effect=lambda client, peer_id,
+                                      addr, reactor, **kwargs: by_addr[addr])
+        self._peer_proxy.start()
+
+        patches = [mock.patch('torrentmgr.TrackerProxy',
+                              return_value=tracker),
+                   mock.patch('torrentmgr.FileMgr', return_value=filemgr),
+                   mock.patch('torrentmgr.get_diskio', return_value=diskio)]
+        for patch in patches:
+            patch.start()
+        try:
+            self.mgr = torrentmgr.TorrentMgr(filename, 6881, _PEER_ID,
+                                             self.clock, max_peers=max_peers)
+            self.mgr.initialize()
+            self.mgr.start()
+        finally:
+            for patch in patches:
+                patch.stop()
+
+    def close(self):
+        self._peer_proxy.stop()
+
+    def has(self, peer, index):
+        self.mgr.peer_has(peer, index)
+
+    def strikes(self):
+        return [stats['strikes'] for stats in
+                sorted(self.mgr.peer_stats(), key=lambda s: s['addr'])]
+
+
+@pytest.fixture
+def swarm(tmpdir):
+    swarms = []
+
+    def make(num_peers, **kwargs):
+        swarms.append(Swarm(tmpdir, num_peers, **kwargs))
+        return swarms[-1]
+
+    yield make
+    for s in swarms:
+        s.close()
+
+
+def test_piece_from_one_peer(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+    assert peer.interested_in
+    peer.send(s.mgr)
+    assert s.mgr.pieces_needed() == 1
+    assert s.mgr.get_bitfield()[0]
+
+
+def test_snubbed_peer_is_relieved_at_snub_timeout(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+    peer.deadline = s.clock.seconds() + torrentmgr._SNUB_TIMEOUT
+
+    # The peer isn't relieved before it is snubbed
+    s.clock.advance(torrentmgr._SNUB_TIMEOUT - 1)
+    assert peer.interested_in
+
+    peer.snubbed = True
+    s.clock.advance(1)
+    assert not peer.interested_in
+    assert s.mgr.peer_counts() == (1, 1)
+
+
+def test_snubbing_peers_are_replaced_at_the_peer_limit(swarm):
+    s = swarm(4, max_peers=2)
+    a, b, c, d = s.peers
+    for peer in (a, b):
+        s.has(peer, 0)
+        s.has(peer, 1)
+        peer.snubbed = True
+    assert a.requests and b.requests
+
+    # Both are dropped to make room for the peers which weren't connected
+    s.clock.advance(torrentmgr._SNUB_TIMEOUT)
+    assert a.dropped and b.dropped
+    s.has(c, 0)
+    s.has(d, 1)
+    assert c.requests and d.requests
+
+
+def test_snub_deadline_follows_progress(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+
+    # A block arriving pushes the moment the peer would be snubbed back
+    s.clock.advance(30)
+    peer.send(s.mgr, 1)
+    peer.deadline = s.clock.seconds() + torrentmgr._SNUB_TIMEOUT
+    s.clock.advance(30)
+    assert peer.interested_in
+
+    peer.snubbed = True
+    s.clock.advance(30)
+    assert not peer.interested_in
+
+
+def test_released_piece_cancels_outstanding_requests(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+    peer.send(s.mgr, 1)
+
+    peer.snubbed = True
+    s.clock.advance(torrentmgr._SNUB_TIMEOUT)
+    assert peer.cancels == [(0, begin, _BLOCK) for begin
+                            in range(_BLOCK, _PIECE_LENGTH, _BLOCK)]
+    assert peer.requests == []
+
+
+def test_choking_peer_is_not_sent_cancels(swarm):
+    # Without the Fast Extension, choking discards the requests
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+    peer.send(s.mgr, 1)
+    peer.choke(s.mgr)
+    assert peer.cancels == []
+
+
+def test_unchoked_peer_is_given_another_piece_after_rejecting(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    s.has(peer, 0)
+    s.has(peer, 1)
+    first = peer.requests[0][0]
+    peer.send(s.mgr, 1)
+
+    # The partly downloaded piece isn't handed straight back to the peer
+    peer.reject(s.mgr, first)
+    assert peer.requests
+    assert all(index != first for index, _, _ in peer.requests)
+
+    # Once it has rejected both pieces there is nothing to ask it for
+    peer.reject(s.mgr, 1 - first)
+    assert peer.requests == []
+    assert not peer.interested_in
+
+
+def test_skipping_piece_being_written(swarm):
+    s = swarm(1)
+    peer = s.peers[0]
+    written = Deferred()
+    s.filemgr.written.return_value = written
+    s.has(peer, 0)
+    peer.send(s.mgr)
+
+    # A verified piece whose write is pending is neither had nor needed, so
+    # skipping the file and wanting it again doesn't download it again
+    s.mgr.set_priority('skip')
+    assert s.mgr.pieces_needed() == 0
+    s.mgr.set_priority('normal')
+    assert s.mgr.pieces_needed() == 1
+
+    written.callback(None)
+    assert s.mgr.get_bitfield()[0]
+    assert s.mgr.pieces_needed() == 1
+
+
+def test_one_bad_sender_is_banned(swarm):
+    s = swarm(3)
+    a, b, c = s.peers
+    b.bad = True
+    for index in range(_PIECES):
+        # a sends half of the piece and b the rest, spoiling it.  Only b's
+        # half is downloaded again, from c, after which the piece passes.
+        s.has(a, index)
+        a.send(s.mgr, 2)
+        a.choke(s.mgr)
+        s.has(b, index)
+        b.send(s.mgr)
+        assert not s.mgr.get_bitfield()[index]
+        s.has(c, index)
+        assert c.requests[0] == (index, 2 * _BLOCK, _BLOCK)
+        c.send(s.mgr)
+        assert s.mgr.get_bitfield()[index]
+        a.unchoke(s.mgr)
+
+    assert b.dropped
+    assert not a.dropped and not c.dropped
+    assert s.strikes() == [0, 0]
+
+
+def test_bad_sender_in_the_middle(swarm):
+    s = swarm(4)
+    a, b, c, d = s.peers
+    b.bad = True
+    s.has(a, 0)
+    a.send(s.mgr, 1)
+    a.choke(s.mgr)
+    s.has(b, 0)
+    b.send(s.mgr, 1)
+    b.choke(s.mgr)
+    s.has(c, 0)
+    c.send(s.mgr)
+
+    # c's blocks are downloaded again from d, which doesn't help, and then
+    # b's and c's are
+    s.has(d, 0)
+    assert d.requests[0] == (0, 2 * _BLOCK, _BLOCK)
+    d.send(s.mgr, 2)
+    assert not s.mgr.get_bitfield()[0]
+    assert d.requests[0] == (0, _BLOCK, _BLOCK)
+    d.send(s.mgr)
+    assert s.mgr.get_bitfield()[0]
+
+    # Only b is known to have sent bad data
+    assert s.strikes() == [0, 1, 0, 0]
+
+
+def test_retry_succeeds_after_two_rounds(swarm):
+    s = swarm(3)
+    a, b, c = s.peers
+    a.bad = True
+    s.has(a, 0)
+    a.send(s.mgr, 2)
+    a.choke(s.mgr)
+    s.has(b, 0)
+    b.send(s.mgr)
+
+    s.has(c, 0)
+    c.send(s.mgr, 2)
+    assert not s.mgr.get_bitfield()[0]
+    assert c.requests[0] == (0, 0, _BLOCK)
+    c.send(s.mgr)
+    assert s.mgr.get_bitfield()[0]
+    assert s.strikes() == [1, 0, 0]
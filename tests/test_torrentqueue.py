@@ -0,0 +1,122 @@
+import mock
+import pytest
+
+import torrentqueue
+from torrentqueue import TorrentQueue
+from twisted.internet.task import Clock
+
+
+class FakeTorrent(object):
+    def __init__(self, name, percent=0):
+        self._name = name
+        self.percent_done = percent
+        self.started = False
+        self.max_peers = None
+        self.status = 'initialized'
+
+    def name(self):
+        return self._name
+
+    def state(self):
+        return self.status
+
+    def percent(self):
+        return self.percent_done
+
+    def pieces_needed(self):
+        return 100
+
+    def swarm_size(self):
+        return 100
+
+    def download_rate(self):
+        return 0
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+    def set_max_peers(self, n):
+        self.max_peers = n
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def make_queue(clock, names, **limits):
+    queue = TorrentQueue(clock, **limits)
+    torrents = [FakeTorrent(name) for name in names]
+    queue.extend(zip(names, torrents))
+    return queue, torrents
+
+
+def test_only_the_first_downloads_are_active(clock):
+    queue, torrents = make_queue(clock, 'abc', downloads=2)
+    assert [t.started for t in torrents] == [True, True, False]
+    assert [queue.state(key) for key in 'abc'] == ['downloading',
+                                                   'downloading', 'queued']
+
+
+def test_completed_download_makes_room(clock):
+    queue, torrents = make_queue(clock, 'abc', downloads=1, seeds=1)
+    torrents[0].percent_done = 100
+    clock.advance(torrentqueue._CHECK_INTERVAL)
+    assert queue.state('a') == 'seeding'
+    assert [t.started for t in torrents] == [True, True, False]
+
+
+def test_move_and_set_limits(clock):
+    queue, torrents = make_queue(clock, 'abc', downloads=1)
+    queue.move('c', 0)
+    assert queue.order() == ['c', 'a', 'b']
+    assert [t.started for t in torrents] == [False, False, True]
+
+    assert queue.set_limits(downloads=2)['downloads'] == 2
+    assert [t.started for t in torrents] == [True, False, True]
+
+    with pytest.raises(ValueError):
+        queue.move('d', 0)
+    with pytest.raises(ValueError):
+        queue.move('a', 3)
+    with pytest.raises(ValueError):
+        queue.set_limits(connections=0)
+
+
+def test_stalled_download_moves_to_end(clock):
+    queue, torrents = make_queue(clock, 'ab', downloads=1)
+    clock.advance(torrentqueue._STALL_TIMEOUT)
+    clock.advance(torrentqueue._CHECK_INTERVAL)
+    assert queue.order() == ['b', 'a']
+    assert [t.started for t in torrents] == [False, True]
+
+
+def test_progressing_download_keeps_its_place(clock):
+    queue, torrents = make_queue(clock, 'ab', downloads=1)
+    for step in range(1, 100):
+        torrents[0].percent_done = step / 10.0
+        clock.advance(torrentqueue._CHECK_INTERVAL)
+    assert queue.order() == ['a', 'b']
+
+
+def test_unavailable_torrents_are_never_active(clock):
+    queue, torrents = make_queue(clock, 'ab', downloads=1)
+    torrents[0].status = 'lost'
+    clock.advance(torrentqueue._CHECK_INTERVAL)
+    assert queue.state('a') == 'lost'
+    assert torrents[1].started
+
+
+def test_failed_call_is_logged(clock):
+    queue = TorrentQueue(clock)
+    torrent = FakeTorrent('a')
+
+    def start():
+        raise IOError("No such file")
+    torrent.start = start
+    with mock.patch.object(torrentqueue.logger, 'error') as error:
+        queue.add('a', torrent)
+    assert "No such file" in error.call_args[0][0]
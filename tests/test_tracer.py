@@ -0,0 +1,80 @@
+import pytest
+
+import tracer
+
+
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+    # The tracer keeps its state in the module, which is restored afterwards
+    for name in ('enabled', 'sample_every', '_capacity', '_buffer', '_next',
+                 '_count', '_skipped', '_source'):
+        monkeypatch.setattr(tracer, name, getattr(tracer, name))
+
+
+def test_record_and_decode():
+    tracer.enable(capacity=8)
+    assert tracer.enabled
+    tracer.record(tracer.REQUEST, ('10.0.0.1', 6881), 1, 2, 3)
+    tracer.record(tracer.CHOKE, None)
+
+    records = tracer.decode(tracer.dump())
+    assert [r['event'] for r in records] == ['request', 'choke']
+    assert records[0]['addr'] == '10.0.0.1:6881'
+    assert records[0]['args'] == [1, 2, 3]
+    assert records[1]['addr'] == '0.0.0.0:0'
+
+
+def test_ring_buffer_keeps_newest_records():
+    tracer.enable(capacity=4)
+    for n in range(10):
+        tracer.record(tracer.HAVE, None, n)
+
+    records = tracer.decode(tracer.dump())
+    assert [r['args'][0] for r in records] == [6, 7, 8, 9]
+    assert tracer.status()['records'] == 4
+    assert tracer.status()['recorded'] == 10
+
+
+def test_sampling():
+    tracer.enable(sample=3, capacity=8)
+    for n in range(9):
+        tracer.record(tracer.HAVE, None, n)
+    assert [r['args'][0] for r in tracer.decode(tracer.dump())] == [2, 5, 8]
+
+
+def test_disable_keeps_records_and_clear_discards_them():
+    tracer.enable(capacity=4)
+    tracer.record(tracer.HAVE, None)
+    tracer.disable()
+    assert not tracer.enabled
+    assert len(tracer.decode(tracer.dump())) == 1
+
+    tracer.clear()
+    assert tracer.dump() == ''
+
+
+def test_merge_orders_records_of_each_process_by_time(monkeypatch):
+    times = iter([1.0, 3.0, 2.0, 4.0])
+    monkeypatch.setattr(tracer.time, 'time', lambda: next(times))
+
+    tracer.enable(capacity=4)
+    tracer.record(tracer.HAVE, None, 1)
+    tracer.record(tracer.HAVE, None, 3)
+    client = tracer.dump()
+
+    tracer.clear()
+    tracer.set_source(2)
+    tracer.record(tracer.HAVE, None, 2)
+    tracer.record(tracer.HAVE, None, 4)
+    worker = tracer.dump()
+
+    records = tracer.decode(tracer.merge([client, worker]))
+    assert [r['args'][0] for r in records] == [1, 2, 3, 4]
+    assert [r['worker'] for r in records] == [None, 1, None, 1]
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        tracer.enable(sample=0)
+    with pytest.raises(ValueError):
+        tracer.enable(capacity=0)
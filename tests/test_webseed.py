@@ -0,0 +1,195 @@
+import hashlib
+import mock
+
+import membudget
+import webseed
+from webseed import WebSeed
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.trial import unittest
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+_BLOCK = 2**14
+_PIECE_LENGTH = 4 * _BLOCK
+_PIECES = 2
+
+
+class Server(Resource):
+    """
+    An HTTP server publishing a single file which answers GETs with a Range
+    header according to its mode: honour the range, ignore it and send the
+    whole file, send less than asked for or send 404 Not Found.
+    """
+    isLeaf = True
+
+    def __init__(self, data):
+        Resource.__init__(self)
+        self.data = data
+        self.mode = 'honour'
+        self.ranges = []
+
+    def render_GET(self, request):
+        header = request.getHeader('range')
+        self.ranges.append(header)
+        if self.mode == 'missing':
+            request.setResponseCode(404)
+            return "Not found"
+        if self.mode == 'ignore':
+            return self.data
+
+        start, end = [int(n) for n in header[len('bytes='):].split('-')]
+        body = self.data[start:end + 1]
+        if self.mode == 'short':
+            body = body[:-100]
+        request.setResponseCode(206)
+        request.setHeader('content-range', "bytes {}-{}/{}".format(
+            start, start + len(body) - 1, len(self.data)))
+        return body
+
+
+class Client(object):
+    """
+    A stand-in for the TorrentMgr which records the blocks a WebSeed sends.
+    finished fires once the expected number of blocks has arrived or the
+    WebSeed has become unconnected, after the WebSeed has returned.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.blocks = []
+        self.unconnected = False
+        self.finished = Deferred()
+
+    def peer_sent_block(self, seed, index, begin, buf):
+        self.blocks.append((index, begin, buf))
+        if len(self.blocks) == self.expected:
+            reactor.callLater(0, self.finished.callback, None)
+
+    def peer_unconnected(self, seed):
+        self.unconnected = True
+        reactor.callLater(0, self.finished.callback, None)
+
+
+class WebSeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join(hashlib.sha512(str(n)).digest()
+                            for n in range(_PIECES * _PIECE_LENGTH // 64))
+        self.server = Server(self.data)
+        self.port = reactor.listenTCP(0, Site(self.server),
+                                      interface='127.0.0.1')
+        self.addCleanup(self.port.stopListening)
+        self.addCleanup(
+            webseed.get_agent(reactor)._pool.closeCachedConnections)
+
+        self.metainfo = mock.Mock(piece_length=_PIECE_LENGTH,
+                                  files=[(['test.bin'], len(self.data))],
+                                  directory='', name='test.bin')
+        self.account = membudget.MemoryBudget().account('test')
+
+    def url(self, port=None):
+        return "http://127.0.0.1:{}/test.bin".format(
+            port or self.port.getHost().port)
+
+    def fetch(self, blocks, expected=None, url=None):
+        # Request the blocks of a new WebSeed and return the Client once
+        # they have arrived or the WebSeed has failed
+        client = Client(len(blocks) if expected is None else expected)
+        seed = WebSeed(client, url or self.url(), self.metainfo, reactor,
+                       self.account)
+        seed.interested()
+        for index, begin in blocks:
+            seed.request(index, begin, _BLOCK)
+        return client.finished.addCallback(lambda _: client)
+
+    def block(self, index, begin):
+        offset = index * _PIECE_LENGTH + begin
+        return self.data[offset:offset + _BLOCK]
+
+    def test_consecutive_blocks_share_a_range(self):
+        def check(client):
+            self.assertEqual(self.server.ranges,
+                             ["bytes=0-32767", "bytes=81920-98303"])
+            self.assertEqual(client.blocks,
+                             [(0, 0, self.block(0, 0)),
+                              (0, _BLOCK, self.block(0, _BLOCK)),
+                              (1, _BLOCK, self.block(1, _BLOCK))])
+            self.assertFalse(client.unconnected)
+            self.assertEqual(self.account.used, 0)
+
+        return self.fetch([(0, 0), (0, _BLOCK),
+                           (1, _BLOCK)]).addCallback(check)
+
+    def test_cancelled_block_is_not_fetched(self):
+        client = Client(1)
+        seed = WebSeed(client, self.url(), self.metainfo, reactor,
+                       self.account)
+        seed.interested()
+        seed.request(0, 0, _BLOCK)
+        seed.request(0, _BLOCK, _BLOCK)
+        seed.cancel(0, _BLOCK, _BLOCK)
+
+        def check(_):
+            self.assertEqual(self.server.ranges, ["bytes=0-16383"])
+            self.assertEqual(client.blocks, [(0, 0, self.block(0, 0))])
+            self.assertIsNone(seed.snub_deadline())
+
+        return client.finished.addCallback(check)
+
+    def test_short_response_drops_the_seed(self):
+        failures = webseed._failures.value
+
+        def check(client):
+            # The blocks which did arrive are handed over and the charge
+            # for the rest is released
+            self.assertTrue(client.unconnected)
+            self.assertEqual(len(client.blocks), 3)
+            self.assertEqual(webseed._failures.value, failures + 1)
+            self.assertEqual(self.account.used, 0)
+
+        self.server.mode = 'short'
+        return self.fetch([(0, begin) for begin
+                           in range(0, _PIECE_LENGTH, _BLOCK)],
+                          expected=4).addCallback(check)
+
+    def test_whole_file_for_range_drops_the_seed(self):
+        def check(client):
+            self.assertTrue(client.unconnected)
+            self.assertEqual(client.blocks, [])
+            self.assertEqual(self.account.used, 0)
+
+        self.server.mode = 'ignore'
+        return self.fetch([(0, 0)]).addCallback(check)
+
+    def test_whole_file_for_whole_file_is_accepted(self):
+        def check(client):
+            self.assertFalse(client.unconnected)
+            self.assertEqual(''.join(buf for _, _, buf in client.blocks),
+                             self.data)
+
+        self.server.mode = 'ignore'
+        return self.fetch([(index, begin) for index in range(_PIECES)
+                           for begin in range(0, _PIECE_LENGTH, _BLOCK)]
+                          ).addCallback(check)
+
+    def test_not_found_drops_the_seed(self):
+        def check(client):
+            self.assertTrue(client.unconnected)
+            self.assertEqual(client.blocks, [])
+
+        self.server.mode = 'missing'
+        return self.fetch([(0, 0)]).addCallback(check)
+
+    def test_connection_error_drops_the_seed(self):
+        # Find a port which nothing is listening on
+        port = reactor.listenTCP(0, Site(self.server), interface='127.0.0.1')
+        number = port.getHost().port
+
+        def check(client):
+            self.assertTrue(client.unconnected)
+            self.assertEqual(self.account.used, 0)
+
+        d = port.stopListening()
+        d.addCallback(lambda _: self.fetch([(0, 0)], url=self.url(number)))
+        return d.addCallback(check)
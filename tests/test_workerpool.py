@@ -0,0 +1,43 @@
+import json
+
+import workerpool
+from commands import MsgError
+from workercommands import WorkerFetch, WorkerTraceDump
+from workerpool import Worker, WorkerPool
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+
+
+def test_result_is_read_in_chunks():
+    data = 'x' * (2 * workerpool._FETCH_SIZE + 10)
+    fetches = []
+
+    def call(command, **kwargs):
+        if command is WorkerFetch:
+            assert kwargs['result'] == 7
+            fetches.append(kwargs['length'])
+            offset = kwargs['offset']
+            return succeed(dict(data=data[offset:offset + kwargs['length']]))
+        assert command is WorkerTraceDump
+        return succeed(dict(result=7, size=len(data)))
+
+    worker = Worker(Clock(), 0)
+    worker.call = call
+    results = []
+    worker.call_result(WorkerTraceDump).addCallback(results.append)
+    assert results == [data]
+    assert fetches == [workerpool._FETCH_SIZE, workerpool._FETCH_SIZE, 10]
+
+
+def test_gather_leaves_out_failed_workers():
+    pool = WorkerPool(Clock(), 3)
+    responses = [fail(MsgError("Worker 0 is not running")),
+                 succeed(dict(lag=json.dumps({'turns': 4}))),
+                 succeed(dict(lag=json.dumps({'turns': 5})))]
+    for worker, response in zip(pool._workers, responses):
+        worker._running = True
+        worker.call = lambda command, response=response: response
+
+    results = []
+    pool.get_lag().addCallback(results.append)
+    assert results == [[(1, {'turns': 4}), (2, {'turns': 5})]]
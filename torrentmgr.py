@@ -12,59 +12,248 @@ including end game strategy.  It also manages the amount of download and
 upload traffic (not implemented).
 
 This implementation of the TorrentMgr is simple in many ways.  Initially, it
-opens a fixed number of connections with peers.  Upon receipt of a bitfield
+opens connections with up to max_peers peers, which is _MAX_PEERS unless set
+with set_max_peers().  Upon receipt of a bitfield
 or have message which includes a needed piece, it expresses interest to that
-peer.  When that peer unchokes, it starts sequentially requesting blocks for
-that piece.  If the peer chokes in the middle of the piece, the data received
-so far is put aside and the rest of the piece is assigned to the next free,
-unchoked peer which has the piece.  When a connected peer has multiple needed
-pieces, the rarest piece across all peers is chosen to acquire.  When a peer
-delivers a complete piece and has no other needed pieces, the TorrentMgr tells
-it that it is no longer interested.  Then it opens a connection to an
-additional peer.  Generally, the number of peers for whom the TorrentMgr is
-interested stays at the fixed number although it will temporarily exceed that
-number when a peer for whom there was no interest notifies the TorrentMgr
-that it has obtained a needed piece.
-
-Periodically, the TorrentMgr checks the peers that are interested or requesting
-to try to rectify potential hung situations such as when a peer is interested
-but unchoked for a long period of time or when it has an outstanding request
-over a long period of time.
-
-This TorrentMgr does not currently implement pipelined requests, an endgame
-strategy or uploading.
+peer.  When that peer unchokes, it starts requesting the blocks of that piece
+in order, keeping up to _PIPELINE_DEPTH requests outstanding.  If the peer
+chokes in the middle of the piece, the data received so far is put aside and
+the rest of the piece is assigned to the next free, unchoked peer which has
+the piece.  When a connected peer has multiple needed
+pieces, the rarest piece across all peers is chosen to acquire.  The rarest
+and largest pieces are given to the fastest peers while slower peers are given
+more common pieces so that a rare piece is not held up by a slow peer.  When a
+peer delivers a complete piece and has no other needed pieces, the TorrentMgr
+tells it that it is no longer interested.  Then it opens a connection to an
+additional peer.  Since uploading is not implemented, a peer with nothing
+needed is disconnected to make room when the TorrentMgr already has max_peers
+peers, so the number of connections never exceeds max_peers.
+
+The TorrentMgr sets a deadline whenever it expresses interest in a peer or
+makes a request of a peer to try to rectify potential hung situations such as
+when a peer is interested but unchoked for a long period of time or when it
+has an outstanding request over a long period of time.  The deadlines are kept
+by the Scheduler shared by all TorrentMgrs and are cancelled when the peer
+makes progress.  Each PeerProxy keeps track of the download and upload rates of
+its peer and considers the peer snubbed when it delivers nothing for the snub
+timeout.  While a peer is being requested from, the TorrentMgr keeps a
+deadline for the moment the peer would become snubbed, which is pushed back
+lazily when the deadline arrives and blocks have come in since it was set.
+A snubbed peer is relieved of the piece it was assigned as soon as its
+deadline passes and is not assigned another until it delivers data again.
+
+With peers which support the Fast Extension, a choke leaves the outstanding
+request in place since the peer either serves it or rejects it explicitly.  A
+rejected request frees the piece for other peers immediately.  A peer which is
+choking this client is given one of the pieces it has declared allowed fast,
+if it has one that is needed, and is asked for it without waiting to be
+unchoked.  Requests from such peers are rejected since uploading is not
+implemented.
+
+The TorrentMgr can also stream a torrent or one of its files.  While
+streaming is on, the pieces in a window of _STREAM_WINDOW pieces ahead of the
+read position are given to fast peers before the rarest pieces.  The read
+position starts at the beginning of the streamed file and follows the reads
+made with read(), which return deferreds that fire once the pieces they
+cover have been verified.
+
+Each file has a priority of skip, low, normal or high, which is normal unless
+set with set_priority().  A piece has the highest priority of the files it
+overlaps, so a piece which a skipped file shares with a wanted file is still
+downloaded.  Only the pieces which are not skipped are needed and counted by
+percent(), and pieces of higher priority are chosen before rarer pieces of
+lower priority.
+
+The TorrentMgr records who sent each block of a piece as the offsets at
+which peers took the piece over, along with the hash of the bytes before each
+offset.  When a piece fails the hash check, only the blocks sent by its last
+sender are downloaded again, from other peers where possible, resuming the
+hash from that sender's offset.  If the piece then passes, that sender is
+known to have sent bad data.  If it fails again, the blocks of one more sender
+are downloaded again, and so on until the whole piece has been.  A peer which
+has sent bad data for _BAN_STRIKES pieces is disconnected and banned from the
+torrent, and the number of pieces each peer has spoiled is reported with its
+statistics.
+
+Blocks are written to disk by the FileMgr in a thread pool shared by all
+TorrentMgrs (see diskio.py).  A verified piece is only marked as had once its
+blocks are on disk and is needed again if they couldn't be written.  While
+the disk is congested, requests to peers are held back and are sent once it
+has caught up.
+
+The data held for a torrent is charged to its account with the process wide
+memory budget (see membudget.py).  While the budget is under pressure, only
+one request is kept outstanding with each peer.
+
+Once a piece has been written, the connected peers are told that it is
+available.  The pieces written within _HAVE_WINDOW seconds are announced
+together, with the have messages for each peer sent in a single write rather
+than one small write per piece.  When the TorrentMgr is created with
+suppress_haves, peers are not sent have messages for pieces they already
+have.
+
+Peers are found through the tracker and, unless the torrent is private,
+through Peer Exchange (ut_pex).  The addresses which peers send are added to
+the TrackerProxy's peer list and the TorrentMgr connects to new peers
+whenever it has fewer than max_peers.  Every _PEX_INTERVAL seconds, each peer
+which supports Peer Exchange is sent the changes to the set of connected
+peers.
+
+Events on the hot paths, such as requests, blocks and haves, are recorded by
+the tracer when tracing is turned on rather than being logged.
+
+A started TorrentMgr can be stopped with stop(), which disconnects every
+peer, cancels its timers and closes its files so that a torrent waiting in
+the client's queue (see torrentqueue.py) holds no sockets or open files.  The
+addresses of the peers are handed back to the TrackerProxy so that they are
+connected to again when the TorrentMgr is next started.
+
+The files of a torrent are saved under save_path, the current directory by
+default.  resume_data() returns what the client's session store (see
+session.py) keeps so that a TorrentMgr created after a restart with the data
+as resume carries on where this one left off: the pieces on disk, the file
+priorities and the addresses of peers.  The pieces are trusted without
+hashing them again as long as the files which hold them are still long
+enough.
+
+The web seeds listed in the metainfo (see webseed.py) are treated as peers
+which have every piece and never choke, but which don't count against
+max_peers and are not handed to the tracker or other peers.  They are kept
+for the pieces which the peers can't supply well: a web seed is given a
+piece only when no more than _WEB_SEED_RARITY peers have it or, in the
+endgame, when no more needed pieces are left unreserved than there are peers
+requesting, in which case it may also take over a piece reserved for a peer
+which is waiting to be unchoked.  Web seeds are asked for up to
+_WEB_SEED_PIPELINE_DEPTH blocks at once, which they fetch with a single HTTP
+request, and are held back along with the peers while the disk is congested
+or memory is short.  A web seed whose request fails is dropped and added
+again after _WEB_SEED_RETRY seconds.
+
+Apart from the web seeds taking over the last pieces, this TorrentMgr does
+not currently implement an endgame strategy or uploading.
 """
 
 import hashlib
+import lagmonitor
 import logging
-from bitstring import BitArray
+import membudget
+import metrics
+import tracer
+from bitfield import Bitfield
+from diskio import get_diskio
 from filemgr import FileMgr
 from metainfo import Metainfo
 from peerproxy import PeerProxy
+from scheduler import get_scheduler
 from trackerproxy import TrackerProxy
+from webseed import WebSeed
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
 
 logger = logging.getLogger('bt.torrentmgr')
 
 _BLOCK_SIZE = 2**14
-_TIMER_INTERVAL = 10
+_INTEREST_TIMEOUT = 40
+_REQUEST_TIMEOUT = 50
 _MAX_RETRIES = 2
+_SNUB_TIMEOUT = 60
+_MAX_PEERS = 20
+_PEX_INTERVAL = 60
+_STREAM_WINDOW = 8
+_PIPELINE_DEPTH = 5
+_HAVE_WINDOW = 0.1
+_RESUME_PEERS = 100
+_BAN_STRIKES = 2
+_WEB_SEED_RARITY = 1
+_WEB_SEED_PIPELINE_DEPTH = 16
+_WEB_SEED_RETRY = 60
+
+# File priorities.  Pieces of skipped files are not downloaded unless they
+# are shared with a file which is wanted.
+(SKIP, LOW, NORMAL, HIGH) = range(4)
+PRIORITIES = ('skip', 'low', 'normal', 'high')
+
+_pieces_verified = metrics.counter('bt_pieces_verified_total',
+                                   "Pieces which passed the hash check")
+_pieces_failed = metrics.counter('bt_pieces_failed_total',
+                                 "Pieces which failed the hash check")
+_haves_suppressed = metrics.counter('bt_haves_suppressed_total',
+                                    "Have messages not sent to peers which "
+                                    "already have the piece")
+_pex_peers = metrics.counter('bt_pex_peers_total',
+                             "New peer addresses learned through peer "
+                             "exchange")
+_refetched = metrics.counter('bt_bytes_refetched_total',
+                             "Bytes of pieces which failed the hash check "
+                             "downloaded again")
+_peers_banned = metrics.counter('bt_peers_banned_total',
+                                "Peers banned for sending bad data")
 
 
 class TorrentMgrError(Exception):
     pass
 
 
+class _Peer(object):
+    # The TorrentMgr's record of a peer.  Slots keep the record small since a
+    # torrent may have thousands of peers.
+    __slots__ = ('proxy', 'bitfield', 'piece', 'received', 'sha1', 'timer',
+                 'snub_timer', 'requesting', 'requested', 'retries',
+                 'rejected', 'verified', 'failed')
+
+    def __init__(self, proxy, num_pieces):
+        self.proxy = proxy
+
+        # bitfield is the bitfield of the pieces the peer has
+        self.bitfield = Bitfield(num_pieces)
+
+        # piece is the index of the piece reserved for the peer or None if
+        # no piece is reserved.  While a piece is reserved, received is the
+        # number of bytes of it which have been received, sha1 is the hash of
+        # those bytes and timer is the Timer for the deadline by which the
+        # peer must unchoke or, once requesting, respond to the requests.
+        # requested is the offset within the piece up to which blocks have
+        # been requested and retries is the number of times the requests have
+        # timed out and been resent.  snub_timer is the Timer for checking
+        # whether the peer has become snubbed while requesting.
+        self.piece = None
+        self.received = 0
+        self.sha1 = None
+        self.timer = None
+        self.snub_timer = None
+        self.requesting = False
+        self.requested = 0
+        self.retries = 0
+
+        # rejected is the set of the pieces for which the peer has rejected a
+        # request since it last unchoked this client, or None if there are
+        # none, so that it isn't asked for them again
+        self.rejected = None
+
+        # verified and failed are the numbers of pieces received from the
+        # peer which passed and failed the hash check
+        self.verified = 0
+        self.failed = 0
+
+
 class TorrentMgr(object):
     class _States(object):
         (Uninitialized, Initialized, Started) = range(3)
 
-    def __init__(self, filename, port, peer_id, reactor):
+    def __init__(self, filename, port, peer_id, reactor,
+                 snub_timeout=_SNUB_TIMEOUT, suppress_haves=False,
+                 max_peers=_MAX_PEERS, save_path='', resume=None):
         self._filename = filename
         self._port = port
         self._peer_id = peer_id
         self._reactor = reactor
+        self._scheduler = get_scheduler(reactor)
+        self._diskio = get_diskio(reactor)
+        self._snub_timeout = snub_timeout
+        self._suppress_haves = suppress_haves
+        self._max_peers = max_peers
+        self._save_path = save_path
+        self._resume = resume
         self._state = self._States.Uninitialized
 
     def initialize(self):
@@ -92,39 +281,77 @@ class TorrentMgr(object):
             d.errback(TorrentMgrError(err.strerror))
             return d
 
-        # _peers is a list of peers that the TorrentMgr is trying
-        # to communicate with
-        self._peers = []
-
-        # _bitfields is a dictionary mapping peers to a bitfield of the pieces
-        # each has
-        self._bitfields = {}
+        # _file_offsets is a list of the offset of each file within the
+        # torrent
+        self._file_offsets = []
+        offset = 0
+        for _, length in self._metainfo.files:
+            self._file_offsets.append(offset)
+            offset += length
+
+        # _stream is None unless streaming is on, in which case it is a tuple
+        # of the offsets within the torrent at which the streamed region
+        # begins and ends.  _stream_position is the offset of the most recent
+        # read within the region.
+        self._stream = None
+        self._stream_position = None
+
+        # _waiters is a list of reads waiting for pieces.  Each entry is a
+        # tuple of the first and last pieces needed, the offset and length of
+        # the read within the torrent and the deferred to fire.
+        self._waiters = []
+
+        # _peers is a dictionary mapping each peer that the TorrentMgr is
+        # trying to communicate with to its _Peer record.  _web_seeds is the
+        # set of the WebSeeds among them and _web_seed_timers maps the url of
+        # each web seed which has failed to the Timer for adding it again.
+        self._peers = {}
+        self._web_seeds = set()
+        self._web_seed_timers = {}
 
         # _have is the bitfield for this torrent. It is initialized to reflect
         # which pieces are already available on disk.
-        self._filemgr = FileMgr(self._metainfo)
+        self._account = membudget.budget.account(self._filename)
+        self._filemgr = FileMgr(self._metainfo, self._reactor, self._account,
+                                self._save_path)
         self._have = self._filemgr.have()
+        if self._resume is not None:
+            try:
+                have = Bitfield.from_bytes(bytearray(self._resume['have']),
+                                           self._metainfo.num_pieces)
+            except ValueError as err:
+                logger.warning("Ignoring resume data of {}: {}"
+                               .format(self._filename, err))
+            else:
+                self._have = self._filemgr.check(have)
 
         # _needed is a dictionary of pieces which are still needed.
-        # The value for each piece is a tuple of the number of peers which
-        # have the piece and a list of those peers.
-        self._needed = {piece: (0, []) for piece
-                        in list(self._have.findall('0b0'))}
-
-        # _interested is a dictionary of peers to whom interest has been
-        # expressed.  The value for each peer is a tuple of the piece that
-        # has been reserved for the peer, the number of bytes of the piece that
-        # have already been received, the sha1 hash of the bytes received so
-        # far and the value of the tick at the time interest was expressed.
-        self._interested = {}
-
-        # _requesting is a dictionary of peers to whom a block request has been
-        # made.  The value for each peer is a tuple of the piece that is being
-        # requested, the number of bytes that have already been received, the
-        # shal2 hash of the bytes received so far, the value of the tick at
-        # the time the request was made and the number of retries that have
-        # been attempted
-        self._requesting = {}
+        # The value for each piece is the number of peers which have the
+        # piece.
+        # _file_priorities is a list of the priority of each file.
+        # _piece_priorities is a list of the priority of each piece, which is
+        # the highest priority of the files it overlaps.  Every file starts
+        # out with normal priority.
+        self._file_priorities = [NORMAL] * len(self._metainfo.files)
+        self._piece_priorities = [NORMAL] * self._metainfo.num_pieces
+
+        # _wanted is a bitfield of the pieces which are wanted but not yet
+        # had and _num_wanted is the number of pieces which are wanted,
+        # whether or not they are had
+        self._wanted = ~self._have
+        self._num_wanted = self._metainfo.num_pieces
+
+        self._needed = {piece: 0 for piece in self._have.zeros()}
+
+        # _writing is the set of pieces which have been verified but not yet
+        # written, so they are neither had nor needed
+        self._writing = set()
+
+        # _reserved is a dictionary mapping each piece which has been reserved
+        # for a peer to that peer.  _requesting is the set of peers to whom
+        # block requests have been made for their reserved piece.
+        self._reserved = {}
+        self._requesting = set()
 
         # _partial is a list which tracks pieces that were interrupted while
         # being downloaded.  Each entry is a tuple containing the index of the
@@ -132,11 +359,47 @@ class TorrentMgr(object):
         # bytes.
         self._partial = []
 
+        # _provenance maps each piece being downloaded to a list of the
+        # blocks' senders.  Each entry is a tuple of the offset within the
+        # piece at which a peer took over, the peer's address and the sha1
+        # hash of the bytes before that offset.
+        # _retrying maps each piece which failed the hash check and is being
+        # downloaded again to a tuple of the provenance of the failed attempt
+        # and the number of its entries whose blocks are kept.
+        self._provenance = {}
+        self._retrying = {}
+
+        # _strikes maps the address of each peer found to have sent bad data
+        # to the number of pieces it spoiled.  _banned is the set of
+        # addresses of the peers which are no longer connected to.
+        self._strikes = {}
+        self._banned = set()
+
+        # _stalled is the set of requesting peers whose next request is being
+        # held back until the disk catches up
+        self._stalled = set()
+
+        # _unannounced is a list of the pieces which have been written since
+        # the peers were last sent have messages and _announce_timer is the
+        # Timer for sending them
+        self._unannounced = []
+        self._announce_timer = None
+
+        # _pex_timer is the Timer for the next exchange of peers
+        self._pex_timer = None
+
+        if self._resume is not None:
+            self._resume_priorities(self._resume['priorities'])
+
         self._tracker_proxy = TrackerProxy(self._metainfo, self._port,
                                            self._peer_id)
 
         def success(result):
             self._state = self._States.Initialized
+            if self._resume is not None:
+                self._tracker_proxy.add_peers(
+                    tuple(addr) for addr in self._resume['peers'])
+                self._resume = None
 
         def failure(failure):
             logger.critical("Could not connect to tracker at {}"
@@ -152,20 +415,88 @@ class TorrentMgr(object):
             raise TorrentMgrError("TorrentMgr must be initialized to be "
                                   "started")
 
-        self._reactor.callLater(_TIMER_INTERVAL, self.timer_event)
-        self._tick = 1
-
         logger.info("Starting to serve torrent {}".format(self._filename))
         print "Starting to serve torrent {}".format(self._filename)
 
         self._state = self._States.Started
 
-        self._connect_to_peers(20)
+        self._connect_to_peers(self._max_peers)
+        for url in self._metainfo.url_list:
+            self._add_web_seed(url)
+        if not self._metainfo.private:
+            self._pex_timer = self._scheduler.call_later(_PEX_INTERVAL,
+                                                         self._exchange_peers)
+
+    def stop(self):
+        """
+        stop() disconnects every peer, cancels the TorrentMgr's timers and
+        closes its files.  The TorrentMgr can be started again.  It returns a
+        deferred which fires once the files have been closed.  It raises a
+        TorrentMgrError if the TorrentMgr isn't started.
+        """
+        if self._state != self._States.Started:
+            raise TorrentMgrError("TorrentMgr must be started to be stopped")
+
+        logger.info("Stopping torrent {}".format(self._filename))
+
+        self._state = self._States.Initialized
+
+        if self._pex_timer is not None:
+            self._pex_timer.cancel()
+            self._pex_timer = None
+        if self._announce_timer is not None:
+            self._announce_timer.cancel()
+            self._announce_timer = None
+        self._unannounced = []
+        for timer in self._web_seed_timers.itervalues():
+            timer.cancel()
+        self._web_seed_timers = {}
+
+        addrs = []
+        for peer in list(self._peers):
+            if peer not in self._web_seeds:
+                addrs.append(peer.addr())
+            peer.drop_connection()
+            self._remove_peer(peer)
+        self._tracker_proxy.return_peers(addrs)
+
+        return self._filemgr.close()
+
+    def max_peers(self):
+        return self._max_peers
+
+    def set_max_peers(self, max_peers):
+        """
+        set_max_peers() sets the number of peers the TorrentMgr may be
+        connected to at once.  If it is started, it connects to more peers
+        or disconnects from the peers which are least useful to match.  It
+        raises a TorrentMgrError if max_peers is less than 1.
+        """
+        if max_peers < 1:
+            raise TorrentMgrError("Maximum number of peers must be at least 1")
+        self._max_peers = max_peers
+        if self._state != self._States.Started:
+            return
+
+        # Peers which haven't been given a piece go first, slowest first
+        excess = self._num_peers() - max_peers
+        if excess > 0:
+            def usefulness(peer):
+                return (self._peers[peer].piece is not None,
+                        peer.download_rate())
+            peers = [peer for peer in self._peers
+                     if peer not in self._web_seeds]
+            for peer in sorted(peers, key=usefulness)[:excess]:
+                peer.drop_connection()
+                self._remove_peer(peer)
+        elif excess < 0:
+            self._connect_to_peers(-excess)
 
     def percent(self):
         if self._state != self._States.Uninitialized:
-            return 100 * (1 - (len(self._needed) /
-                               float(self._metainfo.num_pieces)))
+            if self._num_wanted == 0:
+                return 100.0
+            return 100 * (1 - (len(self._needed) / float(self._num_wanted)))
         else:
             raise TorrentMgrError("Can't get percent on uninitialized "
                                   "TorrentMgr")
@@ -180,112 +511,712 @@ class TorrentMgr(object):
     def name(self):
         return self._metainfo.name
 
+    def memory(self):
+        """
+        memory() returns the number of bytes of block data the TorrentMgr is
+        holding in memory.
+        """
+        if self._state != self._States.Uninitialized:
+            return self._account.used
+        else:
+            raise TorrentMgrError("Can't get memory of uninitialized "
+                                  "TorrentMgr")
+
+    def download_rate(self):
+        if self._state != self._States.Uninitialized:
+            return sum(peer.download_rate() for peer in self._peers)
+        else:
+            raise TorrentMgrError("Can't get rate on uninitialized "
+                                  "TorrentMgr")
+
+    def upload_rate(self):
+        if self._state != self._States.Uninitialized:
+            return sum(peer.upload_rate() for peer in self._peers)
+        else:
+            raise TorrentMgrError("Can't get rate on uninitialized "
+                                  "TorrentMgr")
+
+    def state(self):
+        """
+        state() returns a string describing what the TorrentMgr is doing:
+        uninitialized, initialized, downloading or complete.
+        """
+        if self._state == self._States.Uninitialized:
+            return 'uninitialized'
+        if self._state == self._States.Initialized:
+            return 'initialized'
+        return 'downloading' if self._needed else 'complete'
+
+    def pieces_needed(self):
+        """
+        pieces_needed() returns the number of wanted pieces which the
+        TorrentMgr doesn't have yet.
+        """
+        return len(self._needed)
+
+    def swarm_size(self):
+        """
+        swarm_size() returns the number of peers the TorrentMgr is connected
+        to plus the number of addresses it has yet to try.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't get swarm size of uninitialized "
+                                  "TorrentMgr")
+        return self._num_peers() + self._tracker_proxy.num_peers()
+
+    def peer_counts(self):
+        """
+        peer_counts() returns the number of peers with which the TorrentMgr is
+        communicating and the number of those which are snubbed.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't get peers on uninitialized "
+                                  "TorrentMgr")
+
+        snubbed = 0
+        for peer in self._peers:
+            if peer.is_snubbed():
+                snubbed += 1
+        return len(self._peers), snubbed
+
+    def peer_stats(self):
+        """
+        peer_stats() returns a list containing a dictionary of transfer
+        statistics for each peer with which the TorrentMgr is communicating.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't get peers on uninitialized "
+                                  "TorrentMgr")
+
+        stats = []
+        for peer, record in self._peers.iteritems():
+            last_rx, last_tx, last_block = peer.last_activity()
+            stats.append({'addr': "{}:{}".format(*peer.addr()),
+                          'download_rate': peer.download_rate(),
+                          'upload_rate': peer.upload_rate(),
+                          'downloaded': peer.downloaded(),
+                          'uploaded': peer.uploaded(),
+                          'pieces_verified': record.verified,
+                          'pieces_failed': record.failed,
+                          'strikes': self._strikes.get(peer.addr(), 0),
+                          'web_seed': peer in self._web_seeds,
+                          'last_rx': last_rx,
+                          'last_tx': last_tx,
+                          'last_block': last_block,
+                          'snubbed': peer.is_snubbed()})
+        return stats
+
+    def files(self):
+        """
+        files() returns a list containing a dictionary of the path, length
+        and priority of each file in the torrent.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't get files of uninitialized "
+                                  "TorrentMgr")
+
+        return [{'path': "/".join(path), 'length': length,
+                 'priority': PRIORITIES[priority]}
+                for (path, length), priority
+                in zip(self._metainfo.files, self._file_priorities)]
+
+    def set_priority(self, priority, file_indices=None):
+        """
+        set_priority() sets the priority of each of the specified files, or
+        of every file if none are specified, to the named priority: skip,
+        low, normal or high.  The pieces of skipped
+        files which are not shared with a wanted file are no longer needed
+        and the reads waiting for them fail.  It raises a TorrentMgrError if
+        the priority or a file index is invalid.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't set priority of uninitialized "
+                                  "TorrentMgr")
+        if priority not in PRIORITIES:
+            raise TorrentMgrError("Invalid priority: {}".format(priority))
+        if file_indices is None:
+            file_indices = range(len(self._metainfo.files))
+        for file_index in file_indices:
+            self._file_span(file_index)
+
+        self._set_priority(PRIORITIES.index(priority), file_indices)
+        logger.info("Set priority of files {} of {} to {}"
+                    .format(list(file_indices), self._filename, priority))
+
+    def _set_priority(self, value, file_indices):
+        pieces = set()
+        for file_index in file_indices:
+            if self._file_priorities[file_index] != value:
+                self._file_priorities[file_index] = value
+                pieces.update(self._pieces_of_file(file_index))
+
+        # Recompute the priority of the pieces of the changed files and
+        # update the needed pieces to match
+        added = []
+        removed = []
+        for index in sorted(pieces):
+            was_wanted = self._piece_priorities[index] != SKIP
+            self._piece_priorities[index] = self._priority_of_piece(index)
+            is_wanted = self._piece_priorities[index] != SKIP
+            if is_wanted and not was_wanted:
+                self._num_wanted += 1
+                if not self._have[index] and index not in self._writing:
+                    added.append(index)
+            elif was_wanted and not is_wanted:
+                self._num_wanted -= 1
+                if index in self._needed:
+                    removed.append(index)
+
+        for index in removed:
+            self._wanted[index] = 0
+            del self._needed[index]
+        if removed:
+            self._drop_unwanted(set(removed))
+
+        if added:
+            self._need(added)
+
+    def _resume_priorities(self, priorities):
+        # Restore the file priorities saved in resume data, one digit for
+        # each file
+        if len(priorities) != len(self._metainfo.files):
+            logger.warning("Ignoring saved priorities of {}"
+                           .format(self._filename))
+            return
+        for value in (SKIP, LOW, HIGH):
+            file_indices = [index for index, digit in enumerate(priorities)
+                            if digit == str(value)]
+            if file_indices:
+                self._set_priority(value, file_indices)
+
+    def resume_data(self):
+        """
+        resume_data() returns a dictionary of what a new TorrentMgr needs to
+        carry on where this one left off after a restart: the bitfield of the
+        pieces which are on disk, the priority of each file as a string of
+        digits, the addresses of up to _RESUME_PEERS peers and the numbers
+        of wanted and needed pieces.  It contains only strings, integers and
+        lists so that it can be bencoded.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't get resume data of uninitialized "
+                                  "TorrentMgr")
+
+        addrs = [peer.addr() for peer in self._peers
+                 if peer not in self._web_seeds]
+        addrs.extend(self._tracker_proxy.available_peers(
+            max(0, _RESUME_PEERS - len(addrs))))
+        return {'have': self._have.tobytes(),
+                'priorities': ''.join(str(priority) for priority
+                                      in self._file_priorities),
+                'peers': [[ip, port] for ip, port in addrs[:_RESUME_PEERS]],
+                'wanted': self._num_wanted,
+                'needed': len(self._needed)}
+
+    def set_streaming(self, enable, file_index=None):
+        """
+        set_streaming() turns streaming of the specified file, or of the
+        whole torrent if no file is specified, on or off.  The read position
+        starts at the beginning of the file.  It raises a TorrentMgrError if
+        the file index is invalid.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't stream uninitialized TorrentMgr")
+
+        if not enable:
+            self._stream = None
+            return
+
+        if file_index is None:
+            begin, length = 0, self._metainfo.total_length
+        else:
+            begin, length = self._file_span(file_index)
+        self._stream = (begin, begin + length)
+        self._stream_position = begin
+        logger.info("Streaming {} from offset {}"
+                    .format(self._filename, begin))
+
+    def is_streaming(self):
+        return self._stream is not None
+
+    def read(self, file_index, offset, length):
+        """
+        read() returns a deferred which fires with length bytes of the
+        specified file starting at offset once every piece they belong to has
+        been verified.  If the read is within the region being streamed, the
+        read position moves to offset.  It raises a TorrentMgrError if the
+        file index is invalid or the bytes are not all within the file.
+        """
+        if self._state == self._States.Uninitialized:
+            raise TorrentMgrError("Can't read uninitialized TorrentMgr")
+
+        begin, file_length = self._file_span(file_index)
+        if offset < 0 or length < 0 or offset + length > file_length:
+            raise TorrentMgrError("Invalid range {}-{} of file {}"
+                                  .format(offset, offset + length - 1,
+                                          file_index))
+        if length == 0:
+            return succeed('')
+
+        start = begin + offset
+        if (self._stream is not None and
+                self._stream[0] <= start < self._stream[1]):
+            self._stream_position = start
+
+        first = start // self._metainfo.piece_length
+        last = (start + length - 1) // self._metainfo.piece_length
+        if not self._obtainable(first, last):
+            raise TorrentMgrError("Range {}-{} of file {} is skipped"
+                                  .format(offset, offset + length - 1,
+                                          file_index))
+        if self._available(first, last):
+            return self._filemgr.read(start, length)
+
+        def cancel(d):
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        d = Deferred(cancel)
+        waiter = (first, last, start, length, d)
+        self._waiters.append(waiter)
+        return d
+
+    def _file_span(self, file_index):
+        # Returns the offset of the file within the torrent and its length
+        if not 0 <= file_index < len(self._file_offsets):
+            raise TorrentMgrError("Invalid file index: {}".format(file_index))
+        return (self._file_offsets[file_index],
+                self._metainfo.files[file_index][1])
+
+    def _available(self, first, last):
+        return self._have.all(first, last+1)
+
+    def _obtainable(self, first, last):
+        # Returns whether each of the pieces is either had or wanted
+        return (self._have | self._wanted).all(first, last+1)
+
+    def _pieces_of_file(self, file_index):
+        # Returns the indices of the pieces which overlap the file
+        begin, length = self._file_span(file_index)
+        if length == 0:
+            return []
+        piece_length = self._metainfo.piece_length
+        return range(begin // piece_length,
+                     (begin + length - 1) // piece_length + 1)
+
+    def _priority_of_piece(self, index):
+        # Returns the highest priority of the non-empty files which overlap
+        # the piece
+        piece_length = self._metainfo.piece_length
+        begin = index * piece_length
+        end = begin + self._length_of_piece(index)
+        return max(priority for offset, (_, length), priority
+                   in zip(self._file_offsets, self._metainfo.files,
+                          self._file_priorities)
+                   if length > 0 and offset < end and offset + length > begin)
+
+    def _need(self, pieces):
+        # Add the pieces to those which are needed and look for peers to get
+        # them from
+        for index in pieces:
+            self._wanted[index] = 1
+            self._needed[index] = sum(1 for record in self._peers.itervalues()
+                                      if record.bitfield[index])
+        if self._state == self._States.Started:
+            for peer in list(self._peers):
+                if peer in self._peers:
+                    self._check_interest(peer)
+
+    def _drop_unwanted(self, pieces):
+        # Stop downloading the pieces, which are no longer wanted.  Peers
+        # which were assigned one of them are given another piece, the
+        # partial progress on them is discarded and the reads waiting for
+        # them fail.
+        peers = [self._reserved[index] for index in pieces
+                 if index in self._reserved]
+        for peer in peers:
+            self._release_piece(peer)
+        self._partial = [entry for entry in self._partial
+                         if entry[0] not in pieces]
+        for index in pieces:
+            self._provenance.pop(index, None)
+            self._retrying.pop(index, None)
+        for peer in peers:
+            self._check_interest(peer)
+
+        for waiter in [waiter for waiter in self._waiters
+                       if not self._obtainable(waiter[0], waiter[1])]:
+            self._waiters.remove(waiter)
+            waiter[4].errback(TorrentMgrError("Read of skipped pieces"))
+
+    def _check_waiters(self):
+        # Complete the reads for which every piece has been verified
+        for waiter in [waiter for waiter in self._waiters
+                       if self._available(waiter[0], waiter[1])]:
+            self._waiters.remove(waiter)
+            _, _, start, length, d = waiter
+            self._filemgr.read(start, length).chainDeferred(d)
+
+    def _stream_window(self):
+        # Returns the needed pieces within the window ahead of the read
+        # position in order
+        piece_length = self._metainfo.piece_length
+        first = self._stream_position // piece_length
+        last = min((self._stream[1] - 1) // piece_length,
+                   first + _STREAM_WINDOW - 1)
+        return [index for index in xrange(first, last + 1)
+                if index in self._needed]
+
     def _connect_to_peers(self, n):
-        # Get addresses of n peers from the tracker and try to establish
-        # a connection with each
+        # Get addresses of up to n peers, no more than max_peers allows, from
+        # the tracker and try to establish a connection with each
+        n = min(n, self._max_peers - self._num_peers())
+        if n <= 0:
+            return
 
         def handle_addrs(addrs):
             for addr in addrs:
+                if (addr['ip'], addr['port']) in self._banned:
+                    continue
                 peer = PeerProxy(self, self._peer_id,
                                  (addr['ip'], addr['port']), self._reactor,
-                                 info_hash=self._metainfo.info_hash)
-                self._peers.append(peer)
-                self._bitfields[peer] = BitArray(self._metainfo.num_pieces)
+                                 info_hash=self._metainfo.info_hash,
+                                 snub_timeout=self._snub_timeout,
+                                 pex=not self._metainfo.private,
+                                 account=self._account)
+                self._add_peer(peer)
         self._tracker_proxy.get_peers(n).addCallback(handle_addrs)
 
+    def _add_peer(self, peer):
+        self._peers[peer] = _Peer(peer, self._metainfo.num_pieces)
+
+    def _add_web_seed(self, url):
+        # Add the web seed as a peer which has every piece unless it has
+        # been banned
+        self._web_seed_timers.pop(url, None)
+        try:
+            seed = WebSeed(self, url, self._metainfo, self._reactor,
+                           account=self._account,
+                           snub_timeout=self._snub_timeout)
+        except ValueError as err:
+            logger.warning("Ignoring web seed of {}: {}"
+                           .format(self._filename, err.message))
+            return
+        if seed.addr() in self._banned:
+            return
+
+        logger.info("Adding web seed {}".format(url))
+        self._add_peer(seed)
+        self._web_seeds.add(seed)
+        self.peer_has_all(seed)
+
+    def _num_peers(self):
+        # Returns the number of peers other than web seeds
+        return len(self._peers) - len(self._web_seeds)
+
     def _remove_peer(self, peer):
-        # Clean up references to the peer in various data structures
-        self._peers.remove(peer)
-
-        pieces = list(self._bitfields[peer].findall('0b1'))
-        for piece in pieces:
-            if piece in self._needed:
-                occurences, peers = self._needed[piece]
-                if peer in peers:
-                    peers.remove(peer)
-                    self._needed[piece] = (occurences-1, peers)
-
-        del self._bitfields[peer]
-
-        if peer in self._interested:
-            del self._interested[peer]
-        elif peer in self._requesting:
-            # If the peer is in the middle of downloading a piece, save
-            # the state in the partial list
-            index, offset, sha1, _, _ = self._requesting[peer]
-            self._partial.append((index, offset, sha1))
-            del self._requesting[peer]
-
-    def _rarest(self):
-        # Returns a list of tuples which includes a piece index sorted by
-        # the number of peers which have the piece in ascending order
-        return sorted([(occurences, peers, index)
-                       for (index, (occurences, peers)) in self._needed.items()
-                       if occurences != 0])
+        # Clean up references to the peer.  Only the needed pieces which the
+        # peer has are visited.
+        self._release_piece(peer)
+        self._web_seeds.discard(peer)
+        record = self._peers.pop(peer)
+        for piece in (record.bitfield & self._wanted).ones():
+            self._needed[piece] -= 1
+
+    def _reserve(self, peer, index, offset, sha1):
+        # Reserve the piece for the peer, resuming from offset, and show
+        # interest in the peer
+        record = self._peers[peer]
+        record.piece = index
+        record.received = offset
+        record.sha1 = sha1
+        record.timer = self._interest_deadline(peer)
+        self._reserved[index] = peer
+
+        # Note that the peer sends the blocks from offset on.  Those who took
+        # over at or after offset before haven't sent anything which is kept.
+        provenance = [entry for entry in self._provenance.get(index, ())
+                      if entry[0] < offset]
+        if provenance == [] or provenance[-1][1] != peer.addr():
+            provenance.append((offset, peer.addr(), sha1.copy()))
+        self._provenance[index] = provenance
+
+        self._show_interest(peer)
+
+    def _unreserve(self, peer):
+        # Forget the piece reserved for the peer and cancel its deadline
+        record = self._peers[peer]
+        record.timer.cancel()
+        if record.snub_timer is not None:
+            record.snub_timer.cancel()
+            record.snub_timer = None
+        del self._reserved[record.piece]
+        self._requesting.discard(peer)
+        self._stalled.discard(peer)
+        record.piece = None
+        record.sha1 = None
+        record.timer = None
+        record.requesting = False
+
+    def _cancel_requests(self, peer):
+        # Cancel the blocks which have been requested of the peer but not
+        # received, unless the peer has discarded them by choking without the
+        # Fast Extension
+        if peer.is_peer_choked() and not peer.supports_fast():
+            return
+        record = self._peers[peer]
+        begin = record.received
+        while begin < record.requested:
+            length = self._bytes_to_request(record.piece, begin)
+            peer.cancel(record.piece, begin, length)
+            begin += length
+
+    def _release_piece(self, peer):
+        # Free up the piece assigned to the peer and cancel its deadline and
+        # outstanding requests.  If the peer is in the middle of downloading
+        # a piece, save the state in the partial list.
+        self._stalled.discard(peer)
+        record = self._peers[peer]
+        if record.piece is not None:
+            if record.requesting:
+                self._cancel_requests(peer)
+            if record.requesting or record.received > 0:
+                self._partial.append((record.piece, record.received,
+                                      record.sha1))
+            self._unreserve(peer)
+
+    @lagmonitor.watch('TorrentMgr._rarest')
+    def _rarest(self, common_first=False):
+        # Returns a list of the indices of needed pieces which at least one
+        # peer has, sorted by priority in descending order and then by the
+        # number of peers which have the piece in ascending order, or in
+        # descending order if common_first.  Among equally rare pieces,
+        # larger pieces come first.
+        sign = -1 if common_first else 1
+        return [index for _, _, _, index in
+                sorted((-self._piece_priorities[index], sign * occurences,
+                        -self._length_of_piece(index), index)
+                       for (index, occurences) in self._needed.iteritems()
+                       if occurences != 0)]
+
+    def _take_partial(self, index):
+        # Returns the number of bytes of the piece which have already been
+        # received and their sha1 hash, removing the piece from the partial
+        # list
+        for entry in self._partial:
+            if entry[0] == index:
+                self._partial.remove(entry)
+                return entry[1], entry[2]
+        return 0, hashlib.sha1()
+
+    def _is_fast(self, peer):
+        # A peer is considered fast when it has been delivering data at least
+        # as quickly as the median of the peers which are being requested from
+        rates = sorted(p.download_rate() for p in self._requesting)
+        if rates == []:
+            return True
+        return peer.download_rate() >= rates[len(rates)//2]
 
     def _show_interest(self, peer):
         if not peer.is_interested():
-            logger.debug("Expressing interest in peer {}"
-                         .format(str(peer.addr())))
+            if tracer.enabled:
+                tracer.record(tracer.INTERESTED, peer.addr())
             peer.interested()
 
-        if not peer.is_peer_choked():
+        index = self._peers[peer].piece
+        if not peer.is_peer_choked() or peer.is_allowed_fast(index):
             self._request(peer)
 
+    @lagmonitor.watch('TorrentMgr._check_interest')
     def _check_interest(self, peer):
         # If the peer is not already interested or requesting, identify a piece
         # for it to download and show interest to the peer.
-        if peer not in self._interested and peer not in self._requesting:
-            # Compute the set of needed pieces which the peer has that are not
-            # already designated for another peer
-            needed = self._have.copy()
-            needed.invert()
-            of_interest = list((needed & self._bitfields[peer]).findall('0b1'))
-            dont_consider = [i for i, _, _, _ in self._interested.values()]
-            dont_consider.extend([i for i, _, _, _, _
-                                  in self._requesting.values()])
+        record = self._peers[peer]
+        if record.piece is None:
+            # Don't assign a piece to a peer which is snubbing us.  It is
+            # treated as a peer with no further piece to download.
+            if peer.is_snubbed():
+                self._lose_interest(peer)
+                return
+
+            # Web seeds are only given the pieces the peers can't supply well
+            if peer in self._web_seeds:
+                if not self._check_web_seed(peer) and peer.is_interested():
+                    peer.not_interested()
+                return
+
+            # Compute the needed pieces which the peer has.  Those already
+            # reserved for another peer are not considered.
+            of_interest = (self._wanted & record.bitfield).ones()
 
             # When there are potential pieces for the peer to download, give
             # preference to a piece that has already been partially
-            # downloaded followed by the rarest available piece
+            # downloaded followed by the rarest available piece.  Slower
+            # peers are given the most common pieces to leave the rarest and
+            # largest pieces for faster peers.
             if len(of_interest) > 0:
+                # A peer which is choking us can still be asked for the
+                # pieces it has declared allowed fast
+                if peer.is_peer_choked():
+                    for index in of_interest:
+                        if (peer.is_allowed_fast(index) and
+                                index not in self._reserved and
+                                not self._shunned(record, index)):
+                            offset, sha1 = self._take_partial(index)
+                            self._reserve(peer, index, offset, sha1)
+                            return
+
                 for index, offset, sha1 in self._partial:
-                    if index in of_interest:
+                    if (record.bitfield[index] and
+                            not self._shunned(record, index)):
                         self._partial.remove((index, offset, sha1))
-                        self._interested[peer] = (index, offset, sha1,
-                                                  self._tick)
-                        self._show_interest(peer)
+                        self._reserve(peer, index, offset, sha1)
                         return
 
-                for _, _, index in self._rarest():
-                    if index in of_interest and index not in dont_consider:
-                        self._interested[peer] = (index, 0, hashlib.sha1(),
-                                                  self._tick)
-                        self._show_interest(peer)
+                fast = self._is_fast(peer)
+                candidates = self._rarest(common_first=not fast)
+                if fast and self._stream is not None:
+                    # Fast peers are given the pieces just ahead of the read
+                    # position before the rarest pieces
+                    window = self._stream_window()
+                    in_window = set(window)
+                    candidates = window + [index for index in candidates
+                                           if index not in in_window]
+
+                for index in candidates:
+                    if (record.bitfield[index] and
+                            index not in self._reserved and
+                            not self._shunned(record, index)):
+                        self._reserve(peer, index, 0, hashlib.sha1())
                         return
 
             # If there is no further piece for a peer which was previously
-            # interested to download, make it not interested and connect to
-            # another peer
-            if peer not in self._interested and peer.is_interested():
-                logger.debug("Expressing lack of interest in peer {}"
-                             .format(str(peer.addr())))
-                peer.not_interested()
-                self._connect_to_peers(1)
-
-    def _request(self, peer):
-        if peer in self._interested:
-            index, offset, sha1, _ = self._interested[peer]
-            del self._interested[peer]
-            self._requesting[peer] = (index, offset, sha1, self._tick, 0)
+            # interested to download, make it not interested
+            self._lose_interest(peer)
+
+    def _lose_interest(self, peer):
+        # Make a peer which was previously interested not interested and
+        # replace it
+        if peer.is_interested():
+            if tracer.enabled:
+                tracer.record(tracer.NOT_INTERESTED, peer.addr())
+            peer.not_interested()
+            self._replace_peer(peer)
+
+    def _replace_peer(self, peer):
+        # Connect to another peer in place of one which this client is no
+        # longer interested in.  Once the peer limit has been reached, the
+        # peer is dropped to make room since uploading isn't implemented, so
+        # it is only taking up a connection.  Web seeds don't count towards
+        # the limit.
+        if (peer not in self._web_seeds and
+                self._num_peers() >= self._max_peers):
+            peer.drop_connection()
+            self._remove_peer(peer)
+        self._connect_to_peers(1)
 
-        index, received_bytes, _, _, _ = self._requesting[peer]
+    def _check_web_seed(self, peer):
+        # Reserve a piece for the web seed, preferring partially downloaded
+        # pieces followed by the rarest, and return whether one was found.
+        # Only pieces which at most _WEB_SEED_RARITY peers other than the web
+        # seeds have are considered unless it is the endgame, when a piece
+        # reserved for a peer waiting to be unchoked may be taken over.
+        record = self._peers[peer]
+        seeds = len(self._web_seeds)
+        endgame = (len(self._needed) - len(self._reserved) <=
+                   len(self._requesting))
+
+        def wanted(index):
+            return ((endgame or
+                     self._needed[index] - seeds <= _WEB_SEED_RARITY) and
+                    not self._shunned(record, index))
+
+        for index, offset, sha1 in self._partial:
+            if wanted(index):
+                self._partial.remove((index, offset, sha1))
+                self._reserve(peer, index, offset, sha1)
+                return True
+
+        for index in self._rarest():
+            if index not in self._reserved and wanted(index):
+                self._reserve(peer, index, 0, hashlib.sha1())
+                return True
+
+        if endgame:
+            for index, other in self._reserved.items():
+                if (other not in self._web_seeds and
+                        not self._peers[other].requesting and wanted(index)):
+                    self._release_piece(other)
+                    offset, sha1 = self._take_partial(index)
+                    self._reserve(peer, index, offset, sha1)
+                    self._check_interest(other)
+                    return True
+        return False
+
+    def _check_web_seeds(self):
+        # Look for pieces for the web seeds which don't have one
+        for seed in list(self._web_seeds):
+            if seed in self._peers and self._peers[seed].piece is None:
+                self._check_interest(seed)
+
+    def _interest_deadline(self, peer):
+        return self._scheduler.call_later(_INTEREST_TIMEOUT,
+                                          self._interest_timeout, peer)
+
+    def _request(self, peer, retries=0, resend=False):
+        # Move the peer into requesting if necessary and replace its deadline
+        # with one for the response to these requests.  When resend is true,
+        # the blocks which have already been requested are requested again.
+        record = self._peers[peer]
+        if not record.requesting:
+            record.requesting = True
+            record.requested = record.received
+            self._requesting.add(peer)
+            record.snub_timer = self._scheduler.call_later(
+                self._snub_timeout, self._snub_timeout_expired, peer)
+        elif resend:
+            record.requested = record.received
+
+        record.timer.cancel()
+        record.timer = self._scheduler.call_later(_REQUEST_TIMEOUT,
+                                                  self._request_timeout, peer)
+        record.retries = retries
+
+        # Hold back the request while the disk is behind.  The peer is sent
+        # the request once the disk has caught up.
+        if self._diskio.congested():
+            if not self._stalled:
+                self._diskio.drained().addCallback(self._resume_requests)
+            self._stalled.add(peer)
+            return
 
-        bytes_to_request = self._bytes_to_request(index, received_bytes)
-        logger.debug("Requesting pc: {} off: {} len: {} from {}"
-                     .format(index, received_bytes, bytes_to_request,
-                             str(peer.addr())))
-        peer.request(index, received_bytes, bytes_to_request)
+        # Keep the pipeline full, or down to a single block while memory is
+        # short.  Web seeds fetch their pipelines in one request, so theirs
+        # are deeper.
+        if membudget.budget.pressure():
+            depth = 1
+        elif peer in self._web_seeds:
+            depth = _WEB_SEED_PIPELINE_DEPTH
+        else:
+            depth = _PIPELINE_DEPTH
+        index = record.piece
+        end = min(self._length_of_piece(index),
+                  record.received + depth * _BLOCK_SIZE)
+        requested = record.requested
+        while requested < end:
+            bytes_to_request = self._bytes_to_request(index, requested)
+            if tracer.enabled:
+                tracer.record(tracer.REQUEST, peer.addr(), index, requested,
+                              bytes_to_request)
+            peer.request(index, requested, bytes_to_request)
+            requested += bytes_to_request
+        record.requested = requested
+
+    def _resume_requests(self, _):
+        stalled, self._stalled = self._stalled, set()
+        for peer in stalled:
+            if peer in self._requesting:
+                self._request(peer, self._peers[peer].retries)
 
     def _is_last_piece(self, index):
         return index == self._metainfo.num_pieces-1
@@ -319,17 +1250,31 @@ class TorrentMgr(object):
     def get_bitfield(self):
         return self._have
 
+    @lagmonitor.watch('TorrentMgr.peer_unconnected')
     def peer_unconnected(self, peer):
         logger.info("Peer {} is unconnected".format(str(peer.addr())))
+        if peer not in self._peers:
+            return
+
+        # A web seed is tried again later instead of connecting to another
+        # peer
+        web_seed = peer in self._web_seeds
         self._remove_peer(peer)
-        self._connect_to_peers(1)
+        if self._state == self._States.Started:
+            if web_seed:
+                self._web_seed_timers[peer.url()] = self._scheduler.call_later(
+                    _WEB_SEED_RETRY, self._add_web_seed, peer.url())
+            else:
+                self._connect_to_peers(1)
+            self._check_web_seeds()
 
+    @lagmonitor.watch('TorrentMgr.peer_bitfield')
     def peer_bitfield(self, peer, bitfield):
-        # Validate the bitfield
-        length = len(bitfield)
-        if (length < self._metainfo.num_pieces or
-            (length > self._metainfo.num_pieces and
-             bitfield[self._metainfo.num_pieces:length].any(1))):
+        # Validate the bitfield, which arrives padded to a whole number of
+        # bytes, and trim it to the number of pieces
+        try:
+            bitfield = bitfield.trim(self._metainfo.num_pieces)
+        except ValueError:
             logger.debug("Invalid bitfield from peer {}"
                          .format(str(peer.addr())))
             peer.drop_connection()
@@ -337,99 +1282,274 @@ class TorrentMgr(object):
             self._connect_to_peers(1)
             return
 
-        # Set the peer's bitfield and updated needed to reflect which pieces
-        # the peer has
-        logger.debug("Peer at {} sent bitfield".format(str(peer.addr())))
-        self._bitfields[peer] = bitfield[0:self._metainfo.num_pieces]
-        pieces = list(self._bitfields[peer].findall('0b1'))
-        for piece in pieces:
-            if piece in self._needed:
-                occurences, peers = self._needed[piece]
-                if peer not in peers:
-                    peers.append(peer)
-                    self._needed[piece] = (occurences+1, peers)
+        # Set the peer's bitfield and update needed to reflect the pieces
+        # the peer has which it didn't already have
+        if tracer.enabled:
+            tracer.record(tracer.BITFIELD, peer.addr())
+        record = self._peers[peer]
+        added = bitfield.and_not(record.bitfield)
+        record.bitfield = bitfield | record.bitfield
+        for piece in (added & self._wanted).ones():
+            self._needed[piece] += 1
 
         # Check whether there may be interest obtaining a piece from this peer
         self._check_interest(peer)
 
+    def peer_has_all(self, peer):
+        bitfield = Bitfield(self._metainfo.num_pieces, fill=True)
+        self.peer_bitfield(peer, bitfield)
+
+    def peer_has_none(self, peer):
+        # The peer's bitfield is already empty
+        if tracer.enabled:
+            tracer.record(tracer.BITFIELD, peer.addr())
+
+    @lagmonitor.watch('TorrentMgr.peer_has')
     def peer_has(self, peer, index):
         # Update the peer's bitfield and needed to reflect the availability
         # of the piece
-        logger.debug("Peer at {} has piece {}".format(str(peer.addr()), index))
-        if index < self._metainfo.num_pieces:
-            self._bitfields[peer][index] = 1
-        else:
+        if tracer.enabled:
+            tracer.record(tracer.HAVE, peer.addr(), index)
+        if index >= self._metainfo.num_pieces:
             raise IndexError
 
-        if index in self._needed:
-            occurences, peers = self._needed[index]
-            if peer not in peers:
-                peers.append(peer)
-                self._needed[index] = (occurences+1, peers)
+        record = self._peers[peer]
+        if not record.bitfield[index]:
+            record.bitfield[index] = 1
+            if index in self._needed:
+                self._needed[index] += 1
 
+        if index in self._needed:
             # Check whether there may be interest obtaining a piece from this
             # peer
             self._check_interest(peer)
 
+    @lagmonitor.watch('TorrentMgr.peer_choked')
     def peer_choked(self, peer):
-        logger.debug("Peer {} choked".format(str(peer.addr())))
-        if peer in self._interested:
-            del self._interested[peer]
-        elif peer in self._requesting:
-            # When choked in the middle of obtaining a piece, save the
-            # progress in the partial list
-            index, offset, sha1, _, _ = self._requesting[peer]
-            self._partial.append((index, offset, sha1))
-            del self._requesting[peer]
+        if tracer.enabled:
+            tracer.record(tracer.CHOKE, peer.addr())
+
+        # When choked in the middle of obtaining a piece, the progress is
+        # saved in the partial list.  A peer which supports the Fast
+        # Extension serves or rejects the outstanding request, so it is left
+        # in place.
+        if not peer.supports_fast():
+            self._release_piece(peer)
+            self._check_web_seeds()
+
+    @lagmonitor.watch('TorrentMgr.peer_rejected')
+    def peer_rejected(self, peer, index, begin, length):
+        if tracer.enabled:
+            tracer.record(tracer.REJECT, peer.addr(), index, begin, length)
+
+        record = self._peers[peer]
+        if record.requesting:
+            if record.piece == index and begin >= record.received:
+                # Free the piece for other peers and look for another piece
+                # for the peer, which a choked peer may still allow to be
+                # requested
+                if record.rejected is None:
+                    record.rejected = set()
+                record.rejected.add(index)
+                self._release_piece(peer)
+                self._check_interest(peer)
+
+    def peer_allowed_fast(self, peer, index):
+        if tracer.enabled:
+            tracer.record(tracer.ALLOWED_FAST, peer.addr(), index)
+
+        # A choked peer which is waiting to be unchoked for its piece may be
+        # given a piece it can be asked for right away
+        record = self._peers[peer]
+        if peer.is_peer_choked() and not record.requesting:
+            if record.piece is not None:
+                if peer.is_allowed_fast(record.piece):
+                    self._request(peer)
+                    return
+                self._release_piece(peer)
+            self._check_interest(peer)
 
+    @lagmonitor.watch('TorrentMgr.peer_unchoked')
     def peer_unchoked(self, peer):
-        logger.debug("Peer {} unchoked".format(str(peer.addr())))
-        if peer in self._interested:
+        if tracer.enabled:
+            tracer.record(tracer.UNCHOKE, peer.addr())
+        record = self._peers[peer]
+        record.rejected = None
+        if record.piece is not None and not record.requesting:
             self._request(peer)
 
+    @lagmonitor.watch('TorrentMgr.peer_sent_block')
     def peer_sent_block(self, peer, index, begin, buf):
         if peer not in self._requesting:
             # If a peer is very slow in responding, a block could come after
             # it has timed out.  Just ignore the data at this point and
             # ignore the slow peer
-            logger.debug("Received block from peer {} which has timed out"
-                         .format(str(peer.addr())))
+            if tracer.enabled:
+                tracer.record(tracer.BLOCK_IGNORED, peer.addr(), index, begin,
+                              len(buf))
             return
 
-        piece, received_bytes, sha1, _, _ = self._requesting[peer]
-        if piece == index and begin == received_bytes:
+        if tracer.enabled:
+            tracer.record(tracer.BLOCK_RECEIVED, peer.addr(), index, begin,
+                          len(buf))
+
+        record = self._peers[peer]
+        if record.piece == index and begin == record.received:
             # When the next expected block is received, update the hash value
             # and write the block to file
-            sha1.update(buf)
+            record.sha1.update(buf)
             self._filemgr.write_block(index, begin, buf)
-            self._requesting[peer] = (piece, received_bytes + len(buf),
-                                      sha1, self._tick, 0)
+            record.received += len(buf)
+            record.retries = 0
 
-            if received_bytes + len(buf) < self._length_of_piece(index):
+            if record.received < self._length_of_piece(index):
                 # Request the next block in the piece
                 self._request(peer)
             else:
                 # On receipt of the last block in the piece, verify the hash
                 # and update the records to reflect receipt of the piece
-                if sha1.digest() == self._metainfo.piece_hash(index):
+                verified = (record.sha1.digest() ==
+                            self._metainfo.piece_hash(index))
+                if verified:
+                    _pieces_verified.value += 1
+                    record.verified += 1
                     logger.info("Successfully received piece {} from {}"
                                 .format(index, str(peer.addr())))
                     del self._needed[index]
+                    self._wanted[index] = 0
+                    self._writing.add(index)
                     print "{0}: Downloaded {1:1.4f}%".format(self._filename,
                                                              self.percent())
-                    self._have[index] = 1
+                    self._filemgr.written(index).addCallbacks(
+                        self._piece_written, self._piece_not_written,
+                        callbackArgs=(index,), errbackArgs=(index,))
                 else:
+                    _pieces_failed.value += 1
+                    record.failed += 1
                     logger.info("Unsuccessfully received piece {} from {}"
                                 .format(index, str(peer.addr())))
-                del self._requesting[peer]
+                self._unreserve(peer)
+
+                # Either outcome may show who sent bad data and get them
+                # banned, possibly including this peer
+                if verified:
+                    self._piece_verified(index)
+                else:
+                    self._piece_failed(index)
+                if peer not in self._peers:
+                    return
 
                 if self._needed != {}:
-                    # Try to find another piece for this peer to get
+                    # Try to find another piece for this peer to get and
+                    # let the web seeds see whether the endgame has begun
                     self._check_interest(peer)
+                    self._check_web_seeds()
                 else:
                     logger.info("Successfully downloaded entire torrent {}"
                                 .format(self._filename))
 
+    def _piece_verified(self, index):
+        # When a piece passes the hash check after the blocks from some of
+        # the senders of a failed attempt were downloaded again, the sender
+        # whose blocks were downloaded again last is known to have sent bad
+        # data.  The senders after it were downloaded again in earlier
+        # rounds which still failed, so their blocks weren't the bad ones.
+        self._provenance.pop(index, None)
+        if index in self._retrying:
+            failed, kept = self._retrying.pop(index)
+            addr = failed[kept][1]
+            logger.info("Peer {} sent bad data for piece {}"
+                        .format(str(addr), index))
+            self._strike(addr)
+
+    def _piece_failed(self, index):
+        # Download the blocks of the piece sent by the last sender of the
+        # failed attempt again from other peers, keeping the blocks before
+        # them.  If the piece fails again, the blocks of one more of the
+        # senders are downloaded again, until none are left.
+        provenance = self._provenance.pop(index)
+        if index in self._retrying and self._retrying[index][1] > 0:
+            failed, kept = self._retrying[index]
+            kept -= 1
+        else:
+            failed, kept = provenance, len(provenance) - 1
+        self._retrying[index] = (failed, kept)
+
+        offset, _, sha1 = failed[kept]
+        self._provenance[index] = failed[:kept]
+        if offset > 0:
+            self._partial.append((index, offset, sha1.copy()))
+        _refetched.value += self._length_of_piece(index) - offset
+        logger.debug("Downloading piece {} again from offset {} without {}"
+                     .format(index, offset,
+                             [str(addr) for _, addr, _ in failed[kept:]]))
+
+    def _shunned(self, record, index):
+        # Returns whether the peer should be passed over for the piece
+        # because it rejected a request for it or because it sent blocks of
+        # it which are being downloaded again.  In the latter case, it isn't
+        # passed over when no other peer has the piece.
+        if record.rejected is not None and index in record.rejected:
+            return True
+        if index not in self._retrying:
+            return False
+        failed, kept = self._retrying[index]
+        suspects = set(addr for _, addr, _ in failed[kept:])
+        if record.proxy.addr() not in suspects:
+            return False
+        return any(other.bitfield[index] and
+                   other.proxy.addr() not in suspects
+                   for other in self._peers.itervalues())
+
+    def _strike(self, addr):
+        # Count a piece spoiled by the peer and ban it once it has spoiled
+        # _BAN_STRIKES
+        self._strikes[addr] = self._strikes.get(addr, 0) + 1
+        if self._strikes[addr] < _BAN_STRIKES or addr in self._banned:
+            return
+
+        logger.warning("Banning peer {} of {} after {} bad pieces"
+                       .format(str(addr), self._filename,
+                               self._strikes[addr]))
+        _peers_banned.value += 1
+        self._banned.add(addr)
+        for peer in [peer for peer in self._peers if peer.addr() == addr]:
+            peer.drop_connection()
+            self._remove_peer(peer)
+            if self._state == self._States.Started:
+                self._connect_to_peers(1)
+
+    def _piece_written(self, _, index):
+        # The piece is only available for reading once it is on disk
+        self._writing.discard(index)
+        self._have[index] = 1
+        if self._waiters:
+            self._check_waiters()
+
+        self._unannounced.append(index)
+        if self._announce_timer is None:
+            self._announce_timer = self._scheduler.call_later(
+                _HAVE_WINDOW, self._announce_haves)
+
+    def _piece_not_written(self, failure, index):
+        # The piece has to be downloaded again if it wasn't written
+        logger.error("Piece {} of {} was not written: {}"
+                     .format(index, self._filename,
+                             failure.getErrorMessage()))
+        self._writing.discard(index)
+        if self._piece_priorities[index] != SKIP:
+            self._need([index])
+
+    def peer_exchanged(self, peer, addrs):
+        # Add the new addresses to the peer list and use them to make up any
+        # shortfall in connections
+        connected = set(p.addr() for p in self._peers)
+        added = self._tracker_proxy.add_peers(
+            [addr for addr in addrs if addr not in connected])
+        _pex_peers.value += added
+        if added and self._num_peers() < self._max_peers:
+            self._connect_to_peers(self._max_peers - self._num_peers())
+
     def peer_interested(self, peer):
         pass
 
@@ -437,44 +1557,107 @@ class TorrentMgr(object):
         pass
 
     def peer_request(self, peer, index, begin, length):
-        pass
+        # Uploading is not implemented, so tell peers which expect an answer
+        # that the request won't be served
+        if peer.supports_fast():
+            peer.reject_request(index, begin, length)
 
     def peer_canceled(self, peer, index, begin, length):
         pass
 
-    # Reactor callback
-
-    def timer_event(self):
-        self._reactor.callLater(_TIMER_INTERVAL, self.timer_event)
-        self._tick += 1
-
-        # For any peers that have been interested but unchoked for an
-        # excessive period of time, stop being interested, free up assigned
-        # piece and connect to another peer
-        for peer, (_, _, _, tick) in self._interested.items():
-            if tick + 4 == self._tick:
-                logger.debug("Timed out on interest for peer {}"
-                             .format(str(peer.addr())))
-                peer.not_interested()
-                del self._interested[peer]
-                self._connect_to_peers(1)
+    # Scheduler callbacks
+
+    @lagmonitor.watch('TorrentMgr._announce_haves')
+    def _announce_haves(self):
+        # Tell each peer about the pieces written during the window in one
+        # write.  With have suppression, peers aren't told about pieces they
+        # already have.
+        self._announce_timer = None
+        indices, self._unannounced = self._unannounced, []
+        for peer, record in self._peers.iteritems():
+            if self._suppress_haves:
+                bitfield = record.bitfield
+                to_send = [index for index in indices if not bitfield[index]]
+                _haves_suppressed.value += len(indices) - len(to_send)
+            else:
+                to_send = indices
+            if to_send:
+                peer.haves(to_send)
+
+    def _exchange_peers(self):
+        addrs = [peer.addr() for peer in self._peers
+                 if peer.is_connected() and peer not in self._web_seeds]
+        for peer in self._peers:
+            peer.exchange_peers(addrs)
+        self._pex_timer = self._scheduler.call_later(_PEX_INTERVAL,
+                                                     self._exchange_peers)
+
+    @lagmonitor.watch('TorrentMgr._interest_timeout')
+    def _interest_timeout(self, peer):
+        # When a peer has been interested but unchoked for an excessive period
+        # of time, stop being interested, free up the assigned piece and
+        # connect to another peer
+        logger.debug("Timed out on interest for peer {}"
+                     .format(str(peer.addr())))
+        if tracer.enabled:
+            tracer.record(tracer.TIMEOUT, peer.addr())
+        self._release_piece(peer)
+        peer.not_interested()
+        self._replace_peer(peer)
+
+    @lagmonitor.watch('TorrentMgr._snub_timeout_expired')
+    def _snub_timeout_expired(self, peer):
+        # When a peer which is being requested from has delivered nothing for
+        # the snub timeout, free up its piece and connect to another peer.
+        # Otherwise, check again when it would next become snubbed.  A peer
+        # which hasn't been sent its request because the disk is behind
+        # isn't to blame.
+        record = self._peers[peer]
+        record.snub_timer = None
+        now = self._reactor.seconds()
+        if peer.is_snubbed() and peer not in self._stalled:
+            logger.debug("Peer {} is snubbed".format(str(peer.addr())))
+            if tracer.enabled:
+                tracer.record(tracer.TIMEOUT, peer.addr(), record.piece,
+                              record.received, record.retries)
+            self._release_piece(peer)
+            peer.not_interested()
+            self._replace_peer(peer)
+            return
+
+        deadline = peer.snub_deadline()
+        if deadline is None or deadline <= now:
+            deadline = now + self._snub_timeout
+        record.snub_timer = self._scheduler.call_at(
+            deadline, self._snub_timeout_expired, peer)
 
-        # For any peer that has an outstanding request for an excessive period
+    @lagmonitor.watch('TorrentMgr._request_timeout')
+    def _request_timeout(self, peer):
+        # When a peer has had an outstanding request for an excessive period
         # of time, resend the request message in case it got lost or is being
-        # ignored
-        for peer, (index, offset, sha1, tick, retries) \
-                in self._requesting.items():
-            if tick + 5 == self._tick:
-                logger.debug("Timed out on request for peer {}"
-                             .format(str(peer.addr())))
-                if retries < _MAX_RETRIES:
-                    self._requesting[peer] = (index, offset, sha1,
-                                              self._tick, retries+1)
-                    self._request(peer)
-                else:
-                    logger.debug("Giving up on peer {}"
-                                 .format(str(peer.addr())))
-                    self._partial.append((index, offset, sha1))
-                    del self._requesting[peer]
-                    peer.not_interested()
-                    self._connect_to_peers(1)
+        # ignored.  Give up on peers that are snubbing us or have not
+        # responded after several retries.
+        record = self._peers[peer]
+        index, offset, retries = (record.piece, record.received,
+                                  record.retries)
+
+        # A peer which hasn't been sent its request because the disk is
+        # behind isn't to blame
+        if peer in self._stalled:
+            record.timer = self._scheduler.call_later(
+                _REQUEST_TIMEOUT, self._request_timeout, peer)
+            return
+
+        if tracer.enabled:
+            tracer.record(tracer.TIMEOUT, peer.addr(), index, offset,
+                          retries+1)
+
+        if peer.is_snubbed() or retries >= _MAX_RETRIES:
+            logger.debug("Giving up on peer {}".format(str(peer.addr())))
+            self._release_piece(peer)
+            peer.not_interested()
+            self._replace_peer(peer)
+        else:
+            logger.debug("Timed out on request for peer {}"
+                         .format(str(peer.addr())))
+            self._request(peer, retries+1, resend=True)
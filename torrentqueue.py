@@ -0,0 +1,265 @@
+"""
+The TorrentQueue decides which of the client's torrents are active.  Torrents
+are added to the end of the queue once they have been initialized and only
+those the queue makes active are started, so adding a thousand torrents
+doesn't open twenty thousand connections at once.  A torrent which is not
+active is stopped (see TorrentMgr.stop()) and holds no sockets, timers or open
+files.
+
+The queue has three limits:
+
+    downloads    the number of incomplete torrents which are active
+    seeds        the number of complete torrents which are active
+    connections  the number of peer connections shared by the active torrents
+
+The active torrents are the first downloads incomplete torrents and the first
+seeds complete torrents in queue order.  If there are more of them than
+connections, only the first connections of them are active.  The connections
+are divided among the active torrents by need by a ConnectionBudget (see
+connbudget.py) and each torrent is told how many peers it may connect to with
+set_max_peers().
+
+Every _CHECK_INTERVAL seconds, the queue looks at the progress of the active
+torrents and divides the connections again.  A download which completes
+becomes a seed, making room for the next queued download.  A download which
+hasn't made any progress for _STALL_TIMEOUT seconds while other downloads are
+waiting is moved to the end of the queue so that the next one is given a
+chance.  The queue is also reconsidered whenever a torrent is added or moved
+or the limits change.
+
+The torrents may be TorrentMgrs or RemoteTorrents hosted by a worker (see
+workerpool.py), whose start(), stop() and set_max_peers() return Deferreds.
+Torrents whose worker has exited are reported as lost and torrents restored
+from the session store which couldn't be loaded (see session.py) are reported
+as failed.  Neither is ever made active.
+"""
+
+import logging
+
+from connbudget import ConnectionBudget
+from scheduler import get_scheduler
+
+from twisted.internet.defer import maybeDeferred
+
+logger = logging.getLogger('bt.torrentqueue')
+
+_DOWNLOADS = 5
+_SEEDS = 5
+_CONNECTIONS = 200
+
+_CHECK_INTERVAL = 5
+_STALL_TIMEOUT = 300
+
+_UNAVAILABLE = ('lost', 'failed')
+
+
+class TorrentQueue(object):
+    def __init__(self, reactor, downloads=_DOWNLOADS, seeds=_SEEDS,
+                 connections=_CONNECTIONS):
+        self._reactor = reactor
+        self._scheduler = get_scheduler(reactor)
+        self._check_limits(downloads, seeds, connections)
+        self._downloads = downloads
+        self._seeds = seeds
+        self._budget = ConnectionBudget(reactor, connections)
+
+        # _order is the list of keys of the torrents in queue order and
+        # _torrents maps each key to its torrent.  _active maps the key of
+        # each active torrent to the number of peers it may connect to.
+        # _progress maps the key of each active download to its percent
+        # downloaded and the time at which that last changed.
+        self._order = []
+        self._torrents = {}
+        self._active = {}
+        self._progress = {}
+        self._timer = None
+
+    def _check_limits(self, downloads, seeds, connections):
+        if downloads < 0 or seeds < 0:
+            raise ValueError("Queue limits can't be negative")
+        if connections < 1:
+            raise ValueError("There must be at least one connection")
+
+    def add(self, key, torrent):
+        """
+        add() adds the initialized torrent to the end of the queue and starts
+        it if there is room for it.
+        """
+        self.extend([(key, torrent)])
+
+    def extend(self, torrents):
+        """
+        extend() adds the torrents in a list of (key, torrent) pairs to the
+        end of the queue in order and starts those there is room for.
+        """
+        for key, torrent in torrents:
+            self._order.append(key)
+            self._torrents[key] = torrent
+        if self._timer is None:
+            self._timer = self._scheduler.call_later(_CHECK_INTERVAL,
+                                                     self._check)
+        self._update()
+
+    def move(self, key, position):
+        """
+        move() moves the torrent to the specified position in the queue,
+        counting from 0, and starts or stops torrents to match.  It raises a
+        ValueError if the key or the position is invalid.
+        """
+        if key not in self._torrents:
+            raise ValueError("Invalid key: {}".format(key))
+        if not 0 <= position < len(self._order):
+            raise ValueError("Invalid queue position: {}".format(position))
+
+        self._order.remove(key)
+        self._order.insert(position, key)
+        self._update()
+
+    def order(self):
+        """
+        order() returns a list of the keys of the torrents in queue order.
+        """
+        return list(self._order)
+
+    def limits(self):
+        """
+        limits() returns a dictionary of the queue's limits.
+        """
+        return dict(downloads=self._downloads, seeds=self._seeds,
+                    connections=self._budget.limit())
+
+    def set_limits(self, downloads=None, seeds=None, connections=None):
+        """
+        set_limits() changes those of the queue's limits which are supplied,
+        starts or stops torrents to match and returns the limits.  It raises
+        a ValueError if a limit is invalid.
+        """
+        downloads = self._downloads if downloads is None else downloads
+        seeds = self._seeds if seeds is None else seeds
+        if connections is None:
+            connections = self._budget.limit()
+        self._check_limits(downloads, seeds, connections)
+
+        self._downloads = downloads
+        self._seeds = seeds
+        self._budget.set_limit(connections)
+        logger.info("Queue limits: {} downloads, {} seeds, {} connections"
+                    .format(downloads, seeds, connections))
+        self._update()
+        return self.limits()
+
+    def state(self, key):
+        """
+        state() returns the state of the torrent in the queue: downloading,
+        seeding, queued, lost or failed.
+        """
+        torrent = self._torrents[key]
+        if torrent.state() in _UNAVAILABLE:
+            return torrent.state()
+        if key not in self._active:
+            return 'queued'
+        return 'seeding' if self._is_seed(torrent) else 'downloading'
+
+    def entries(self):
+        """
+        entries() returns a list of dictionaries containing the key, name,
+        position, state, percent downloaded and number of connections
+        granted of each torrent in queue order.
+        """
+        return [dict(key=key, name=self._torrents[key].name(),
+                     position=position, state=self.state(key),
+                     percent=float(self._torrents[key].percent()),
+                     connections=self._active.get(key, 0))
+                for position, key in enumerate(self._order)]
+
+    def _is_seed(self, torrent):
+        return float(torrent.percent()) >= 100
+
+    def _check(self):
+        # Note the progress of the active downloads, moving those which have
+        # stalled to the end of the queue if others are waiting, and bring
+        # the active torrents up to date
+        now = self._reactor.seconds()
+        waiting = any(key not in self._active and
+                      self._torrents[key].state() not in _UNAVAILABLE and
+                      not self._is_seed(self._torrents[key])
+                      for key in self._order)
+
+        for key in list(self._progress):
+            torrent = self._torrents[key]
+            percent = float(torrent.percent())
+            if percent != self._progress[key][0]:
+                self._progress[key] = (percent, now)
+            elif (waiting and not self._is_seed(torrent) and
+                    now - self._progress[key][1] >= _STALL_TIMEOUT):
+                logger.info("Download of {} has stalled, moving it to the "
+                            "end of the queue".format(torrent.name()))
+                self._order.remove(key)
+                self._order.append(key)
+                self._progress[key] = (percent, now)
+
+        self._update()
+        self._timer = self._scheduler.call_later(_CHECK_INTERVAL, self._check)
+
+    def _update(self):
+        # Start and stop torrents so that the active torrents are the ones
+        # the limits allow and tell each of them the number of connections
+        # the budget grants it
+        downloads = []
+        seeds = []
+        for key in self._order:
+            torrent = self._torrents[key]
+            if torrent.state() in _UNAVAILABLE:
+                continue
+            if self._is_seed(torrent):
+                if len(seeds) < self._seeds:
+                    seeds.append(key)
+            elif len(downloads) < self._downloads:
+                downloads.append(key)
+
+        wanted = set(downloads + seeds)
+        active = [key for key in self._order
+                  if key in wanted][:self._budget.limit()]
+        grants = self._budget.allocate({key: self._torrents[key]
+                                        for key in active})
+
+        for key in [key for key in self._active if key not in active]:
+            self._stop(key)
+
+        now = self._reactor.seconds()
+        for key in active:
+            torrent = self._torrents[key]
+            if key not in self._active:
+                self._start(key, grants[key])
+            elif self._active[key] != grants[key]:
+                self._active[key] = grants[key]
+                self._call(torrent.set_max_peers, grants[key])
+
+            if self._is_seed(torrent):
+                self._progress.pop(key, None)
+            elif key not in self._progress:
+                self._progress[key] = (float(torrent.percent()), now)
+
+    def _start(self, key, slots):
+        torrent = self._torrents[key]
+        logger.info("Starting {} with up to {} peers"
+                    .format(torrent.name(), slots))
+        self._active[key] = slots
+        self._call(torrent.set_max_peers, slots)
+        self._call(torrent.start)
+
+    def _stop(self, key):
+        torrent = self._torrents[key]
+        logger.info("Stopping {}".format(torrent.name()))
+        del self._active[key]
+        self._progress.pop(key, None)
+        if torrent.state() not in _UNAVAILABLE:
+            self._call(torrent.stop)
+
+    def _call(self, function, *args):
+        def failure(failure):
+            logger.error("Queue couldn't {}: {}"
+                         .format(function.__name__,
+                                 failure.getErrorMessage()))
+
+        return maybeDeferred(function, *args).addErrback(failure)
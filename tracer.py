@@ -0,0 +1,203 @@
+"""
+The tracer records events on hot paths into a fixed size binary ring buffer
+instead of formatting log messages for them.  Tracing is off by default and
+can be turned on and off at run time, for example over the control channels.
+
+Trace points are guarded by the module level enabled flag so that the cost of
+a trace point when tracing is off is a single global attribute lookup and no
+arguments are formatted:
+
+    if tracer.enabled:
+        tracer.record(tracer.BLOCK_RECEIVED, peer.addr(), index, begin, length)
+
+When tracing is on, only one out of every sample_every events is recorded.
+Each record holds the time, an event id, the process which recorded it, the
+address of the peer involved and up to three unsigned integer arguments packed
+into RECORD_SIZE bytes.  Once the ring buffer is full, new records overwrite
+the oldest ones.
+
+dump() returns the raw contents of the ring buffer, oldest record first, and
+decode() turns raw records back into dictionaries.  Each worker process (see
+worker.py) has its own ring buffer and calls set_source() so that its records
+can be told apart once merge() has combined them with the client's.
+"""
+
+import socket
+import struct
+import time
+
+_DEFAULT_CAPACITY = 65536
+
+# time, event id, source, port, ip address, three arguments
+_RECORD = struct.Struct('<dBBHI3I')
+RECORD_SIZE = _RECORD.size
+_TIME = struct.Struct('<d')
+
+(BLOCK_RECEIVED, BLOCK_IGNORED, REQUEST, HAVE, BITFIELD, CHOKE, UNCHOKE,
+ INTERESTED, NOT_INTERESTED, TIMEOUT, REJECT, ALLOWED_FAST) = range(12)
+
+EVENT_NAMES = {BLOCK_RECEIVED: 'block_received',
+               BLOCK_IGNORED: 'block_ignored',
+               REQUEST: 'request',
+               HAVE: 'have',
+               BITFIELD: 'bitfield',
+               CHOKE: 'choke',
+               UNCHOKE: 'unchoke',
+               INTERESTED: 'interested',
+               NOT_INTERESTED: 'not_interested',
+               TIMEOUT: 'timeout',
+               REJECT: 'reject',
+               ALLOWED_FAST: 'allowed_fast'}
+
+enabled = False
+sample_every = 1
+
+_capacity = _DEFAULT_CAPACITY
+_buffer = None
+_next = 0
+_count = 0
+_skipped = 0
+
+# _source is 0 in the client and one more than the index of the worker in a
+# worker process
+_source = 0
+
+
+def enable(sample=1, capacity=None):
+    """
+    enable() turns tracing on, recording one out of every sample events.  The
+    ring buffer is allocated the first time tracing is turned on and is
+    reallocated, discarding its contents, if a different capacity (in records)
+    is specified.
+    """
+    global enabled, sample_every, _capacity, _buffer, _next, _count, _skipped
+
+    if sample < 1:
+        raise ValueError("Sample rate must be at least 1")
+
+    if capacity is not None and capacity != _capacity:
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1")
+        _capacity = capacity
+        _buffer = None
+
+    if _buffer is None:
+        _buffer = bytearray(_capacity * _RECORD.size)
+        _next = _count = 0
+
+    sample_every = sample
+    _skipped = 0
+    enabled = True
+
+
+def set_source(source):
+    """
+    set_source() sets the source stored in each record made by this process,
+    which is 0 in the client and one more than the worker's index in a
+    worker.
+    """
+    global _source
+    _source = source
+
+
+def disable():
+    """
+    disable() turns tracing off.  The contents of the ring buffer are kept so
+    that they can still be dumped.
+    """
+    global enabled
+    enabled = False
+
+
+def clear():
+    global _next, _count
+    _next = _count = 0
+
+
+def status():
+    return {'enabled': enabled,
+            'sample': sample_every,
+            'capacity': _capacity,
+            'records': min(_count, _capacity),
+            'recorded': _count}
+
+
+def _ip_to_int(ip):
+    # Converting each time is cheap and, unlike a cache, doesn't grow with
+    # every address the client ever talks to
+    try:
+        return struct.unpack('>I', socket.inet_aton(ip))[0]
+    except socket.error:
+        return 0
+
+
+def record(event, addr, a=0, b=0, c=0):
+    """
+    record() adds an event involving the peer at addr to the ring buffer
+    unless it is skipped by sampling.  Callers should check enabled before
+    calling record().
+    """
+    global _next, _count, _skipped
+
+    if sample_every > 1:
+        _skipped += 1
+        if _skipped < sample_every:
+            return
+        _skipped = 0
+
+    if addr is None:
+        ip, port = 0, 0
+    else:
+        ip, port = _ip_to_int(addr[0]), addr[1]
+
+    _RECORD.pack_into(_buffer, _next * _RECORD.size, time.time(), event,
+                      _source, port, ip, a, b, c)
+    _next = (_next + 1) % _capacity
+    _count += 1
+
+
+def dump():
+    """
+    dump() returns the raw contents of the ring buffer as a string of bytes
+    with the oldest record first.
+    """
+    if _buffer is None:
+        return ''
+    if _count < _capacity:
+        return str(_buffer[:_next * _RECORD.size])
+    split = _next * _RECORD.size
+    return str(_buffer[split:] + _buffer[:split])
+
+
+def merge(dumps):
+    """
+    merge() combines strings of raw records as returned by dump() in
+    different processes into a single string of raw records, oldest record
+    first.
+    """
+    records = []
+    for data in dumps:
+        records.extend(data[offset:offset + _RECORD.size] for offset
+                       in xrange(0, len(data) - _RECORD.size + 1,
+                                 _RECORD.size))
+    records.sort(key=lambda record: _TIME.unpack_from(record)[0])
+    return ''.join(records)
+
+
+def decode(data):
+    """
+    decode() converts a string of raw records as returned by dump() into a
+    list of dictionaries.  The worker of each record is None if it was made
+    by the client.
+    """
+    records = []
+    for offset in xrange(0, len(data) - _RECORD.size + 1, _RECORD.size):
+        t, event, source, port, ip, a, b, c = _RECORD.unpack_from(data,
+                                                                  offset)
+        records.append({'time': t,
+                        'event': EVENT_NAMES.get(event, str(event)),
+                        'worker': source - 1 if source else None,
+                        'addr': "{}:{}".format(
+                            socket.inet_ntoa(struct.pack('>I', ip)), port),
+                        'args': [a, b, c]})
+    return records
@@ -11,17 +11,40 @@ announce-list in the Metainfo object.
 The TrackerProxy should periodically report progress back to the tracker and
 notify it when it has downloaded the entire torrent.  If the peer list is
 exhausted, it should also get more peers from the tracker.
+
+Addresses of peers learned from other sources, such as peer exchange, can be
+added to the peer list with add_peers() so that they are handed out by
+get_peers() along with those from the tracker.  An address is only ever added
+to the list once.  The addresses of peers which were connected to can be put
+back at the front of the list with return_peers(), as the TorrentMgr does
+when it is stopped.
+
+The time taken by the tracker to respond to an announce and the number of
+announces which fail are recorded in the metrics registry.
 """
 
 import bencode
 import logging
+import metrics
 import sys
+import time
+import urllib
 
 from twisted.internet.defer import Deferred
 from twisted.web.client import getPage
 
 logger = logging.getLogger('bt.trackerproxy')
 
+# Seconds to wait for the tracker before giving up on an announce so that a
+# tracker which never responds doesn't hold up the initialization of a torrent
+_ANNOUNCE_TIMEOUT = 30
+
+_announce_seconds = metrics.histogram('bt_tracker_announce_seconds',
+                                      "Time taken by the tracker to respond "
+                                      "to an announce")
+_announce_errors = metrics.counter('bt_tracker_announce_errors_total',
+                                   "Announces which failed")
+
 
 class TrackerError(Exception):
     pass
@@ -35,8 +58,14 @@ class TrackerProxy(object):
         self._started = False
         self._tracker_id = ""
 
+        # _known is the set of addresses which have been added to the peer
+        # list
+        self._known = set()
+
     def _params_str(self, params_dict):
-        return "&".join(str(k)+"="+str(v) for (k, v) in params_dict.items())
+        # Values such as the info hash are binary and must be escaped
+        return "&".join(str(k)+"="+urllib.quote(str(v), safe='')
+                        for (k, v) in params_dict.items())
 
     def start(self):
         """
@@ -58,9 +87,17 @@ class TrackerProxy(object):
 
         addr = self._metainfo.announce+"?"+self._params_str(params)
 
-        return getPage(addr).addCallbacks(self._decode, self._connect_error)
+        start = time.time()
+
+        def responded(result):
+            _announce_seconds.observe(time.time() - start)
+            return result
+
+        return (getPage(addr, timeout=_ANNOUNCE_TIMEOUT).addBoth(responded)
+                .addCallbacks(self._decode, self._connect_error))
 
     def _connect_error(self, failure):
+        _announce_errors.value += 1
         raise TrackerError("Can't connect to the tracker at {}"
                            .format(self._metainfo.announce))
 
@@ -68,6 +105,7 @@ class TrackerProxy(object):
         response = bencode.bdecode(content)
 
         if 'failure reason' in response:
+            _announce_errors.value += 1
             raise TrackerError("Failure reason: {}"
                                .format(response['failure reason']))
 
@@ -99,10 +137,47 @@ class TrackerProxy(object):
                                         'port': (ord(peers[offset+4])*256 +
                                                  ord(peers[offset+5]))})
         except Exception:
+            _announce_errors.value += 1
             raise TrackerError("Invalid tracker response")
 
+        self._known.update((peer['ip'], peer['port']) for peer in self._peers)
         self._started = True
 
+    def add_peers(self, addrs):
+        """
+        add_peers() adds those of the supplied (ip, port) addresses which have
+        not been seen before to the peer list and returns the number added.
+        """
+        added = 0
+        for ip, port in addrs:
+            if (ip, port) not in self._known:
+                self._known.add((ip, port))
+                self._peers.append({'ip': ip, 'port': port})
+                added += 1
+        return added
+
+    def num_peers(self):
+        """
+        num_peers() returns the number of addresses in the peer list which
+        have not been handed out.
+        """
+        return len(self._peers)
+
+    def available_peers(self, n):
+        """
+        available_peers() returns the first n (ip, port) addresses in the
+        peer list without handing them out.
+        """
+        return [(peer['ip'], peer['port']) for peer in self._peers[:n]]
+
+    def return_peers(self, addrs):
+        """
+        return_peers() puts the supplied (ip, port) addresses, which were
+        previously handed out by get_peers() or added, back at the front of
+        the peer list.
+        """
+        self._peers[:0] = [{'ip': ip, 'port': port} for ip, port in addrs]
+
     def get_peers(self, n):
         """
         get_peers() takes a number and returns a deferred which fires when
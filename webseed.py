@@ -0,0 +1,417 @@
+"""
+A WebSeed downloads the pieces of a torrent from an HTTP server which
+publishes the torrent's files (BEP 19).  The urls of a torrent's web seeds
+are listed under url-list in its metainfo.  The url of a single file torrent
+is the url of the file itself unless it ends with a slash, in which case the
+name of the torrent is appended to it.  The files of a multi file torrent are
+found under the url followed by the name of the torrent and the path of each
+file.
+
+The TorrentMgr treats a WebSeed as a peer which has every piece and never
+chokes, so it reserves pieces for a WebSeed and requests their blocks just as
+it does for a PeerProxy, and the WebSeed delivers the blocks through the same
+peer_sent_block() callback.  Rather than sending a GET for each block, the
+WebSeed queues the blocks which are requested and fetches the longest run of
+consecutive queued blocks with a single GET with a Range header, so a full
+pipeline of requests becomes a single GET.  A run which spans several files
+is fetched with a GET for each file in turn.  Only one GET is outstanding at
+a time and the blocks requested meanwhile are fetched together by the next.
+A block which is cancelled is dropped from the queue, but one which is
+already being fetched still arrives with the rest of its GET.
+
+The GETs are made through an Agent whose HTTPConnectionPool keeps the
+connections to each server open between requests.  There is a single Agent
+for each reactor which is obtained by calling get_agent() and is shared by
+all of the WebSeeds.
+
+The body of a response is charged to the torrent's account with the memory
+budget (see membudget.py) until its blocks have been handed to the
+TorrentMgr, and the connection is registered with the budget while the body
+is being received so that reading from it is paused along with the peer
+connections when the budget is exhausted.
+
+A GET which fails, is answered with a status other than 206 Partial Content
+(or 200 OK when the whole of a file was asked for) or delivers the wrong
+number of bytes makes the WebSeed unconnected: its requests are discarded and
+the TorrentMgr is told through peer_unconnected().  Telling a WebSeed that
+this client is not interested discards its requests as well, abandoning the
+GET in progress.
+
+The WebSeed keeps the download rate and the times of the most recent activity
+in the same way as the PeerProxy and is considered snubbed when its requests
+have been outstanding for longer than the snub timeout without a block
+arriving.  The bytes of piece data received from web seeds and the number of
+failed GETs are recorded in the metrics registry.
+"""
+
+import logging
+import membudget
+import metrics
+import urllib
+import urlparse
+
+from ratemeter import RateMeter
+
+from twisted.internet.protocol import Protocol
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http_headers import Headers
+
+logger = logging.getLogger('bt.webseed')
+
+_SNUB_TIMEOUT = 60
+
+# The number of idle connections kept open to each server
+_CONNECTIONS_PER_HOST = 4
+
+_PORTS = {'http': 80, 'https': 443}
+
+_received = metrics.counter('bt_web_seed_bytes_total',
+                            "Bytes of piece data received from web seeds")
+_failures = metrics.counter('bt_web_seed_failures_total',
+                            "Requests to web seeds which failed")
+
+_agents = {}
+
+
+def get_agent(reactor):
+    """
+    get_agent() returns the Agent with which the WebSeeds of the specified
+    reactor make their requests, creating it if necessary.
+    """
+    if reactor not in _agents:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = _CONNECTIONS_PER_HOST
+        _agents[reactor] = Agent(reactor, pool=pool)
+    return _agents[reactor]
+
+
+class WebSeedError(Exception):
+    pass
+
+
+class _Fetch(object):
+    # A run of consecutive blocks being fetched.  segments is the list of
+    # the url, offset, length and file length of the part of the run in each
+    # file which has yet to be asked for and remaining is the number of bytes
+    # of the current GET which have yet to arrive.  buf holds the received
+    # bytes which don't yet make up the next block and transport is the
+    # transport of the response being received, if any.
+    def __init__(self, blocks, segments):
+        self.blocks = blocks
+        self.segments = segments
+        self.remaining = 0
+        self.buf = []
+        self.buffered = 0
+        self.transport = None
+
+
+class _Body(Protocol):
+    # Receives the body of a response for a WebSeed
+    def __init__(self, seed, fetch):
+        self._seed = seed
+        self._fetch = fetch
+
+    def connectionMade(self):
+        membudget.budget.register(self.transport)
+        self._fetch.transport = self.transport
+
+    def dataReceived(self, data):
+        self._seed._body_received(self._fetch, data)
+
+    def connectionLost(self, reason):
+        membudget.budget.unregister(self.transport)
+        self._fetch.transport = None
+        self._seed._body_done(self._fetch, reason)
+
+
+class _Discard(Protocol):
+    # Closes the connection of a response which is no longer wanted
+    def connectionMade(self):
+        self.transport.stopProducing()
+
+
+class WebSeed(object):
+    def __init__(self, client, url, metainfo, reactor, account=None,
+                 snub_timeout=_SNUB_TIMEOUT):
+        self._client = client
+        self._url = url
+        self._reactor = reactor
+        self._agent = get_agent(reactor)
+        self._account = account
+        self._snub_timeout = snub_timeout
+        self._piece_length = metainfo.piece_length
+        self._connected = True
+        self._interested = False
+
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in _PORTS or not parsed.hostname:
+            raise ValueError("Invalid web seed url: {}".format(url))
+        self._addr = (parsed.hostname, parsed.port or _PORTS[parsed.scheme])
+
+        # _files is a list of the url, length and offset within the torrent
+        # of each file
+        self._files = []
+        offset = 0
+        for path, length in metainfo.files:
+            if metainfo.directory == '':
+                if url.endswith('/'):
+                    file_url = url + urllib.quote(metainfo.name)
+                else:
+                    file_url = url
+            else:
+                file_url = (url.rstrip('/') + '/' +
+                            '/'.join(urllib.quote(part) for part
+                                     in [metainfo.directory] + path))
+            self._files.append((file_url, length, offset))
+            offset += length
+
+        # _queue is the list of the index, offset and length of each block
+        # which has been requested but not yet asked of the server and
+        # _fetch is the _Fetch in progress or None.  _scheduled is whether a
+        # fetch of the queued blocks is due once the current requests have
+        # all been queued.
+        self._queue = []
+        self._fetch = None
+        self._scheduled = False
+
+        # Transfer statistics, as for the PeerProxy
+        now = reactor.seconds()
+        self._download = RateMeter(reactor)
+        self._last_rx = now
+        self._last_tx = now
+        self._last_block = None
+        self._pending = 0
+        self._pending_since = now
+
+    def url(self):
+        return self._url
+
+    def addr(self):
+        return self._addr
+
+    def is_interested(self):
+        return self._interested
+
+    def is_peer_choked(self):
+        return False
+
+    def supports_fast(self):
+        return False
+
+    def is_allowed_fast(self, index):
+        return False
+
+    def is_connected(self):
+        return self._connected
+
+    def download_rate(self):
+        return self._download.rate()
+
+    def upload_rate(self):
+        return 0.0
+
+    def downloaded(self):
+        return self._download.total()
+
+    def uploaded(self):
+        return 0
+
+    def last_activity(self):
+        """
+        last_activity() returns the times at which data was last received
+        from and a block last requested of the web seed and the time at which
+        a block was last received (None if no block has been received).
+        """
+        return self._last_rx, self._last_tx, self._last_block
+
+    def is_snubbed(self):
+        return (self._pending > 0 and
+                self._reactor.seconds() - self._pending_since >=
+                self._snub_timeout)
+
+    def snub_deadline(self):
+        if self._pending == 0:
+            return None
+        return self._pending_since + self._snub_timeout
+
+    def _segments(self, offset_in_torrent, length):
+        # Returns a list of tuples containing the url, the offset within the
+        # file, the number of bytes and the length of the file for each part
+        # of the span of the torrent which falls in a different file
+        segments = []
+        for url, file_length, file_offset in self._files:
+            if length == 0:
+                break
+            offset_in_file = offset_in_torrent - file_offset
+            if 0 <= offset_in_file < file_length:
+                n = min(length, file_length - offset_in_file)
+                segments.append((url, offset_in_file, n, file_length))
+                offset_in_torrent += n
+                length -= n
+        return segments
+
+    def _offset(self, block):
+        index, begin, _ = block
+        return index * self._piece_length + begin
+
+    def _start_fetch(self):
+        # Fetch the longest run of consecutive blocks at the head of the
+        # queue
+        self._scheduled = False
+        if self._fetch is not None or not self._queue:
+            return
+
+        blocks = [self._queue.pop(0)]
+        while (self._queue and self._offset(self._queue[0]) ==
+               self._offset(blocks[-1]) + blocks[-1][2]):
+            blocks.append(self._queue.pop(0))
+
+        length = sum(block[2] for block in blocks)
+        self._fetch = _Fetch(blocks, self._segments(self._offset(blocks[0]),
+                                                    length))
+        self._get(self._fetch)
+
+    def _get(self, fetch):
+        # Ask for the next segment of the fetch
+        url, offset, n, file_length = fetch.segments.pop(0)
+        fetch.remaining = n
+        headers = Headers({'Range': ["bytes={}-{}".format(offset,
+                                                          offset + n - 1)]})
+        d = self._agent.request('GET', url, headers)
+        d.addCallback(self._response, fetch, offset == 0 and n == file_length)
+        d.addErrback(self._failed, fetch)
+
+    def _response(self, response, fetch, whole):
+        if fetch is not self._fetch:
+            response.deliverBody(_Discard())
+            return
+        if response.code != 206 and not (response.code == 200 and whole):
+            response.deliverBody(_Discard())
+            raise WebSeedError("HTTP status {} {}"
+                               .format(response.code, response.phrase))
+        response.deliverBody(_Body(self, fetch))
+
+    def _body_received(self, fetch, data):
+        if fetch is not self._fetch:
+            return
+        if len(data) > fetch.remaining:
+            self._fail(fetch, "More data than requested")
+            return
+
+        self._last_rx = self._reactor.seconds()
+        fetch.remaining -= len(data)
+        fetch.buf.append(data)
+        fetch.buffered += len(data)
+        if self._account is not None:
+            self._account.charge('receive', len(data))
+
+        # Hand over each block which is complete.  The client may abandon
+        # the fetch from the callback.
+        while (fetch is self._fetch and fetch.blocks and
+               fetch.buffered >= fetch.blocks[0][2]):
+            index, begin, length = fetch.blocks.pop(0)
+            buf = ''.join(fetch.buf)
+            block, rest = buf[:length], buf[length:]
+            fetch.buf = [rest] if rest else []
+            fetch.buffered -= length
+
+            self._download.update(length)
+            _received.value += length
+            self._last_block = self._pending_since = self._last_rx
+            if self._pending > 0:
+                self._pending -= 1
+            try:
+                self._client.peer_sent_block(self, index, begin, block)
+            finally:
+                if self._account is not None:
+                    self._account.release('receive', length)
+
+    def _body_done(self, fetch, reason):
+        if fetch is not self._fetch:
+            return
+        if not reason.check(ResponseDone) or fetch.remaining > 0:
+            self._fail(fetch, "Response ended after {} bytes too few"
+                              .format(fetch.remaining))
+            return
+
+        if fetch.segments:
+            self._get(fetch)
+        else:
+            self._fetch = None
+            self._start_fetch()
+
+    def _failed(self, failure, fetch):
+        if fetch is self._fetch:
+            self._fail(fetch, failure.getErrorMessage())
+
+    def _fail(self, fetch, reason):
+        _failures.value += 1
+        logger.info("Web seed {} failed: {}".format(self._url, reason))
+        self._drop_connection()
+
+    def _abandon(self):
+        # Discard the requests, closing the connection of the response
+        # being received if there is one
+        fetch, self._fetch = self._fetch, None
+        if fetch is not None:
+            if self._account is not None and fetch.buffered:
+                self._account.release('receive', fetch.buffered)
+            if fetch.transport is not None:
+                fetch.transport.stopProducing()
+        self._queue = []
+        self._pending = 0
+
+    def _drop_connection(self, notify_client=True):
+        self._connected = False
+        self._interested = False
+        self._abandon()
+        if notify_client:
+            self._client.peer_unconnected(self)
+
+    # Client calls
+
+    def drop_connection(self):
+        self._drop_connection(False)
+
+    def interested(self):
+        if self._connected:
+            self._interested = True
+
+    def not_interested(self):
+        if self._connected:
+            self._interested = False
+            self._abandon()
+
+    def request(self, index, begin, length):
+        # A request which is resent after a timeout is already queued or
+        # being fetched
+        block = (index, begin, length)
+        if (not self._connected or block in self._queue or
+                (self._fetch is not None and block in self._fetch.blocks)):
+            return
+
+        self._last_tx = self._reactor.seconds()
+        if self._pending == 0:
+            self._pending_since = self._last_tx
+        self._pending += 1
+        self._queue.append(block)
+
+        # The blocks are fetched once the client has made all of the
+        # requests it is making now so that they are fetched together
+        if self._fetch is None and not self._scheduled:
+            self._scheduled = True
+            self._reactor.callLater(0, self._start_fetch)
+
+    def cancel(self, index, begin, length):
+        block = (index, begin, length)
+        if block in self._queue:
+            self._queue.remove(block)
+            if self._pending > 0:
+                self._pending -= 1
+
+    def haves(self, indices):
+        # Web seeds aren't told which pieces this client has
+        pass
+
+    def exchange_peers(self, addrs):
+        pass
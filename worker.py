@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+A worker is a process which hosts a share of the client's TorrentMgrs so that
+the torrents are spread across several reactors and CPU cores.  Workers are
+started by the client's WorkerPool and never by hand.
+
+The worker talks to the client over AMP on its stdin and stdout using the
+commands in workercommands.py.  The client asks the worker to add torrents,
+optionally with resume data, to start and stop them as its queue decides, to
+limit their peers, to report the resume data, peers and files of a torrent, to
+set the priorities of its files, to stream a torrent and to read from its
+files.  The client also asks each worker for its metrics, lag and trace
+records, to turn its tracing on and off and to profile it, and combines the
+results with its own.  Results which may not fit in an AMP value are held by
+the worker and read by the client in chunks.  The worker subscribes to its
+own StatusPublisher and pushes the changes to the status of its torrents to
+the client every interval seconds so that the client can answer status
+requests without asking the worker.  When the client goes away, the worker
+stops.
+
+Since stdout carries the AMP channel, anything the TorrentMgrs print and the
+console logging handler are redirected to stderr, which the client passes on
+to its own stderr.
+
+Usage:
+
+    python worker.py index interval [memory]
+
+where memory is the limit of the worker's memory budget in bytes.
+"""
+
+import sys
+
+# Keep prints from reaching the AMP channel.  This must happen before logging
+# is configured since the console handler writes to sys.stdout.
+sys.stdout = sys.stderr
+
+import bencode
+import json
+import lagmonitor
+import logging
+import logging.config
+import membudget
+import metrics
+import os
+import profiler
+import tracer
+
+from commands import MsgError
+from statuspublisher import StatusPublisher, split_update
+from torrentmgr import TorrentMgr, TorrentMgrError
+from workercommands import WorkerAdd, WorkerFetch, WorkerFiles, WorkerLag
+from workercommands import WorkerMaxPeers, WorkerMetrics, WorkerPeers
+from workercommands import WorkerPriority, WorkerProfile, WorkerQuit
+from workercommands import WorkerRead, WorkerResume, WorkerStart
+from workercommands import WorkerStatusUpdate, WorkerStop, WorkerStream
+from workercommands import WorkerTrace, WorkerTraceDump
+
+from twisted.internet import reactor, stdio
+from twisted.protocols.amp import AMP, MAX_VALUE_LENGTH
+
+logging.config.fileConfig(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), 'logging.conf'))
+logger = logging.getLogger('bt.worker')
+
+
+class WorkerServer(AMP):
+    def __init__(self, reactor, index, interval):
+        AMP.__init__(self)
+        self._reactor = reactor
+        self._index = index
+        self._interval = interval
+        self._torrents = {}
+        self._publisher = StatusPublisher(self._snapshot, reactor)
+        self._subscription = None
+
+        # _results maps the numbers of the results waiting to be read by the
+        # client with WorkerFetch to their data
+        self._results = {}
+        self._next_result = 0
+
+    def connectionMade(self):
+        AMP.connectionMade(self)
+        logger.info("Worker {} started".format(self._index))
+        self._subscription = self._publisher.subscribe(self._send_update,
+                                                       self._interval)
+
+    def connectionLost(self, reason):
+        AMP.connectionLost(self, reason)
+        logger.info("Worker {} lost the client, stopping".format(self._index))
+        if self._subscription is not None:
+            self._subscription.cancel()
+        if self._reactor.running:
+            self._reactor.stop()
+
+    def _snapshot(self):
+        snapshot = {}
+        for key, torrent in self._torrents.iteritems():
+            peers, snubbed = torrent.peer_counts()
+            snapshot[key] = {'state': torrent.state(),
+                             'percent': torrent.percent(),
+                             'download_rate': torrent.download_rate(),
+                             'upload_rate': torrent.upload_rate(),
+                             'peers': peers,
+                             'snubbed': snubbed,
+                             'memory': torrent.memory(),
+                             'needed': torrent.pieces_needed(),
+                             'swarm': torrent.swarm_size()}
+        return snapshot
+
+    def _send_update(self, deltas):
+        if deltas:
+            for chunk in split_update(deltas, MAX_VALUE_LENGTH):
+                self.callRemote(WorkerStatusUpdate, deltas=chunk)
+
+    @WorkerAdd.responder
+    def add(self, filename, port, peer_id, save_path='', resume=None):
+        if resume is not None:
+            resume = bencode.bdecode(resume)
+        torrent = TorrentMgr(filename, port, peer_id, self._reactor,
+                             save_path=save_path, resume=resume)
+
+        def success(_):
+            key = torrent.info_hash().encode('hex')
+            if key in self._torrents:
+                raise MsgError("Already serving {} (key: {})"
+                               .format(filename, key))
+
+            self._torrents[key] = torrent
+            return dict(key=key, name=torrent.name())
+
+        def failure(failure):
+            raise MsgError(failure.value.message)
+
+        return torrent.initialize().addCallbacks(success, failure)
+
+    @WorkerPeers.responder
+    def peers(self, key):
+        if key not in self._torrents:
+            raise MsgError("Invalid key: {}".format(key))
+        return dict(peers=json.dumps(self._torrents[key].peer_stats()))
+
+    def _torrent(self, key):
+        if key not in self._torrents:
+            raise MsgError("Invalid key: {}".format(key))
+        return self._torrents[key]
+
+    @WorkerStart.responder
+    def start(self, key):
+        try:
+            self._torrent(key).start()
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return dict()
+
+    @WorkerStop.responder
+    def stop(self, key):
+        try:
+            d = self._torrent(key).stop()
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return d.addCallback(lambda _: dict())
+
+    @WorkerMaxPeers.responder
+    def max_peers(self, key, peers):
+        try:
+            self._torrent(key).set_max_peers(peers)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return dict()
+
+    @WorkerResume.responder
+    def resume(self, key):
+        try:
+            data = self._torrent(key).resume_data()
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return dict(resume=bencode.bencode(data))
+
+    @WorkerFiles.responder
+    def files(self, key):
+        return dict(files=json.dumps(self._torrent(key).files()))
+
+    @WorkerStream.responder
+    def stream(self, key, enable, file=None):
+        try:
+            self._torrent(key).set_streaming(enable, file)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return dict()
+
+    @WorkerPriority.responder
+    def priority(self, key, priority, files=None):
+        try:
+            self._torrent(key).set_priority(priority, files)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return dict()
+
+    @WorkerRead.responder
+    def read(self, key, file, offset, length):
+        try:
+            d = self._torrent(key).read(file, offset, length)
+        except TorrentMgrError as err:
+            raise MsgError(err.message)
+        return d.addCallback(lambda data: dict(data=data))
+
+    def _hold(self, data):
+        # Hold data until the client has read it with WorkerFetch
+        result = self._next_result
+        self._next_result += 1
+        if data:
+            self._results[result] = data
+        return dict(result=result, size=len(data))
+
+    @WorkerFetch.responder
+    def fetch(self, result, offset, length):
+        if result not in self._results:
+            raise MsgError("Invalid result: {}".format(result))
+        data = self._results[result]
+        if offset + length >= len(data):
+            del self._results[result]
+        return dict(data=data[offset:offset + length])
+
+    @WorkerMetrics.responder
+    def metrics(self):
+        return self._hold(json.dumps(metrics.registry.collect()))
+
+    @WorkerTrace.responder
+    def trace(self, enable=None, sample=None):
+        if enable:
+            try:
+                tracer.enable(sample if sample is not None else 1)
+            except ValueError as err:
+                raise MsgError(err.message)
+        elif enable is not None:
+            tracer.disable()
+        return tracer.status()
+
+    @WorkerTraceDump.responder
+    def trace_dump(self):
+        return self._hold(tracer.dump())
+
+    @WorkerLag.responder
+    def lag(self):
+        return dict(lag=json.dumps(lagmonitor.status()))
+
+    @WorkerProfile.responder
+    def profile(self, duration, mode, format):
+        try:
+            d = profiler.profile(self._reactor, duration, mode, format)
+        except ValueError as err:
+            raise MsgError(err.message)
+        return d.addCallback(self._hold)
+
+    @WorkerQuit.responder
+    def quit(self):
+        self._reactor.callLater(0, self._reactor.stop)
+        return dict()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3:
+        membudget.set_limit(int(sys.argv[3]))
+    index = int(sys.argv[1])
+    tracer.set_source(index + 1)
+    lagmonitor.start(reactor)
+    stdio.StandardIO(WorkerServer(reactor, index, float(sys.argv[2])))
+    reactor.run()
@@ -0,0 +1,184 @@
+"""
+Worker channel message definitions in AMP format.  These are exchanged between
+the client and its worker processes over the workers' stdin and stdout.
+"""
+
+from commands import MsgError
+from twisted.protocols import amp
+
+
+class WorkerAdd(amp.Command):
+    """
+    Sent by the client to add a torrent to a worker.  The resume data, if
+    any, is bencoded as described for TorrentMgr.resume_data() and must fit
+    within AMP's limit on the size of a value.
+    """
+    arguments = [("filename", amp.String()),
+                 ("port", amp.Integer()),
+                 ("peer_id", amp.String()),
+                 ("save_path", amp.String(optional=True)),
+                 ("resume", amp.String(optional=True))]
+    response = [("key", amp.String()),
+                ("name", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerStart(amp.Command):
+    arguments = [("key", amp.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerStop(amp.Command):
+    """
+    Sent by the client to stop a torrent which its queue has made inactive.
+    The worker responds once the torrent's files have been closed.
+    """
+    arguments = [("key", amp.String())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerMaxPeers(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("peers", amp.Integer())]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerResume(amp.Command):
+    """
+    Responds with the bencoded resume data of a torrent hosted by a worker.
+    """
+    arguments = [("key", amp.String())]
+    response = [("resume", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerPeers(amp.Command):
+    arguments = [("key", amp.String())]
+    response = [("peers", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerFiles(amp.Command):
+    arguments = [("key", amp.String())]
+    response = [("files", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerStream(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("enable", amp.Boolean()),
+                 ("file", amp.Integer(optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerPriority(amp.Command):
+    arguments = [("key", amp.String()),
+                 ("priority", amp.String()),
+                 ("files", amp.ListOf(amp.Integer(), optional=True))]
+    response = []
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerRead(amp.Command):
+    """
+    Sent by the client to read part of a file of a torrent hosted by a
+    worker.  The worker responds once the pieces have been verified, so the
+    length must leave the response within AMP's limit on the size of a value.
+    """
+    arguments = [("key", amp.String()),
+                 ("file", amp.Integer()),
+                 ("offset", amp.Integer()),
+                 ("length", amp.Integer())]
+    response = [("data", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerFetch(amp.Command):
+    """
+    Sent by the client to read part of a result which a worker is holding
+    because it may be too large for a single AMP value.  The worker discards
+    the result once its end has been read.
+    """
+    arguments = [("result", amp.Integer()),
+                 ("offset", amp.Integer()),
+                 ("length", amp.Integer())]
+    response = [("data", amp.String())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerMetrics(amp.Command):
+    """
+    Responds with a result, to be read with WorkerFetch, holding the json
+    formatted values of the worker's metrics as returned by
+    metrics.Registry.collect().
+    """
+    arguments = []
+    response = [("result", amp.Integer()),
+                ("size", amp.Integer())]
+
+
+class WorkerTrace(amp.Command):
+    """
+    Sent by the client to turn tracing in a worker on or off, or, without
+    enable, to ask for the state of its tracer.
+    """
+    arguments = [("enable", amp.Boolean(optional=True)),
+                 ("sample", amp.Integer(optional=True))]
+    response = [("enabled", amp.Boolean()),
+                ("sample", amp.Integer()),
+                ("capacity", amp.Integer()),
+                ("records", amp.Integer()),
+                ("recorded", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerTraceDump(amp.Command):
+    """
+    Responds with a result, to be read with WorkerFetch, holding the raw
+    contents of the worker's trace ring buffer.
+    """
+    arguments = []
+    response = [("result", amp.Integer()),
+                ("size", amp.Integer())]
+
+
+class WorkerLag(amp.Command):
+    """
+    Responds with the json formatted summary of the lag of the worker's
+    reactor as returned by lagmonitor.status().
+    """
+    arguments = []
+    response = [("lag", amp.String())]
+
+
+class WorkerProfile(amp.Command):
+    """
+    Sent by the client to profile a worker.  The worker responds once the
+    profile has been taken with a result, to be read with WorkerFetch,
+    holding the result in the specified format.
+    """
+    arguments = [("duration", amp.Float()),
+                 ("mode", amp.String()),
+                 ("format", amp.String())]
+    response = [("result", amp.Integer()),
+                ("size", amp.Integer())]
+    errors = {MsgError: "MsgError"}
+
+
+class WorkerStatusUpdate(amp.Command):
+    """
+    Sent by a worker to the client with the changes to the status of the
+    torrents it hosts.  The deltas are a json formatted string as described in
+    statuspublisher.py.
+    """
+    arguments = [("deltas", amp.String())]
+    requiresAnswer = False
+
+
+class WorkerQuit(amp.Command):
+    arguments = []
+    response = []
@@ -0,0 +1,444 @@
+"""
+The WorkerPool runs a number of worker processes (see worker.py), each hosting
+a share of the client's torrents, so that a busy torrent which is parsing,
+hashing and writing only competes for a CPU core with the other torrents in
+its worker rather than with every torrent.  The control channels stay in the
+client's process and talk to the workers over AMP on the workers' stdin and
+stdout.
+
+Each new torrent is given to the worker hosting the fewest torrents.  The
+WorkerPool returns a RemoteTorrent for each torrent, which stands in for the
+TorrentMgr in the worker.  The worker only initializes the torrent, which is
+started and stopped by the client's queue (see torrentqueue.py).  The workers
+push the changes to the status of their torrents every interval seconds and
+the RemoteTorrent answers status requests from the most recent status without
+a round trip to the worker.  Requests for the resume data, peers and files of
+a torrent, to start or stop it, to limit its peers, to set the priorities of
+its files, to stream it and to read from it are forwarded to its worker, so
+the corresponding methods of RemoteTorrent return Deferreds.
+
+The metrics, lag, trace records and profiles of the workers are gathered
+from every running worker by the WorkerPool so that the client can combine
+them with its own.  A worker which fails to respond is left out and logged.
+
+If a worker exits, its torrents are reported as lost.
+
+When the WorkerPool is given a memory limit, each worker is given an equal
+share of it as the limit of its own memory budget (see membudget.py).
+"""
+
+import bencode
+import json
+import logging
+import os
+import sys
+
+from commands import MsgError
+from workercommands import WorkerAdd, WorkerFetch, WorkerFiles, WorkerLag
+from workercommands import WorkerMaxPeers, WorkerMetrics, WorkerPeers
+from workercommands import WorkerPriority, WorkerProfile, WorkerQuit
+from workercommands import WorkerRead, WorkerResume, WorkerStart
+from workercommands import WorkerStatusUpdate, WorkerStop, WorkerStream
+from workercommands import WorkerTrace, WorkerTraceDump
+
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.amp import AMP
+
+logger = logging.getLogger('bt.workerpool')
+
+_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'worker.py')
+_STATUS_INTERVAL = 0.5
+
+# The number of bytes of a result read from a worker at a time, which must
+# leave the response within AMP's limit on the size of a value
+_FETCH_SIZE = 2**15
+
+
+class RemoteTorrent(object):
+    def __init__(self, worker, key, name):
+        self._worker = worker
+        self._key = key
+        self._name = name
+        self._status = {'state': 'initialized',
+                        'percent': 0.0,
+                        'download_rate': 0.0,
+                        'upload_rate': 0.0,
+                        'peers': 0,
+                        'snubbed': 0,
+                        'memory': 0,
+                        'needed': None,
+                        'swarm': None}
+
+    def _update(self, delta):
+        self._status.update(delta)
+
+    def info_hash(self):
+        return self._key.decode('hex')
+
+    def name(self):
+        return self._name
+
+    def state(self):
+        return self._status['state']
+
+    def percent(self):
+        return self._status['percent']
+
+    def download_rate(self):
+        return self._status['download_rate']
+
+    def upload_rate(self):
+        return self._status['upload_rate']
+
+    def peer_counts(self):
+        return self._status['peers'], self._status['snubbed']
+
+    def memory(self):
+        return self._status['memory']
+
+    def pieces_needed(self):
+        return self._status['needed']
+
+    def swarm_size(self):
+        return self._status['swarm']
+
+    def start(self):
+        return self._worker.call(WorkerStart, key=self._key)
+
+    def stop(self):
+        return self._worker.call(WorkerStop, key=self._key)
+
+    def set_max_peers(self, max_peers):
+        return self._worker.call(WorkerMaxPeers, key=self._key,
+                                 peers=max_peers)
+
+    def resume_data(self):
+        return (self._worker.call(WorkerResume, key=self._key)
+                .addCallback(lambda response:
+                             bencode.bdecode(response['resume'])))
+
+    def peer_stats(self):
+        """
+        peer_stats() returns a Deferred which fires with the list of
+        dictionaries of transfer statistics that the TorrentMgr in the worker
+        returns.
+        """
+        return (self._worker.call(WorkerPeers, key=self._key)
+                .addCallback(lambda response: json.loads(response['peers'])))
+
+    def files(self):
+        return (self._worker.call(WorkerFiles, key=self._key)
+                .addCallback(lambda response: json.loads(response['files'])))
+
+    def set_streaming(self, enable, file_index=None):
+        kwargs = {}
+        if file_index is not None:
+            kwargs['file'] = file_index
+        return self._worker.call(WorkerStream, key=self._key, enable=enable,
+                                 **kwargs)
+
+    def set_priority(self, priority, file_indices=None):
+        kwargs = {}
+        if file_indices is not None:
+            kwargs['files'] = list(file_indices)
+        return self._worker.call(WorkerPriority, key=self._key,
+                                 priority=priority, **kwargs)
+
+    def read(self, file_index, offset, length):
+        return (self._worker.call(WorkerRead, key=self._key, file=file_index,
+                                  offset=offset, length=length)
+                .addCallback(lambda response: response['data']))
+
+
+class _WorkerChannel(AMP):
+    # The client's end of the AMP channel with a worker
+    def __init__(self, worker):
+        AMP.__init__(self)
+        self._worker = worker
+
+    @WorkerStatusUpdate.responder
+    def status_update(self, deltas):
+        self._worker._status_update(json.loads(deltas))
+        return dict()
+
+
+class _ChannelTransport(object):
+    # Presents the worker's stdin as the transport of the AMP channel
+    def __init__(self, process):
+        self._process = process
+
+    def write(self, data):
+        self._process.writeToChild(0, data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        self._process.loseConnection()
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class _WorkerProcess(ProcessProtocol):
+    # Connects the AMP channel to the worker's stdin and stdout and passes
+    # the worker's stderr on to the client's
+    def __init__(self, worker, channel):
+        self._worker = worker
+        self._channel = channel
+
+    def connectionMade(self):
+        self._channel.makeConnection(_ChannelTransport(self.transport))
+        self._worker._started()
+
+    def childDataReceived(self, fd, data):
+        if fd == 1:
+            self._channel.dataReceived(data)
+        else:
+            sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        self._channel.connectionLost(reason)
+        self._worker._ended(reason)
+
+
+class Worker(object):
+    def __init__(self, reactor, index, interval=_STATUS_INTERVAL,
+                 memory=None):
+        self._reactor = reactor
+        self._index = index
+        self._interval = interval
+        self._memory = memory
+        self._channel = _WorkerChannel(self)
+        self._process = None
+        self._running = False
+        self._stopping = False
+        self._start_deferred = None
+        self.pending = 0
+
+        # _torrents maps keys to the RemoteTorrents hosted by the worker
+        self._torrents = {}
+
+    def start(self):
+        """
+        start() starts the worker process and returns a Deferred which fires
+        once it has started.
+        """
+        self._start_deferred = Deferred()
+        args = [sys.executable, _WORKER, str(self._index), str(self._interval)]
+        if self._memory is not None:
+            args.append(str(self._memory))
+        self._process = self._reactor.spawnProcess(
+            _WorkerProcess(self, self._channel), sys.executable, args,
+            env=os.environ, path=os.getcwd())
+        return self._start_deferred
+
+    def stop(self):
+        if self._running:
+            self._stopping = True
+            self._channel.callRemote(WorkerQuit).addErrback(lambda _: None)
+
+    def running(self):
+        return self._running
+
+    def index(self):
+        return self._index
+
+    def load(self):
+        return len(self._torrents) + self.pending
+
+    def call(self, command, **kwargs):
+        if not self._running:
+            d = Deferred()
+            d.errback(MsgError("Worker {} is not running"
+                               .format(self._index)))
+            return d
+        return self._channel.callRemote(command, **kwargs)
+
+    def call_result(self, command, **kwargs):
+        """
+        call_result() sends a command to which the worker responds with a
+        result held for WorkerFetch and returns a Deferred which fires with
+        the data of the result once it has all been read.
+        """
+        chunks = []
+
+        def read(response):
+            offset = sum(len(chunk) for chunk in chunks)
+            if offset >= response['size']:
+                return ''.join(chunks)
+
+            def received(fetched):
+                chunks.append(fetched['data'])
+                return read(response)
+
+            length = min(_FETCH_SIZE, response['size'] - offset)
+            return (self.call(WorkerFetch, result=response['result'],
+                              offset=offset, length=length)
+                    .addCallback(received))
+
+        return self.call(command, **kwargs).addCallback(read)
+
+    def add_torrent(self, filename, port, peer_id, save_path=None,
+                    resume=None):
+        """
+        add_torrent() asks the worker to add the torrent specified by
+        filename, saving its files under save_path and resuming from the
+        resume data if supplied, and returns a Deferred which fires with its
+        RemoteTorrent.
+        """
+        kwargs = {}
+        if save_path is not None:
+            kwargs['save_path'] = save_path
+        if resume is not None:
+            kwargs['resume'] = bencode.bencode(resume)
+        self.pending += 1
+
+        def success(response):
+            self.pending -= 1
+            torrent = RemoteTorrent(self, response['key'], response['name'])
+            self._torrents[response['key']] = torrent
+            return torrent
+
+        def failure(failure):
+            self.pending -= 1
+            raise MsgError(failure.getErrorMessage())
+
+        return (self.call(WorkerAdd, filename=filename, port=port,
+                          peer_id=peer_id, **kwargs)
+                .addCallbacks(success, failure))
+
+    def _started(self):
+        self._running = True
+        self._start_deferred.callback(self)
+
+    def _status_update(self, deltas):
+        for key, delta in deltas.iteritems():
+            if key in self._torrents and delta is not None:
+                self._torrents[key]._update(delta)
+
+    def _ended(self, reason):
+        self._running = False
+        if self._stopping:
+            logger.info("Worker {} stopped".format(self._index))
+            return
+
+        logger.critical("Worker {} exited: {}"
+                        .format(self._index, reason.getErrorMessage()))
+        for torrent in self._torrents.itervalues():
+            torrent._update({'state': 'lost', 'download_rate': 0.0,
+                             'upload_rate': 0.0, 'peers': 0, 'snubbed': 0,
+                             'memory': 0})
+
+
+class WorkerPool(object):
+    def __init__(self, reactor, num_workers, interval=_STATUS_INTERVAL,
+                 memory=None):
+        if num_workers < 1:
+            raise ValueError("There must be at least one worker")
+        share = memory // num_workers if memory is not None else None
+        self._workers = [Worker(reactor, index, interval, share)
+                         for index in range(num_workers)]
+
+    def start(self):
+        """
+        start() starts the worker processes and returns a Deferred which fires
+        once they have all started.
+        """
+        return DeferredList([worker.start() for worker in self._workers],
+                            fireOnOneErrback=True)
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+    def add_torrent(self, filename, port, peer_id, save_path=None,
+                    resume=None):
+        """
+        add_torrent() gives the torrent specified by filename to the worker
+        hosting the fewest torrents and returns a Deferred which fires with
+        a RemoteTorrent for it.
+        """
+        workers = [worker for worker in self._workers if worker.running()]
+        if workers == []:
+            d = Deferred()
+            d.errback(MsgError("No workers are running"))
+            return d
+
+        worker = min(workers, key=lambda worker: worker.load())
+        return worker.add_torrent(filename, port, peer_id, save_path, resume)
+
+    def _gather(self, call):
+        # Returns a Deferred which fires with a list of the (index, result)
+        # pairs of the running workers for which call(worker) succeeded
+        workers = [worker for worker in self._workers if worker.running()]
+
+        def gathered(results):
+            succeeded = []
+            for worker, (success, result) in zip(workers, results):
+                if success:
+                    succeeded.append((worker.index(), result))
+                else:
+                    logger.warning("Worker {} failed to respond: {}"
+                                   .format(worker.index(),
+                                           result.getErrorMessage()))
+            return succeeded
+
+        return (DeferredList([call(worker) for worker in workers],
+                             consumeErrors=True)
+                .addCallback(gathered))
+
+    def collect_metrics(self):
+        """
+        collect_metrics() returns a Deferred which fires with a list of the
+        index of each worker and the values of its metrics as returned by
+        metrics.Registry.collect().
+        """
+        return self._gather(lambda worker: worker.call_result(WorkerMetrics)
+                            .addCallback(json.loads))
+
+    def set_tracing(self, enable=None, sample=None):
+        """
+        set_tracing() turns tracing in the workers on or off, or leaves it as
+        it is if enable is None, and returns a Deferred which fires with a
+        list of the index of each worker and the state of its tracer as
+        returned by tracer.status().
+        """
+        kwargs = {}
+        if enable is not None:
+            kwargs['enable'] = bool(enable)
+        if sample is not None:
+            kwargs['sample'] = sample
+        return self._gather(lambda worker: worker.call(WorkerTrace, **kwargs))
+
+    def get_trace(self):
+        """
+        get_trace() returns a Deferred which fires with a list of the index
+        of each worker and the raw contents of its trace ring buffer.
+        """
+        return self._gather(lambda worker:
+                            worker.call_result(WorkerTraceDump))
+
+    def get_lag(self):
+        """
+        get_lag() returns a Deferred which fires with a list of the index of
+        each worker and the summary of the lag of its reactor as returned by
+        lagmonitor.status().
+        """
+        return self._gather(lambda worker: worker.call(WorkerLag)
+                            .addCallback(lambda response:
+                                         json.loads(response['lag'])))
+
+    def profile(self, duration, mode, format):
+        """
+        profile() profiles each worker for duration seconds and returns a
+        Deferred which fires with a list of the index of each worker and the
+        result in the specified format.
+        """
+        return self._gather(lambda worker: worker.call_result(
+            WorkerProfile, duration=duration, mode=mode, format=format))